@@ -1,11 +1,17 @@
-import json
+import copy
 import re
 import os
+import threading
+import unicodedata
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, List, Optional, Tuple
 from langchain_openai import AzureChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import JsonOutputParser
+import httpx
 import langchain
+import json_utils
+from bounded_cache import BoundedCache
 from ai_prompts import (
     NEGATIVE_RESPONSE_PROMPT, 
     EXTRACTION_PROMPT, 
@@ -13,8 +19,7 @@ from ai_prompts import (
     INVENTORY_DETECTION_PROMPT
 )
 from maquinaria_config import machinery_config_service, get_required_fields_for_tipo
-from state_management import ConversationState, ConversationStateStore, InMemoryStateStore, FIELDS_CONFIG_PRIORITY
-from datetime import datetime, timezone
+from state_management import ConversationState, ConversationStateStore, InMemoryStateStore, FIELDS_CONFIG_PRIORITY, build_message
 import logging
 from hubspot_manager import HubSpotManager
 from inventory_service import InventoryService
@@ -49,8 +54,11 @@ langchain.llm_cache = False
 # CONFIGURACIÓN DE DEBUG
 # ============================================================================
 
-# Variable global para controlar si se muestran los prints de DEBUG
-DEBUG_MODE = True
+# Logs de depuración del flujo, apagados por defecto. Con CHATBOT_DEBUG=1 se
+# encienden sin tocar código. Las llamadas que vuelcan textos grandes (el
+# estado, la extracción, el prompt) usan argumentos %s para que logging solo
+# los formatee si el mensaje realmente se emite.
+DEBUG_MODE = os.environ.get("CHATBOT_DEBUG") == "1"
 
 def debug_print(*args, **kwargs):
     """
@@ -84,23 +92,70 @@ def get_inventory():
 # OBTENER EL ESTADO ACTUAL DE LOS CAMPOS EN UN STRING
 # ============================================================================
 
-def get_current_state_str(current_state: ConversationState) -> str:
-    """Obtiene el estado actual de los campos como una cadena de texto"""
-    field_names = [field for field in FIELDS_CONFIG_PRIORITY.keys()]
-    fields_str = ""
-    for field in field_names:
+def _dumps_detalles(detalles: Dict[str, Any]) -> str:
+    """
+    Serializa detalles_maquinaria para los prompts. No se memoiza por
+    contenido: 1, 1.0 y True son llaves iguales para un caché y un valor
+    cacheado se colaría en lugar de otro.
+    """
+    return json_utils.dumps(detalles)
+
+
+def get_current_state_str(current_state: ConversationState, summarize_detalles: bool = False) -> str:
+    """
+    Obtiene el estado actual de los campos como una cadena de texto.
+
+    Con summarize_detalles=True, detalles_maquinaria se resume a cuántos campos
+    hay registrados en lugar del JSON completo (prompt más corto en los turnos
+    que no tratan de la máquina).
+    """
+    lines = []
+    for field in FIELDS_CONFIG_PRIORITY:
         if field == "detalles_maquinaria":
-            fields_str += f"- {field}: " + json.dumps(current_state.get(field) or {}) + "\n"
+            detalles = current_state.get(field) or {}
+            if summarize_detalles:
+                filled_count = sum(1 for v in detalles.values() if v not in (None, ""))
+                lines.append(f"- {field}: {filled_count} campos registrados\n")
+            else:
+                lines.append(f"- {field}: {_dumps_detalles(detalles)}\n")
         else:
             value = current_state.get(field)
             # Convert to string to handle boolean values like quiere_cotizacion
-            fields_str += f"- {field}: " + (str(value) if value is not None else "") + "\n"
-    return fields_str
+            lines.append(f"- {field}: {str(value) if value is not None else ''}\n")
+    return "".join(lines)
+
+def _normalize_text(text: str) -> str:
+    """Minúsculas, sin acentos y con espacios colapsados, para comparar frases del lead."""
+    nfkd = unicodedata.normalize("NFKD", str(text))
+    cleaned = "".join(c for c in nfkd if not unicodedata.combining(c)).lower()
+    return re.sub(r"\s+", " ", cleaned).strip()
+
 
 # ============================================================================
 # CONFIGURACIÓN DE AZURE OPENAI
 # ============================================================================
 
+# Instancias de AzureChatOpenAI compartidas por el proceso (ver create_llm)
+_LLM_CACHE: Dict[tuple, AzureChatOpenAI] = {}
+_LLM_CACHE_LOCK = threading.Lock()
+
+# Cliente HTTP único para todas las instancias de AzureChatOpenAI del proceso.
+# Cada instancia abriría su propio pool (y su propio handshake TLS); así la
+# extracción, la respuesta y el inventario reutilizan las mismas conexiones
+# keep-alive hacia Azure. Se crea perezosamente al construir el primer LLM.
+_HTTP_CLIENT: Optional[httpx.Client] = None
+
+
+def _get_http_client() -> httpx.Client:
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is None:
+        _HTTP_CLIENT = httpx.Client(
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+            timeout=60,
+        )
+    return _HTTP_CLIENT
+
+
 class AzureOpenAIConfig:
     """Clase para manejar la configuración de Azure OpenAI con diferentes configuraciones según el propósito"""
     
@@ -109,10 +164,14 @@ class AzureOpenAIConfig:
                  api_key: str,
                  deployment_name: str,
                  api_version: str = "2024-12-01-preview",
-                 model_name: str = "gpt-4.1-mini"):
+                 model_name: str = "gpt-4.1-mini",
+                 light_deployment_name: Optional[str] = None):
         self.endpoint = endpoint
         self.api_key = api_key
         self.deployment_name = deployment_name
+        # Deployment para generación ligera (ver create_light_llm). Si no se
+        # configura uno aparte, se usa el mismo que el resto.
+        self.light_deployment_name = light_deployment_name or deployment_name
         self.api_version = api_version
         self.model_name = model_name
         
@@ -121,12 +180,36 @@ class AzureOpenAIConfig:
         os.environ["FOUNDRY_API_KEY"] = api_key
         os.environ["OPENAI_API_VERSION"] = api_version
     
-    def create_llm(self, temperature: float = 0.3, max_tokens: int = 1000, top_p: float = 1.0):
-        """Crea una instancia de AzureChatOpenAI con parámetros personalizados"""
+    def create_llm(self, temperature: float = 0.3, max_tokens: int = 1000, top_p: float = 1.0, json_mode: bool = False,
+                   deployment_name: Optional[str] = None):
+        """
+        Crea una instancia de AzureChatOpenAI con parámetros personalizados.
+        Con `json_mode` el modelo responde siempre un objeto JSON válido
+        (response_format json_object), así que no hace falta limpiar la salida.
+
+        Las instancias se reutilizan por proceso para cada combinación de
+        parámetros: el bot se arma en cada request, pero todas las conversaciones
+        que atiende el worker comparten el mismo cliente y su pool de conexiones
+        HTTP hacia Azure en lugar de abrir uno nuevo por mensaje.
+        """
+        deployment_name = deployment_name or self.deployment_name
+        cache_key = (
+            self.endpoint, self.api_key, deployment_name, self.api_version, self.model_name,
+            temperature, max_tokens, top_p, json_mode
+        )
+        with _LLM_CACHE_LOCK:
+            llm = _LLM_CACHE.get(cache_key)
+            if llm is None:
+                llm = self._build_llm(deployment_name, temperature, max_tokens, top_p, json_mode)
+                _LLM_CACHE[cache_key] = llm
+        return llm
+
+    def _build_llm(self, deployment_name: str, temperature: float, max_tokens: int, top_p: float, json_mode: bool):
+        model_kwargs = {"response_format": {"type": "json_object"}} if json_mode else {}
         return AzureChatOpenAI(
             azure_endpoint=self.endpoint,
             api_key=self.api_key,
-            azure_deployment=self.deployment_name,
+            azure_deployment=deployment_name,
             api_version=self.api_version,
             model_name=self.model_name,
             temperature=temperature,
@@ -134,6 +217,8 @@ class AzureOpenAIConfig:
             max_tokens=max_tokens,
             timeout=60,
             max_retries=3,
+            model_kwargs=model_kwargs,
+            http_client=_get_http_client(),
             verbose=True
         )
     
@@ -142,7 +227,8 @@ class AzureOpenAIConfig:
         return self.create_llm(
             temperature=0.1,  # Temperatura muy baja para extracción precisa
             top_p=0.9,        # Top-p moderado para consistencia
-            max_tokens=1000
+            max_tokens=1000,
+            json_mode=True    # Extracción y respuestas negativas siempre regresan JSON
         )
     
     def create_conversational_llm(self):
@@ -153,6 +239,20 @@ class AzureOpenAIConfig:
             max_tokens=300
         )
     
+    def create_light_llm(self, max_tokens: int = 300):
+        """
+        Crea un LLM para las respuestas conversacionales del bot (confirmar lo
+        recibido y hacer la siguiente pregunta). Usa el deployment ligero si está
+        configurado (FOUNDRY_LIGHT_DEPLOYMENT), con los mismos parámetros de
+        muestreo que el conversacional.
+        """
+        return self.create_llm(
+            temperature=0.7,
+            top_p=0.95,
+            max_tokens=max_tokens,
+            deployment_name=self.light_deployment_name
+        )
+    
     def create_inventory_llm(self):
         """Crea un LLM para responder preguntas sobre inventario (temperatura moderada)"""
         return self.create_llm(
@@ -176,16 +276,15 @@ _MACHINERY_QUESTION_TYPES = {
     "seleccion_maquina",
 }
 
+# Palabras clave de giro que identifican a un distribuidor.
+_GIRO_DISTRIBUIDOR_KEYWORDS = ("venta", "renta", "distribuidor", "reventa", "distribucion", "distribución")
+
 def _is_distribuidor(giro: str) -> bool:
     """Verifica si el giro corresponde a un distribuidor basado en palabras clave."""
     if not giro:
         return False
     g = giro.lower()
-    distributor_keywords = ["venta", "renta", "distribuidor", "reventa", "distribucion", "distribución"]
-    for keyword in distributor_keywords:
-        if keyword in g:
-            return True
-    return False
+    return any(keyword in g for keyword in _GIRO_DISTRIBUIDOR_KEYWORDS)
 
 def _is_compresor_estacionario(current_state: dict) -> bool:
     """Verifica si el lead está solicitando un compresor estacionario.
@@ -196,12 +295,17 @@ def _is_compresor_estacionario(current_state: dict) -> bool:
     tipo_compresor = str(detalles.get("tipo_compresor", "")).lower()
     return "estacionario" in tipo_compresor or "electrico" in tipo_compresor or "eléctrico" in tipo_compresor
 
+# Llaves del documento de inventario que no son características técnicas
+# (metadatos de Cosmos, identificadores y precio, que no se muestra).
+_MACHINE_DETAILS_IGNORE_KEYS = frozenset((
+    "modelo", "categoria", "id", "_rid", "_self", "_etag", "_attachments", "_ts", "precio", "moneda",
+))
+
 def _format_machine_details(machine: Dict[str, Any]) -> str:
     """Extrae las características técnicas de una máquina en un string amigable."""
-    ignore_keys = {"modelo", "categoria", "id", "_rid", "_self", "_etag", "_attachments", "_ts", "precio", "moneda"}
     details = []
     for key, value in machine.items():
-        if key not in ignore_keys and value is not None and str(value).strip() != "":
+        if key not in _MACHINE_DETAILS_IGNORE_KEYS and value is not None and str(value).strip() != "":
             # Convert keys: "altura_trabajo_m" -> "Altura Trabajo M"
             label = " ".join(word.capitalize() for word in key.split("_"))
             details.append(f"{label}: {value}")
@@ -263,16 +367,236 @@ def get_pending_empresa_fields(current_state: ConversationState) -> List[str]:
 # SISTEMA DE SLOT-FILLING INTELIGENTE
 # ============================================================================
 
+# Preguntas fijas del flujo, armadas una sola vez a partir de
+# FIELDS_CONFIG_PRIORITY. Son de solo lectura porque se comparten entre todas
+# las conversaciones del proceso.
+_FIXED_QUESTIONS = {
+    name: MappingProxyType({
+        "question": FIELDS_CONFIG_PRIORITY[name]["question"],
+        "reason": FIELDS_CONFIG_PRIORITY[name]["reason"],
+        "question_type": name,
+    })
+    for name in ("nombre", "apellido", "tipo_ayuda", "tipo_maquinaria", "quiere_cotizacion")
+}
+
+# Campos marcados como obligatorios en FIELDS_CONFIG_PRIORITY.
+_REQUIRED_TOP_FIELDS = tuple(
+    field for field, config in FIELDS_CONFIG_PRIORITY.items() if config["required"]
+)
+
+# Palabras clave para inferir tipo_cliente del último mensaje del lead. Se
+# comparan contra el texto normalizado (minúsculas y sin acentos).
+_CLIENTE_FINAL_KEYWORDS = (
+    "uso propio", "uso de la empresa", "uso interno", "para mi empresa",
+    "para nuestra empresa", "para la empresa", "no me dedico",
+    "no nos dedicamos", "no, es para", "cliente final", "cliente_final",
+)
+_DISTRIBUIDOR_KEYWORDS = (
+    "si me dedico", "me dedico a la venta", "me dedico a la renta",
+    "para venta", "para reventa", "para distribucion", "soy distribuidor",
+)
+
+# Respuestas completas (vocabulario cerrado) a la pregunta de si el equipo es
+# para venta o para uso propio. Si el mensaje normalizado es exactamente una de
+# estas, tipo_cliente se resuelve sin LLM.
+_TIPO_CLIENTE_REPLIES = {
+    **dict.fromkeys((
+        "uso propio", "para uso propio", "es para uso propio", "uso interno",
+        "para uso interno", "uso de la empresa", "para uso de la empresa",
+        "para mi empresa", "para nuestra empresa", "para la empresa",
+        "es para la empresa", "es para nuestra empresa", "cliente final",
+    ), "cliente_final"),
+    **dict.fromkeys((
+        "venta", "para venta", "es para venta", "para vender", "para reventa",
+        "reventa", "para distribucion", "distribucion", "para comercializar",
+        "soy distribuidor", "somos distribuidores", "renta", "para renta",
+    ), "distribuidor"),
+}
+
+def _details_filled(detalles: Dict[str, Any], required_fields: List[str]) -> bool:
+    """True si todos los campos requeridos están en detalles con un valor distinto de None/""."""
+    for field in required_fields:
+        value = detalles.get(field)
+        if value is None or value == "":
+            return False
+    return True
+
+
+# Mensajes que son únicamente un correo o un teléfono: se extraen sin LLM.
+_EMAIL_ONLY_RE = re.compile(r"^([\w.+-]+@[\w-]+(?:\.[\w-]+)+)[.!]?$")
+_PHONE_ONLY_RE = re.compile(r"^\+?[\d\s().-]+$")
+
+# Pool compartido para las llamadas al LLM que pueden ir en paralelo dentro de
+# un mismo turno. Se crea una sola vez por proceso para no pagar el arranque de
+# hilos en cada mensaje.
+_LLM_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="llm")
+
+# Pool para la actualización del contacto en HubSpot, que corre mientras se
+# genera la respuesta (ver send_message).
+_HUBSPOT_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="hubspot")
+
+# Lista de campos con su descripción para los prompts de extracción y de
+# respuestas negativas. FIELDS_CONFIG_PRIORITY es estático, así que el texto se
+# arma una sola vez al importar en lugar de en cada llamada al LLM.
+_FIELDS_AVAILABLE_STR = "".join(
+    f"- {field}: {config['description']}\n" for field, config in FIELDS_CONFIG_PRIORITY.items()
+)
+
+# Llave con la que el prompt de extracción clasifica si el mensaje es una
+# pregunta de inventario. No es un campo del lead.
+INVENTORY_FLAG_KEY = "es_pregunta_inventario"
+
+# Frases con las que el lead pide que se le reenvíe la cotización PDF.
+_PDF_RESEND_KEYWORDS = (
+    "cotización", "cotizacion", "pdf", "mándame", "mandame",
+    "envíame", "enviame", "reenvía", "reenvia", "otra vez",
+    "de nuevo", "vuelve a enviar", "manda otra",
+)
+
+# Caché de extracciones por (pregunta del bot, mensaje normalizado, tipo de
+# pregunta, qué slots están llenos, tipo de maquinaria, recomendadas). Las
+# respuestas cortas ("si", "2", "para venta") se repiten mucho entre leads y
+# para la misma pregunta producen la misma extracción. La firma del estado usa
+# solo QUÉ campos están llenos, no sus valores, para no mezclar datos de leads;
+# por lo mismo no se cachea una extracción que repite valores del estado (ver
+# _echoes_state). Solo se cachean mensajes cortos: los largos casi nunca se repiten.
+_EXTRACTION_CACHE = BoundedCache(maxsize=4096)
+_EXTRACTION_CACHE_MAX_LEN = 64
+
+
+def _extraction_cache_key(
+    message: str,
+    current_state: ConversationState,
+    last_bot_question: Optional[str],
+    last_question_type: Optional[str],
+) -> Optional[Tuple]:
+    normalized = " ".join(message.lower().split())
+    if not normalized or len(normalized) > _EXTRACTION_CACHE_MAX_LEN:
+        return None
+    filled = tuple(
+        field for field in FIELDS_CONFIG_PRIORITY
+        if current_state.get(field) not in (None, "", [], {})
+    )
+    detalles = current_state.get("detalles_maquinaria") or {}
+    detalles_filled = tuple(sorted(k for k, v in detalles.items() if v not in (None, "")))
+    return (
+        last_bot_question or "",
+        normalized,
+        last_question_type or "",
+        filled,
+        detalles_filled,
+        current_state.get("tipo_maquinaria") or "",
+        tuple(current_state.get("maquinas_recomendadas") or ()),
+        # Con la conversación completada se omite la detección de negativas
+        bool(current_state.get("completed")),
+    )
+
+def _echoes_state(extracted_data: Dict[str, Any], current_state: ConversationState) -> bool:
+    """
+    True si la extracción trae algún valor que ya está en el estado. El prompt
+    pide reenviar los subcampos de detalles_maquinaria "incluso si ya tienen
+    valor", así que ante un "sí" el modelo puede devolver los datos del lead:
+    cacheados, otro lead con los mismos campos llenos los recibiría y, como
+    detalles_maquinaria se sobrescribe, reemplazarían los suyos.
+    """
+    for key, value in extracted_data.items():
+        if value in (None, "", [], {}):
+            continue
+        current = current_state.get(key)
+        if key == "detalles_maquinaria" and isinstance(value, dict) and isinstance(current, dict):
+            if any(v not in (None, "") and current.get(k) == v for k, v in value.items()):
+                return True
+        elif current == value:
+            return True
+    return False
+
+# Campos que SÍ se sobrescriben aunque ya tengan valor:
+# - detalles_maquinaria: se actualiza múltiples veces porque tiene varios subcampos.
+# - quiere_cotizacion: puede cambiar si el usuario corrige su respuesta.
+# - maquina_seleccionada: puede cambiar si el usuario elige otra máquina.
+# - tipo_maquinaria: puede cambiar si el usuario cambia de opinión.
+# - giro_empresa: el usuario puede corregirlo (ej: "en realidad nos dedicamos a la construcción").
+# - tipo_cliente: puede cambiar por reclasificación (distribuidor → cliente_final).
+_OVERWRITABLE_FIELDS = frozenset((
+    "detalles_maquinaria", "quiere_cotizacion", "maquina_seleccionada",
+    "tipo_maquinaria", "giro_empresa", "tipo_cliente",
+))
+
+# Plantilla del estado vacío (ver _create_empty_state). Se arma una sola vez:
+# FIELDS_CONFIG_PRIORITY es estático. Solo guarda valores inmutables; las
+# listas y el dict de detalles se crean por conversación.
+_EMPTY_STATE_TEMPLATE = MappingProxyType({
+    # Campos que no se preguntan al usuario
+    "completed": False,
+    "cotizacion_enviada": False,  # True cuando ya se envió la respuesta final (evita ciclo)
+    "messages": None,
+    "conversation_mode": "bot", # agente o bot
+    "asignado_asesor": None,
+    "hubspot_contact_id": None,
+    "quiere_cotizacion": None,
+    "maquinas_recomendadas": None,  # Lista de máquinas recomendadas para mapear posición a modelo
+    "maquina_mencionada": None,  # Código/modelo que el lead mencionó por su cuenta
+    "marcas_solicitadas": None,  # Marcas que pidió el lead (ej. ["DeWalt", "Makita"])
+    "marcas_aclaradas": False,  # True cuando el bot ya le respondió sobre esas marcas
+    "cobertura_aclarada": False,  # True cuando ya se le dijo que solo operamos en México
+    # Campos que se preguntan al usuario
+    **dict.fromkeys(FIELDS_CONFIG_PRIORITY),
+})
+
+# Campos del lead que la extracción puede escribir en el estado. Cualquier otra
+# llave que invente el LLM (ej. "messages" o "completed") se ignora.
+_TRACKED_KEYS = frozenset(FIELDS_CONFIG_PRIORITY)
+
+# Mensajes del historial que se mandan al LLM de respuesta. Lo que dijo el lead
+# antes ya está en el estado (que va completo en el prompt); el historial solo
+# aporta el tono y el hilo reciente. Sin tope, el prompt crecía con cada turno.
+# El estado conserva la conversación completa: la web la muestra y Cosmos la
+# guarda tal cual.
+_PROMPT_HISTORY_WINDOW = 20
+
+
+def _history_for_prompt(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [
+        {"role": msg["role"], "content": msg["content"]}
+        for msg in messages[-_PROMPT_HISTORY_WINDOW:]
+    ]
+
+# Llave del estado con la última pregunta del bot (ver _remember_last_bot_question).
+LAST_BOT_QUESTION_KEY = "_last_bot_question"
+
+
+def _bot_question_from_content(content: str) -> str:
+    """La última línea con '?' de un mensaje del bot, o el mensaje completo si no pregunta nada."""
+    q = content.rfind("?")
+    if q == -1:
+        return content
+    # Límites de la línea que contiene ese '?', sin partir todo el mensaje
+    start = content.rfind("\n", 0, q) + 1
+    end = content.find("\n", q)
+    return content[start:end if end != -1 else len(content)].strip()
+
+# Acuses de recibo que el prompt de respuesta ya dicta literalmente cuando el
+# lead solo dio su nombre o apellido (ver extracted_name_instruction). Para
+# esos turnos el LLM no aporta nada: se arma el texto localmente.
+_ACK_TEMPLATES = {
+    "nombre": "Gracias, {nombre}. {pregunta}",
+    "apellido": "Va. {pregunta}",
+}
+# Preguntas siguientes que se pueden encadenar tal cual tras el acuse.
+_ACK_QUESTION_TYPES = frozenset(("apellido", "tipo_ayuda"))
+
+
 class IntelligentSlotFiller:
     """Sistema inteligente de slot-filling que detecta información ya proporcionada"""
     
     def __init__(self, azure_config: AzureOpenAIConfig):
-        self.llm = azure_config.create_extraction_llm()  # Usar LLM optimizado para extracción
-        self.parser = JsonOutputParser()
+        self.llm = azure_config.create_extraction_llm()  # Usar LLM optimizado para extracción (modo JSON)
     
     def _parse_json_robust(self, text: str) -> dict:
         """
-        Parsing robusto de JSON que maneja:
+        Parsing robusto de JSON. El LLM de extracción corre en modo JSON, así que
+        lo normal es que el primer intento (parseo directo) funcione; el resto
+        queda como red de seguridad y maneja:
         - JSON envuelto en bloques de código markdown (```json ... ```)
         - Texto extra antes/después del JSON
         - Respuestas con explicaciones antes del JSON
@@ -281,45 +605,36 @@ class IntelligentSlotFiller:
         if not text or not text.strip():
             return {}
         
-        original_text = text
         text = text.strip()
         
         # 1. Intentar parseo directo
         try:
-            result = json.loads(text)
+            result = json_utils.loads(text)
             if isinstance(result, dict):
                 return result
-        except json.JSONDecodeError:
+        except json_utils.JSONDecodeError:
             pass
         
         # 2. Intentar extraer JSON de bloques de código markdown
         code_block_match = re.search(r'```(?:json)?\s*\n?(\{[\s\S]*?\})\s*\n?```', text)
         if code_block_match:
             try:
-                result = json.loads(code_block_match.group(1))
+                result = json_utils.loads(code_block_match.group(1))
                 if isinstance(result, dict):
                     return result
-            except json.JSONDecodeError:
+            except json_utils.JSONDecodeError:
                 pass
         
         # 3. Intentar encontrar la primera aparición de un objeto JSON { ... }
         brace_match = re.search(r'(\{[\s\S]*\})', text)
         if brace_match:
             try:
-                result = json.loads(brace_match.group(1))
+                result = json_utils.loads(brace_match.group(1))
                 if isinstance(result, dict):
                     return result
-            except json.JSONDecodeError:
+            except json_utils.JSONDecodeError:
                 pass
         
-        # 4. Intentar con el parser de LangChain como último recurso
-        try:
-            result = self.parser.parse(original_text)
-            if isinstance(result, dict):
-                return result
-        except Exception:
-            pass
-        
         raise ValueError(f"No se pudo extraer JSON válido del texto: {text[:200]}")
         
     def detect_negative_response(self, message: str, last_bot_question: Optional[str] = None) -> Optional[Dict[str, str]]:
@@ -353,7 +668,7 @@ class IntelligentSlotFiller:
                     return parsed_result
                 else:
                     return None
-            except (ValueError, json.JSONDecodeError):
+            except (ValueError, json_utils.JSONDecodeError):
                 return None
                 
         except Exception as e:
@@ -366,19 +681,81 @@ class IntelligentSlotFiller:
         Detecta qué slots se pueden llenar y cuáles ya están completos
         Incluye el contexto de la última pregunta del bot para mejor interpretación
         """
+        extracted_data, _ = self.classify_and_extract(message, current_state, last_bot_question)
+        return extracted_data
+
+    def _deterministic_extraction(self, message: str, current_state: ConversationState, last_question_type: Optional[str]) -> Optional[Dict[str, Any]]:
+        """
+        Resuelve sin LLM las respuestas que no admiten interpretación:
+        - el mensaje es solo un correo (y aún no tenemos correo)
+        - el mensaje es solo un teléfono (y aún no tenemos teléfono)
+        - el mensaje es solo el número de una de las máquinas recomendadas
+          que el bot acaba de listar
+        - el mensaje es solo "uso propio"/"para venta" (o equivalente) cuando el
+          bot pidió los datos de la empresa y falta tipo_cliente
+        Retorna None si el mensaje necesita la extracción completa.
+        """
+        text = message.strip()
+
+        email_match = _EMAIL_ONLY_RE.match(text)
+        if email_match:
+            return {"correo": email_match.group(1)} if not current_state.get("correo") else None
+
+        if _PHONE_ONLY_RE.match(text) and len(re.sub(r"\D", "", text)) >= 7:
+            return {"telefono": text} if not current_state.get("telefono") else None
+
+        if last_question_type == "datos_empresa" and not current_state.get("tipo_cliente"):
+            tipo_cliente = _TIPO_CLIENTE_REPLIES.get(_normalize_text(text).rstrip(".!"))
+            if tipo_cliente:
+                return {"tipo_cliente": tipo_cliente}
+
+        if last_question_type in ("quiere_cotizacion", "seleccion_maquina") and text.isdigit():
+            recomendadas = current_state.get("maquinas_recomendadas") or []
+            position = int(text)
+            if 1 <= position <= len(recomendadas):
+                return {"maquina_seleccionada": recomendadas[position - 1], "quiere_cotizacion": True}
+
+        return None
+
+    def classify_and_extract(self, message: str, current_state: ConversationState, last_bot_question: Optional[str] = None, last_question_type: Optional[str] = None) -> Tuple[Dict[str, Any], bool]:
+        """
+        Igual que extract_all_information, pero además regresa si el mensaje es una
+        pregunta sobre inventario.
+
+        La clasificación viaja en la misma llamada de extracción (llave
+        `es_pregunta_inventario` del JSON) para no pagar una segunda ida y vuelta
+        al LLM por mensaje. La llave se saca del resultado antes de regresarlo
+        porque no es un campo del lead.
+        Retorna (datos_extraídos, es_pregunta_inventario).
+        """
+        # Respuestas triviales (un correo, un teléfono, "2" para elegir máquina):
+        # no hace falta ninguna llamada al LLM.
+        deterministic_data = self._deterministic_extraction(message, current_state, last_question_type)
+        if deterministic_data is not None:
+            logging.info(f"Extracción determinista. Mensaje: '{message[:50]}' → Datos: {deterministic_data}")
+            return deterministic_data, False
+
+        cache_key = _extraction_cache_key(message, current_state, last_bot_question, last_question_type)
+        cached = _EXTRACTION_CACHE.get(cache_key) if cache_key else None
+        if cached is not None:
+            extracted_data, is_inventory_question = copy.deepcopy(cached)
+            logging.info(f"Extracción desde caché. Mensaje: '{message[:50]}' → Datos: {extracted_data}")
+            self._apply_implicit_selection(extracted_data, current_state)
+            return extracted_data, is_inventory_question
+
+        is_inventory_question = False
         
-        # PRIMERO: Detectar si es una respuesta negativa o de incertidumbre
-        negative_response = self.detect_negative_response(message, last_bot_question)
+        # PRIMERO: Detectar si es una respuesta negativa o de incertidumbre.
+        # No depende de la extracción general, así que se lanza en otro hilo y
+        # corre al mismo tiempo que ella en lugar de sumar su ida y vuelta al LLM.
+        # En una conversación ya completada no hay pregunta pendiente a la que
+        # el lead pueda decir "no sé": la llamada se omite. La extracción general
+        # sí corre, porque un nuevo requerimiento de maquinaria reinicia el flujo.
+        negative_future = None
+        if not current_state.get("completed"):
+            negative_future = _LLM_EXECUTOR.submit(self.detect_negative_response, message, last_bot_question)
         
         extracted_data = {}
-
-        if negative_response:
-            # Si es una respuesta negativa, guardar el campo y valor
-            field_name = negative_response.get("field")
-            response_type = negative_response.get("response_type")
-            
-            if field_name and response_type:
-                extracted_data[field_name] = response_type
         
         # SEGUNDO: Extraer el resto de la información usando el prompt general
         # Crear prompt que considere el estado actual y la última pregunta del bot
@@ -387,7 +764,7 @@ class IntelligentSlotFiller:
         try:
             # Nombres de tipos de maquinaria
             # OBTENER DINÁMICAMENTE LOS NOMBRES DESDE LA CONFIGURACIÓN (Strings)
-            maquinaria_names = " ".join([f"\"{m.type_id}\"" for m in machinery_config_service.get_all_types()])
+            maquinaria_names = machinery_config_service.get_type_ids_str()
 
             # Obtener campos disponibles desde el FIELDS_CONFIG_PRIORITY
             fields_available = self._get_fields_available_str()
@@ -428,37 +805,65 @@ class IntelligentSlotFiller:
             
             # Parsear la respuesta JSON con método robusto
             raw_content = response.content
+            parsed_ok = True
             try:
                 general_extraction = self._parse_json_robust(raw_content)
             except ValueError as parse_err:
                 logging.error(f"Error parseando JSON de extracción. Respuesta del LLM: '{raw_content[:300]}'. Error: {parse_err}")
                 general_extraction = {}
+                parsed_ok = False
             
             # Fusionar resultados (la extracción general tiene prioridad si encuentra algo más específico,
             # pero mantenemos la respuesta negativa si no hay conflicto o si es complementaria)
+            self._add_negative_response(extracted_data, negative_future and negative_future.result())
             if isinstance(general_extraction, dict):
+                is_inventory_question = general_extraction.pop(INVENTORY_FLAG_KEY, False) in (True, "true")
                 extracted_data.update(general_extraction)
             
-            logging.info(f"Extracción completada. Mensaje: '{message[:50]}' → Datos: {json.dumps(extracted_data, ensure_ascii=False, default=str)}")
-            
-            # Lógica determinista de selección implícita
-            quiere_cot_new = extracted_data.get("quiere_cotizacion")
-            quiere_cot_curr = current_state.get("quiere_cotizacion")
-            is_quoting = quiere_cot_new is True or quiere_cot_curr is True
-            
-            if is_quoting and not extracted_data.get("maquina_seleccionada") and not current_state.get("maquina_seleccionada"):
-                recomendadas = current_state.get("maquinas_recomendadas", [])
-                if isinstance(recomendadas, list) and len(recomendadas) == 1:
-                    extracted_data["maquina_seleccionada"] = recomendadas[0]
-                    logging.info(f"Seleccionada automáticamente la única opción recomendada: {recomendadas[0]}")
+            logging.info(f"Extracción completada. Mensaje: '{message[:50]}' → Datos: {json_utils.dumps(extracted_data, default=str)}")
+
+            # Se cachea antes de la selección implícita, que depende del
+            # estado completo y se vuelve a aplicar en cada acierto.
+            if cache_key and parsed_ok and not _echoes_state(extracted_data, current_state):
+                _EXTRACTION_CACHE.set(cache_key, copy.deepcopy((extracted_data, is_inventory_question)))
+
+            self._apply_implicit_selection(extracted_data, current_state)
             
-            return extracted_data
+            return extracted_data, is_inventory_question
             
         except Exception as e:
             logging.error(f"Error extrayendo información: {e}")
             import traceback
             logging.error(f"Traceback: {traceback.format_exc()}")
-            return extracted_data
+            # detect_negative_response maneja sus propios errores: su resultado
+            # sigue siendo válido aunque la extracción general haya fallado.
+            self._add_negative_response(extracted_data, negative_future and negative_future.result())
+            return extracted_data, is_inventory_question
+
+    @staticmethod
+    def _apply_implicit_selection(extracted_data: Dict[str, Any], current_state: ConversationState) -> None:
+        """Lógica determinista de selección implícita: si el lead quiere cotizar
+        y solo se le recomendó una máquina, esa es la seleccionada."""
+        quiere_cot_new = extracted_data.get("quiere_cotizacion")
+        quiere_cot_curr = current_state.get("quiere_cotizacion")
+        is_quoting = quiere_cot_new is True or quiere_cot_curr is True
+
+        if is_quoting and not extracted_data.get("maquina_seleccionada") and not current_state.get("maquina_seleccionada"):
+            recomendadas = current_state.get("maquinas_recomendadas", [])
+            if isinstance(recomendadas, list) and len(recomendadas) == 1:
+                extracted_data["maquina_seleccionada"] = recomendadas[0]
+                logging.info(f"Seleccionada automáticamente la única opción recomendada: {recomendadas[0]}")
+
+    @staticmethod
+    def _add_negative_response(extracted_data: Dict[str, Any], negative_response: Optional[Dict[str, str]]) -> None:
+        """Si hubo respuesta negativa, guarda el campo con su valor ("No tiene"/"No especificado")."""
+        if not negative_response:
+            return
+        field_name = negative_response.get("field")
+        response_type = negative_response.get("response_type")
+        
+        if field_name and response_type:
+            extracted_data[field_name] = response_type
     
     def get_next_question(self, current_state: ConversationState) -> Optional[str]:
         """
@@ -470,29 +875,17 @@ class IntelligentSlotFiller:
             # Verificar si tenemos el nombre
             nombre = current_state.get("nombre")
             if not nombre:
-                return {
-                    "question": FIELDS_CONFIG_PRIORITY["nombre"]["question"],
-                    "reason": FIELDS_CONFIG_PRIORITY["nombre"]["reason"],
-                    "question_type": "nombre"
-                }
+                return _FIXED_QUESTIONS["nombre"]
             
             # Verificar si tenemos el apellido (o si el nombre ya incluye apellido)
             apellido = current_state.get("apellido")
             if not apellido and len(nombre.split()) < 2:
-                return {
-                    "question": FIELDS_CONFIG_PRIORITY["apellido"]["question"],
-                    "reason": FIELDS_CONFIG_PRIORITY["apellido"]["reason"],
-                    "question_type": "apellido"
-                }
+                return _FIXED_QUESTIONS["apellido"]
 
             # 2. TIPO DE AYUDA
             tipo_ayuda = current_state.get("tipo_ayuda")
             if not tipo_ayuda:
-                return {
-                    "question": FIELDS_CONFIG_PRIORITY["tipo_ayuda"]["question"],
-                    "reason": FIELDS_CONFIG_PRIORITY["tipo_ayuda"]["reason"],
-                    "question_type": "tipo_ayuda"
-                }
+                return _FIXED_QUESTIONS["tipo_ayuda"]
             
             # Si el tipo de ayuda es "otro", terminamos el flujo de preguntas
             if tipo_ayuda == "otro":
@@ -501,11 +894,7 @@ class IntelligentSlotFiller:
             # 3. TIPO DE MAQUINARIA (Solo si tipo_ayuda es "maquinaria")
             tipo_maquinaria = current_state.get("tipo_maquinaria")
             if not tipo_maquinaria:
-                return {
-                    "question": FIELDS_CONFIG_PRIORITY["tipo_maquinaria"]["question"],
-                    "reason": FIELDS_CONFIG_PRIORITY["tipo_maquinaria"]["reason"],
-                    "question_type": "tipo_maquinaria"
-                }
+                return _FIXED_QUESTIONS["tipo_maquinaria"]
 
             # 4. DETALLES DE MAQUINARIA
             # Verificar si faltan detalles específicos
@@ -524,11 +913,7 @@ class IntelligentSlotFiller:
                 # Si no hemos recomendado máquinas aún, forzamos este paso para que se active la búsqueda de inventario.
                 quiere_cotizacion = current_state.get("quiere_cotizacion")
                 if not current_state.get("maquinas_recomendadas"):
-                    return {
-                        "question": FIELDS_CONFIG_PRIORITY["quiere_cotizacion"]["question"],
-                        "reason": FIELDS_CONFIG_PRIORITY["quiere_cotizacion"]["reason"],
-                        "question_type": "quiere_cotizacion"
-                    }
+                    return _FIXED_QUESTIONS["quiere_cotizacion"]
             
             # Si ya se recomendaron máquinas y el usuario no quiere cotización, terminamos
             quiere_cotizacion = current_state.get("quiere_cotizacion")
@@ -568,11 +953,7 @@ class IntelligentSlotFiller:
 
     def _get_fields_available_str(self) -> str:
         """Obtiene los campos disponibles como una lista de strings con su descripción"""
-        fields_available = [field for field in FIELDS_CONFIG_PRIORITY.keys()]
-        fields_available_str = ""
-        for field in fields_available:
-            fields_available_str += f"- {field}: " + FIELDS_CONFIG_PRIORITY[field]['description'] + "\n"
-        return fields_available_str
+        return _FIELDS_AVAILABLE_STR
     
     def _get_contextual_required_fields(self, current_state: ConversationState) -> list:
         """
@@ -614,14 +995,7 @@ class IntelligentSlotFiller:
             return False
         
         detalles = current_state.get("detalles_maquinaria", {})
-        required_fields = self._get_contextual_required_fields(current_state)
-        
-        return all(
-            field in detalles and 
-            detalles[field] is not None and 
-            detalles[field] != ""
-            for field in required_fields
-        )
+        return _details_filled(detalles, self._get_contextual_required_fields(current_state))
     
     def _get_maquinaria_detail_question_with_reason(self, current_state: ConversationState) -> Optional[dict]:
         """Obtiene la siguiente pregunta específica sobre detalles de maquinaria de manera conversacional con el motivo"""
@@ -656,69 +1030,43 @@ class IntelligentSlotFiller:
     
     def is_conversation_complete(self, current_state: ConversationState) -> bool:
         """Verifica si la conversación está completa (todos los slots llenos)"""
+        get = current_state.get
 
         # Verificar si el nombre tiene al menos dos palabras (nombre + apellido)
-        nombre = current_state.get("nombre", "")
+        nombre = get("nombre")
         if not nombre or len(nombre.split()) < 2:
             return False
 
         # Verificar tipo_ayuda
-        tipo_ayuda = current_state.get("tipo_ayuda")
+        tipo_ayuda = get("tipo_ayuda")
         if not tipo_ayuda:
             return False
         
         # Si tipo_ayuda es "otro", solo se requiere nombre y apellido
         if tipo_ayuda == "otro":
-            # Solo verificar nombre y apellido
-            nombre = current_state.get("nombre", "")
-            if not nombre or len(nombre.split()) < 2:
-                return False
-            
             return True
         
-        # Si tipo_ayuda es "maquinaria", verificar también tipo_maquinaria y detalles_maquinaria
-        # Obtener campos obligatorios desde el FIELDS_CONFIG_PRIORITY
-        required_fields = [field for field in FIELDS_CONFIG_PRIORITY.keys() if FIELDS_CONFIG_PRIORITY[field]["required"]]
-        
-        # Verificar campos básicos
-        for field in required_fields:
-            value = current_state.get(field)
-            if not value or value == "":
-                return False
-        
-        # Verificar tipo_maquinaria
-        tipo_maquinaria = current_state.get("tipo_maquinaria")
-        if not tipo_maquinaria:
-            return False
-        
-        # Verificar detalles de maquinaria
-        detalles = current_state.get("detalles_maquinaria", {})
-        
-        if not detalles:
+        # Si tipo_ayuda es "maquinaria", verificar también los campos obligatorios
+        # de FIELDS_CONFIG_PRIORITY, tipo_maquinaria y detalles_maquinaria
+        if not all(get(field) for field in _REQUIRED_TOP_FIELDS) or not get("tipo_maquinaria"):
             return False
         
         # Usar la configuración centralizada para obtener campos obligatorios (con contexto)
-        required_fields = self._get_contextual_required_fields(current_state)
-        
-        if not all(
-            field in detalles and 
-            detalles[field] is not None and 
-            detalles[field] != ""
-            for field in required_fields
-        ):
+        detalles = get("detalles_maquinaria")
+        if not detalles or not _details_filled(detalles, self._get_contextual_required_fields(current_state)):
             return False
 
         # Verificar si quiere cotización
-        quiere_cot = current_state.get("quiere_cotizacion")
+        quiere_cot = get("quiere_cotizacion")
         if quiere_cot is None:
             return False
             
         if quiere_cot is True:
             # Reutilizamos get_pending_empresa_fields para validar
-            if len(get_pending_empresa_fields(current_state)) > 0:
+            if get_pending_empresa_fields(current_state):
                 return False
             # Para cotización (excepto compresor estacionario), se requiere máquina seleccionada
-            if not _is_compresor_estacionario(current_state) and not current_state.get("maquina_seleccionada"):
+            if not _is_compresor_estacionario(current_state) and not get("maquina_seleccionada"):
                 return False
 
         return True
@@ -731,7 +1079,7 @@ class IntelligentResponseGenerator:
     """Genera respuestas inteligentes basadas en el contexto y la información extraída"""
     
     def __init__(self, azure_config: AzureOpenAIConfig, cosmos_client=None, db_name=None):
-        self.llm = azure_config.create_conversational_llm()  # Usar LLM optimizado para conversación
+        self.llm = azure_config.create_light_llm()  # Confirmar + siguiente pregunta: basta el deployment ligero
         self.inventory_service = InventoryService(cosmos_client, db_name)
     
     def generate_response(self, 
@@ -781,7 +1129,7 @@ class IntelligentResponseGenerator:
                         safe_info[key] = '[INFORMACIÓN PRIVADA]'
                     else:
                         safe_info[key] = value
-                extracted_info_str = json.dumps(safe_info, ensure_ascii=False, indent=2)
+                extracted_info_str = json_utils.dumps(safe_info, indent=True)
 
                 if extracted_info.get("nombre"):
                     nombre = extracted_info.get("nombre")
@@ -800,7 +1148,7 @@ class IntelligentResponseGenerator:
             # Lista autorizada de tipos de maquinaria (nombres amigables). Fuente de
             # verdad única; se inyecta SIEMPRE en el prompt para que el bot nunca
             # invente tipos que no existen en el inventario.
-            tipos_maquinaria_validos = ", ".join(machinery_config_service.get_type_display_list())
+            tipos_maquinaria_validos = machinery_config_service.get_type_display_list_str()
 
             # Marcas que pidió el lead, contrastadas contra el inventario. Es la
             # ÚNICA fuente con la que el bot puede afirmar o negar una marca; sin
@@ -815,6 +1163,14 @@ class IntelligentResponseGenerator:
                 and not current_state.get("cobertura_aclarada")
             )
 
+            if not (is_initial_conversation or is_inventory_question or brand_evaluations
+                    or coverage_pendiente or machine_reference):
+                template_response = self._try_template_response(
+                    message, extracted_info, next_question, question_type
+                )
+                if template_response:
+                    return template_response
+
             if is_inventory_question:
                 inventory_instruction = (
                     "El mensaje del usuario incluye una pregunta sobre inventario. "
@@ -1013,7 +1369,15 @@ class IntelligentResponseGenerator:
                 # hay que volver a aclararlas en los turnos siguientes.
                 current_state["marcas_aclaradas"] = True
 
-            current_state_str = get_current_state_str(current_state)
+            # Los detalles de la máquina solo le sirven al LLM cuando el turno
+            # trata de ella, cuando ya se cierra la conversación o cuando el
+            # usuario pregunta algo que podría referirse a su requerimiento.
+            summarize_detalles = not (
+                question_type in _MACHINERY_QUESTION_TYPES
+                or question_type == "conversation_complete"
+                or "?" in message or "¿" in message
+            )
+            current_state_str = get_current_state_str(current_state, summarize_detalles=summarize_detalles)
             formatedPrompt = prompt.format_prompt(
                 user_message=message,
                 current_state_str=current_state_str,
@@ -1032,7 +1396,7 @@ class IntelligentResponseGenerator:
                 tipos_maquinaria_validos=tipos_maquinaria_validos
             )
 
-            debug_print(f"DEBUG: Prompt conversacional: {formatedPrompt}")
+            debug_print("DEBUG: Prompt conversacional: %s", formatedPrompt)
             
             response = self.llm.invoke(formatedPrompt)
             
@@ -1055,7 +1419,32 @@ class IntelligentResponseGenerator:
                 return next_question
             else:
                 return "En un momento le responderemos."
-    
+
+    @staticmethod
+    def _try_template_response(
+        message: str,
+        extracted_info: Dict[str, Any],
+        next_question: Optional[str],
+        question_type: Optional[str],
+    ) -> Optional[str]:
+        """
+        Respuesta sin LLM para el acuse de nombre/apellido seguido de la
+        siguiente pregunta fija. Devuelve None si el turno necesita al LLM: el
+        usuario preguntó algo, dio más información o la siguiente pregunta no
+        es de texto fijo.
+        """
+        if not next_question or question_type not in _ACK_QUESTION_TYPES:
+            return None
+        if "?" in message or "¿" in message:
+            return None
+        if not extracted_info or not set(extracted_info) <= _ACK_TEMPLATES.keys():
+            return None
+
+        slot = "nombre" if extracted_info.get("nombre") else "apellido"
+        if not extracted_info.get(slot):
+            return None
+        return _ACK_TEMPLATES[slot].format(nombre=extracted_info.get("nombre", ""), pregunta=next_question)
+
     def _pending_brand_evaluations(self, current_state: ConversationState) -> List[BrandAvailability]:
         """
         Marcas pedidas por el lead que el bot todavía NO le ha aclarado,
@@ -1238,6 +1627,25 @@ Procederé a generar su cotización."""
 # RESPONDEDOR DE INVENTARIO
 # ============================================================================
 
+# Frases que por sí solas ya hacen del mensaje una pregunta de inventario
+# (disponibilidad, tipos/modelos, precios, entregas). Se compara contra el
+# texto normalizado, así que van en minúsculas y sin acentos.
+_INVENTORY_QUESTION_RE = re.compile(
+    r"\b(?:"
+    r"tienen|tendran|manejan|venden|rentan|cuentan con|disponibles?|disponibilidad|inventario|catalogo|stock"
+    r"|cuanto (?:cuesta|cuestan|sale|salen|vale|valen)|precios?"
+    r"|que (?:tipos?|modelos?|maquinas?|maquinaria|equipos?)"
+    r"|(?:donde|en que \w+) (?:entregan|envian)|pueden cotizar"
+    r")\b"
+)
+
+# Clasificaciones del LLM para preguntas ambiguas, por mensaje normalizado. La
+# respuesta solo depende del texto, así que las preguntas frecuentes se repiten
+# entre leads. Vive en memoria del worker (el disco de Functions es efímero y
+# compartido entre instancias solo en algunos planes).
+_INVENTORY_CLASSIFICATION_CACHE = BoundedCache(maxsize=2048, ttl=7 * 24 * 3600)
+
+
 class InventoryResponder:
     """Responde preguntas sobre el inventario de maquinaria"""
     
@@ -1246,7 +1654,26 @@ class InventoryResponder:
         self.inventory = get_inventory() # TODO: Mover esto también a DB si es necesario, por ahora usa el fake
 
     def is_inventory_question(self, message: str) -> bool:
-        """Determina si el mensaje del usuario es una pregunta sobre el inventario"""
+        """
+        Determina si el mensaje del usuario es una pregunta sobre el inventario.
+
+        Los casos claros se resuelven localmente: una frase de inventario
+        ("¿tienen...?", "¿cuánto cuesta...?") es pregunta de inventario, y un
+        mensaje sin signo de interrogación es una respuesta o un dato del lead.
+        Solo las preguntas ambiguas llegan al LLM.
+        """
+        normalized = _normalize_text(message)
+        if _INVENTORY_QUESTION_RE.search(normalized):
+            debug_print(f"DEBUG: ¿Es pregunta sobre inventario? '{message}' → true (regex)")
+            return True
+        if "?" not in message and "¿" not in message:
+            return False
+
+        cached = _INVENTORY_CLASSIFICATION_CACHE.get(normalized)
+        if cached is not None:
+            debug_print(f"DEBUG: ¿Es pregunta sobre inventario? '{message}' → {cached} (caché)")
+            return cached
+
         try:
             prompt = INVENTORY_DETECTION_PROMPT
             
@@ -1257,8 +1684,10 @@ class InventoryResponder:
             result = response.content.strip().lower()
             
             debug_print(f"DEBUG: ¿Es pregunta sobre inventario? '{message}' → {result}")
-            
-            return result == "true"
+
+            is_inventory = result == "true"
+            _INVENTORY_CLASSIFICATION_CACHE.set(normalized, is_inventory)
+            return is_inventory
             
         except Exception as e:
             logging.error(f"Error detectando pregunta de inventario: {e}")
@@ -1297,37 +1726,33 @@ class IntelligentLeadQualificationChatbot:
         self._machine_ref: Optional[MachineReference] = None
         self._coverage: Optional[CoverageStatus] = None
 
+        # Usuario cuyo estado ya se cargó de state_store (ver load_conversation)
+        self._loaded_user_id: Optional[str] = None
+
     def _create_empty_state(self) -> ConversationState:
         """Crea un estado vacío"""
-        state = {
-            # Campos que no se preguntan al usuario
-            "completed": False,
-            "cotizacion_enviada": False,  # True cuando ya se envió la respuesta final (evita ciclo)
-            "messages": [],
-            "conversation_mode": "bot", # agente o bot
-            "asignado_asesor": None,
-            "hubspot_contact_id": None,
-            "quiere_cotizacion": None,
-            "maquinas_recomendadas": [],  # Lista de máquinas recomendadas para mapear posición a modelo
-            "maquina_mencionada": None,  # Código/modelo que el lead mencionó por su cuenta
-            "marcas_solicitadas": [],  # Marcas que pidió el lead (ej. ["DeWalt", "Makita"])
-            "marcas_aclaradas": False,  # True cuando el bot ya le respondió sobre esas marcas
-            "cobertura_aclarada": False  # True cuando ya se le dijo que solo operamos en México
-        }
-        
-        # Agregamos los campos que se preguntan al usuario desde el FIELDS_CONFIG_PRIORITY
-        fields_to_ask = [field for field in FIELDS_CONFIG_PRIORITY.keys()]
-        for field in fields_to_ask:
-            if field == "detalles_maquinaria":
-                state[field] = {}
-            else:
-                state[field] = None
-
-
+        state = dict(_EMPTY_STATE_TEMPLATE)
+        # Los contenedores se crean en cada llamada: compartirlos entre
+        # conversaciones mezclaría sus datos.
+        state["messages"] = []
+        state["maquinas_recomendadas"] = []
+        state["marcas_solicitadas"] = []
+        state["detalles_maquinaria"] = {}
         return state
     
-    def load_conversation(self, user_id: str):
-        """Carga la conversación de un usuario específico"""
+    def load_conversation(self, user_id: str, force: bool = False):
+        """
+        Carga la conversación de un usuario específico.
+
+        Si el estado de ese usuario ya se cargó en este request, no se vuelve a
+        leer de Cosmos: el estado en memoria es el más reciente. send_message y
+        process_last_lead_message olvidan la carga al terminar, porque entre
+        requests la web escribe en Cosmos directamente (mensajes del agente).
+        `force=True` lo relee de todos modos.
+        """
+        if not force and user_id == self._loaded_user_id:
+            debug_print(f"DEBUG: Estado de {user_id} ya cargado, se reutiliza")
+            return
         logging.info(f"Cargando conversación para usuario {user_id}")
         self.current_user_id = user_id
         stored_state = self.state_store.get_conversation_state(user_id)
@@ -1349,6 +1774,7 @@ class IntelligentLeadQualificationChatbot:
             logging.info(f"No hay estado existente para usuario {user_id}, creando nuevo estado")
             self.state = self._create_empty_state()
             debug_print(f"DEBUG: Nuevo estado creado para usuario {user_id}")
+        self._loaded_user_id = user_id
 
     def save_conversation(self):
         """Guarda el estado actual de la conversación"""
@@ -1379,6 +1805,7 @@ class IntelligentLeadQualificationChatbot:
         Si hubspot_manager es None, no se actualiza el contacto en HubSpot (para poder usar test_chatbot.py)
         """
         
+        hubspot_future = None
         try:
             debug_print(f"DEBUG: send_message llamado con mensaje: '{user_message}'")
             
@@ -1390,20 +1817,25 @@ class IntelligentLeadQualificationChatbot:
             contextual_response = ""
             
             # Agregar mensaje del usuario
-            self.state["messages"].append({
-                "role": "user", 
-                "whatsapp_message_id": whatsapp_message_id,
-                "content": user_message,
-                "question_type": "",
-                "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
-                "sender": "lead"
-            })
+            self.state["messages"].append(build_message(
+                "user", "lead", user_message, whatsapp_message_id=whatsapp_message_id
+            ))
+
+            # En modo agente el bot no responde; la extracción solo sirve para
+            # llevar los datos a HubSpot. Sin hubspot_manager (multimedia,
+            # pruebas) no hay a dónde llevarlos: se ahorra la llamada al LLM.
+            if self.state.get("conversation_mode", "bot") == "agente" and hubspot_manager is None:
+                debug_print("DEBUG: Modo agente sin HubSpot, se omite la extracción")
+                self.save_conversation()
+                return None
 
             # Extraer TODA la información disponible del mensaje (SIEMPRE)
             # Obtener la última pregunta del bot para contexto
-            last_bot_question, _ = self._get_last_bot_question()
-            extracted_info = self.slot_filler.extract_all_information(user_message, self.state, last_bot_question)
-            debug_print(f"DEBUG: Información extraída: {extracted_info}")
+            last_bot_question, last_question_type = self._get_last_bot_question()
+            extracted_info, is_inventory_question = self.slot_filler.classify_and_extract(
+                user_message, self.state, last_bot_question, last_question_type
+            )
+            debug_print("DEBUG: Información extraída: %s", extracted_info)
 
             # Detectar si el lead mencionó el código/modelo de una máquina. Se hace
             # ANTES de actualizar HubSpot y el estado para que el tipo de maquinaria
@@ -1414,9 +1846,14 @@ class IntelligentLeadQualificationChatbot:
             # negarlas contra el inventario al generar la respuesta.
             self._detect_and_store_brands(user_message)
 
-            # Actualizar el contacto en HubSpot
+            # Actualizar el contacto en HubSpot. No depende de la respuesta ni
+            # la respuesta de él, así que corre en otro hilo mientras se genera.
+            # Trabaja sobre copias: el estado se sigue modificando en este hilo.
             if hubspot_manager:
-                hubspot_manager.update_contact(self.state, extracted_info)
+                state_snapshot = copy.deepcopy({k: v for k, v in self.state.items() if k != "messages"})
+                hubspot_future = _HUBSPOT_EXECUTOR.submit(
+                    hubspot_manager.update_contact, state_snapshot, copy.deepcopy(extracted_info)
+                )
 
             # Actualizar el estado con la información extraída
             self._update_state_with_extracted_info(extracted_info)
@@ -1434,21 +1871,25 @@ class IntelligentLeadQualificationChatbot:
                 self.save_conversation()
                 return None  # No response en modo agente
             
-            return self._process_and_respond(user_message, extracted_info)
+            return self._process_and_respond(user_message, extracted_info, is_inventory_question)
         
         except Exception as e:
             logging.error(f"Error procesando mensaje: {e}")
             return "Disculpe, hubo un error técnico. ¿Podría intentar de nuevo?"
 
+        finally:
+            # Azure Functions puede congelar el worker en cuanto la invocación
+            # termina: la actualización de HubSpot debe acabar antes de salir.
+            if hubspot_future is not None:
+                hubspot_future.result()
+            self._loaded_user_id = None
+
     def _wants_pdf_resend(self, message: str) -> bool:
         """Detecta si el usuario pide explícitamente re-enviar la cotización PDF."""
         if self.state.get("tipo_cliente") == "distribuidor":
             return False  # Distribuidores no reciben PDF, se les asigna asesor
-        keywords = ["cotización", "cotizacion", "pdf", "mándame", "mandame",
-                    "envíame", "enviame", "reenvía", "reenvia", "otra vez",
-                    "de nuevo", "vuelve a enviar", "manda otra"]
         msg_lower = message.lower()
-        return any(kw in msg_lower for kw in keywords)
+        return any(kw in msg_lower for kw in _PDF_RESEND_KEYWORDS)
 
     def _detect_and_merge_machine_reference(
         self, user_message: str, extracted_info: Dict[str, Any]
@@ -1531,11 +1972,15 @@ class IntelligentLeadQualificationChatbot:
         self.state["marcas_aclaradas"] = False
         debug_print(f"DEBUG: Marcas solicitadas por el lead: {marcas}")
 
-    def _process_and_respond(self, user_message: str, extracted_info: Dict[str, Any]) -> str:
+    def _process_and_respond(self, user_message: str, extracted_info: Dict[str, Any], is_inventory_question: Optional[bool] = None) -> str:
         """
         Lógica común para procesar un mensaje y generar una respuesta.
         Detecta preguntas de inventario, verifica si la conversación está completa,
         obtiene la siguiente pregunta y genera la respuesta con LLM.
+
+        `is_inventory_question` llega ya resuelto cuando el mensaje pasó por
+        classify_and_extract. Si es None (p. ej. process_last_lead_message, que no
+        extrae), se clasifica aquí con el InventoryResponder.
         """
 
         # ── Manejo de mensajes de seguimiento en conversaciones ya completadas ──
@@ -1543,7 +1988,7 @@ class IntelligentLeadQualificationChatbot:
         # En su lugar, responder de forma natural con el LLM.
         if self.state.get("cotizacion_enviada"):
             debug_print("DEBUG: Conversación ya completada y cotización ya enviada. Respondiendo naturalmente.")
-            history_messages = [{"role": msg["role"], "content": msg["content"]} for msg in self.state["messages"]]
+            history_messages = _history_for_prompt(self.state["messages"])
 
             # Permitir re-envío de PDF si el cliente_final lo pide explícitamente
             if self._wants_pdf_resend(user_message):
@@ -1570,21 +2015,17 @@ class IntelligentLeadQualificationChatbot:
             return self._add_message_and_return_response(generated_response, "")
 
         # ── Flujo normal ──
-        is_inventory_question = False
-
         # Verificar si es una pregunta sobre inventario
-        if self.inventory_responder.is_inventory_question(user_message):
+        if is_inventory_question is None:
+            is_inventory_question = self.inventory_responder.is_inventory_question(user_message)
+        if is_inventory_question:
             debug_print(f"DEBUG: Pregunta sobre inventario detectada")
-            is_inventory_question = True
         
         # Si no es pregunta de inventario ni de requerimientos, continuar con el flujo normal
         debug_print(f"DEBUG: Flujo normal de calificación de leads...")
 
         # Preparar historial de mensajes para el LLM
-        history_messages = [{
-            "role": msg["role"],
-            "content": msg["content"]
-        } for msg in self.state["messages"]]
+        history_messages = _history_for_prompt(self.state["messages"])
 
         next_question_str = None
         next_question_type = "conversation_complete"
@@ -1602,7 +2043,7 @@ class IntelligentLeadQualificationChatbot:
             next_question_data = self.slot_filler.get_next_question(self.state)
 
             if next_question_data is None:
-                debug_print(f"DEBUG: Estado completo (sin siguiente pregunta): {self.state}")
+                debug_print("DEBUG: Estado completo (sin siguiente pregunta): %s", self.state)
                 
                 # Caso especial: Si el usuario dijo "no" a la cotización
                 quiere_cot = self.state.get("quiere_cotizacion")
@@ -1674,14 +2115,11 @@ class IntelligentLeadQualificationChatbot:
             # Continuar sin el ID si hay error
         
         # Crear el mensaje con el ID de WhatsApp       
-        self.state["messages"].append({
-            "role": "assistant", 
-            "whatsapp_message_id": whatsapp_message_id,
-            "question_type": question_type,
-            "content": response,
-            "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
-            "sender": "bot"
-        })
+        self.state["messages"].append(build_message(
+            "assistant", "bot", response,
+            whatsapp_message_id=whatsapp_message_id, question_type=question_type
+        ))
+        self._remember_last_bot_question(question_type)
         
         # Al final, guardar el estado
         self.save_conversation()
@@ -1815,14 +2253,10 @@ class IntelligentLeadQualificationChatbot:
             intro_message = "Te comparto la ficha técnica de la máquina que te interesó."
             try:
                 wa_msg_id = self.send_message_callback(self.current_user_id, intro_message)
-                self.state["messages"].append({
-                    "role": "assistant",
-                    "whatsapp_message_id": wa_msg_id or "",
-                    "question_type": "",
-                    "content": intro_message,
-                    "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
-                    "sender": "bot"
-                })
+                self.state["messages"].append(build_message(
+                    "assistant", "bot", intro_message, whatsapp_message_id=wa_msg_id or ""
+                ))
+                self._remember_last_bot_question("")
                 # Persistir el intro ANTES de mandar el PDF: el envío del documento
                 # registra su propio mensaje en Cosmos, y save_conversation solo
                 # persiste el último mensaje nuevo.
@@ -1872,9 +2306,8 @@ class IntelligentLeadQualificationChatbot:
                 del result[alias]
 
         # 2) Descartar llaves no canónicas (solo si conocemos la config del tipo).
-        config = machinery_config_service.get_config(tipo)
-        if config:
-            valid_fields = {f.name for f in config.fields}
+        valid_fields = machinery_config_service.get_field_names(tipo)
+        if valid_fields is not None:
             dropped = [k for k in list(result.keys()) if k not in valid_fields]
             for k in dropped:
                 del result[k]
@@ -1883,12 +2316,82 @@ class IntelligentLeadQualificationChatbot:
 
         return result
 
+    def _apply_field(self, key: str, value: Any, extracted_info: Dict[str, Any]) -> None:
+        """Actualización directa. Se confía en que el LLM ya formateó la respuesta según las reglas del prompt."""
+        self.state[key] = value
+        debug_print(f"DEBUG: Campo '{key}' actualizado con valor: '{value}'")
+
+    def _apply_detalles_maquinaria(self, key: str, value: Any, extracted_info: Dict[str, Any]) -> None:
+        if not isinstance(value, dict):
+            # detalles_maquinaria SIEMPRE es un dict. Cuando el lead dice "no
+            # tengo esa información" sobre un detalle de la máquina,
+            # detect_negative_response devuelve field="detalles_maquinaria" y
+            # value="No especificado" (un string). Escribirlo dejaba el estado
+            # corrupto y TODAS las llamadas posteriores a detalles.get()
+            # reventaban: la conversación quedaba muerta con "hubo un error
+            # técnico" en cada mensaje (visto en 5.json al replicarla).
+            debug_print(
+                f"DEBUG: Ignorando detalles_maquinaria no-dict ({value!r}); "
+                "el estado conserva los detalles ya extraídos."
+            )
+            return
+
+        # Normalizar a los campos canónicos del tipo actual: remapear alias
+        # conocidos (ej. altura_plataforma_m -> altura_trabajo_m) y descartar
+        # llaves que no estén en la config del tipo. Evita que una llave mal
+        # extraída bloquee el flujo (el campo requerido quedaría vacío y el
+        # bot re-preguntaría indefinidamente).
+        tipo_actual = extracted_info.get("tipo_maquinaria") or self.state.get("tipo_maquinaria")
+        value = self._normalize_detalles_maquinaria(value, tipo_actual)
+        current_detalles = self.state.get("detalles_maquinaria", {})
+        current_detalles.update(value)
+        self.state["detalles_maquinaria"] = current_detalles
+        debug_print("DEBUG: Detalles de maquinaria actualizados: %s", self.state["detalles_maquinaria"])
+
+    def _apply_tipo_maquinaria(self, key: str, value: Any, extracted_info: Dict[str, Any]) -> None:
+        # Validar dinámicamente si el tipo existe en la configuración
+        config = machinery_config_service.get_config(value)
+        if not config:
+            logging.error(f"ADVERTENCIA: Tipo de maquinaria inválido '{value}' extraído por el LLM.")
+            return
+
+        old_tipo = self.state.get("tipo_maquinaria")
+        self.state[key] = value
+        debug_print(f"DEBUG: Campo '{key}' actualizado a: {value}")
+
+        # Si el tipo de maquinaria CAMBIÓ, limpiar campos relacionados
+        if old_tipo and old_tipo != value:
+            debug_print(f"DEBUG: Tipo de maquinaria cambió de '{old_tipo}' a '{value}'. Limpiando detalles, recomendaciones y selección.")
+            self.state["detalles_maquinaria"] = {}
+            self.state["maquinas_recomendadas"] = []
+            self.state["maquina_seleccionada"] = None
+            self.state["quiere_cotizacion"] = None
+            self.state["completed"] = False
+
+    def _apply_apellido(self, key: str, value: Any, extracted_info: Dict[str, Any]) -> None:
+        # Combinar nombre y apellido en el campo nombre
+        nombre_actual = self.state.get("nombre", "")
+        if nombre_actual and value:
+            self.state["nombre"] = f"{nombre_actual} {value}".strip()
+            self.state["apellido"] = value
+            debug_print(f"DEBUG: Nombre y apellido combinados: '{self.state['nombre']}'")
+        else:
+            self.state[key] = value
+            debug_print(f"DEBUG: Campo '{key}' actualizado con valor: '{value}'")
+
+    # Campos con actualización especial en _update_state_with_extracted_info
+    _FIELD_HANDLERS = {
+        "detalles_maquinaria": _apply_detalles_maquinaria,
+        "tipo_maquinaria": _apply_tipo_maquinaria,
+        "apellido": _apply_apellido,
+    }
+
     def _update_state_with_extracted_info(self, extracted_info: Dict[str, Any]):
         """
         Actualiza el estado con la información extraída, confiando en el
         pre-procesamiento y formato realizado por el LLM.
         """
-        debug_print(f"DEBUG: Actualizando estado con información: {extracted_info}")
+        debug_print("DEBUG: Actualizando estado con información: %s", extracted_info)
 
         # Pre-check: si la conversación ya estaba completada y llega nueva info de maquinaria,
         # reiniciar el flujo de cotización (mantiene datos de empresa).
@@ -1960,11 +2463,14 @@ class IntelligentLeadQualificationChatbot:
                 del extracted_info["giro_empresa"]
                 debug_print(f"DEBUG: Eliminado giro_empresa='{giro_value}' de extracción simultánea con tipo_cliente='distribuidor'. El giro se preguntará por separado.")
 
-        for key, value in extracted_info.items():
-            # 1. Ignorar valores nulos o vacíos para no insertar datos inútiles.
-            if value is None or value == "":
-                continue
+        # 1. Ignorar valores nulos o vacíos y llaves desconocidas en una sola
+        # pasada: el JSON del LLM trae casi todos los campos en null.
+        updates = {
+            k: v for k, v in extracted_info.items()
+            if k in _TRACKED_KEYS and v is not None and v != ""
+        }
 
+        for key, value in updates.items():
             # 1.5 Guardia: el código de una máquina NUNCA es el nombre, apellido o
             # giro del lead. Cuando el lead responde con un código en lugar de
             # contestar (ej. "PDSG900VR" a "¿Con quién tengo el gusto?"), el LLM a
@@ -1976,83 +2482,18 @@ class IntelligentLeadQualificationChatbot:
                 )
                 continue
 
-            # 2. No sobrescribir campos que ya tienen un valor válido a excepción de:
-            # - detalles_maquinaria: se actualiza múltiples veces porque tiene varios subcampos.
-            # - quiere_cotizacion: puede cambiar si el usuario corrige su respuesta.
-            # - maquina_seleccionada: puede cambiar si el usuario elige otra máquina.
-            # - tipo_maquinaria: puede cambiar si el usuario cambia de opinión.
-            # - giro_empresa: el usuario puede corregirlo (ej: "en realidad nos dedicamos a la construcción").
-            # - tipo_cliente: puede cambiar por reclasificación (distribuidor → cliente_final).
-            # Esto es clave para evitar que una respuesta ambigua posterior
-            # borre un dato que ya se había confirmado.
+            # 2. No sobrescribir campos que ya tienen un valor válido, salvo los
+            # de _OVERWRITABLE_FIELDS. Esto es clave para evitar que una respuesta
+            # ambigua posterior borre un dato que ya se había confirmado.
             current_value = self.state.get(key)
-            if key not in ["detalles_maquinaria", "quiere_cotizacion", "maquina_seleccionada", "tipo_maquinaria", "giro_empresa", "tipo_cliente"] and current_value:
+            if key not in _OVERWRITABLE_FIELDS and current_value:
                 debug_print(f"DEBUG: Campo '{key}' ya tiene valor válido '{current_value}', no se sobrescribe.")
                 continue
 
-            # 3. Manejo de casos especiales
-            if key == "detalles_maquinaria" and not isinstance(value, dict):
-                # detalles_maquinaria SIEMPRE es un dict. Cuando el lead dice "no
-                # tengo esa información" sobre un detalle de la máquina,
-                # detect_negative_response devuelve field="detalles_maquinaria" y
-                # value="No especificado" (un string). Escribirlo dejaba el estado
-                # corrupto y TODAS las llamadas posteriores a detalles.get()
-                # reventaban: la conversación quedaba muerta con "hubo un error
-                # técnico" en cada mensaje (visto en 5.json al replicarla).
-                debug_print(
-                    f"DEBUG: Ignorando detalles_maquinaria no-dict ({value!r}); "
-                    "el estado conserva los detalles ya extraídos."
-                )
-                continue
-
-            if key == "detalles_maquinaria" and isinstance(value, dict):
-                # Normalizar a los campos canónicos del tipo actual: remapear alias
-                # conocidos (ej. altura_plataforma_m -> altura_trabajo_m) y descartar
-                # llaves que no estén en la config del tipo. Evita que una llave mal
-                # extraída bloquee el flujo (el campo requerido quedaría vacío y el
-                # bot re-preguntaría indefinidamente).
-                tipo_actual = extracted_info.get("tipo_maquinaria") or self.state.get("tipo_maquinaria")
-                value = self._normalize_detalles_maquinaria(value, tipo_actual)
-                current_detalles = self.state.get("detalles_maquinaria", {})
-                current_detalles.update(value)
-                self.state["detalles_maquinaria"] = current_detalles
-                debug_print(f"DEBUG: Detalles de maquinaria actualizados: {self.state['detalles_maquinaria']}")
-            
-            elif key == "tipo_maquinaria":
-                # Validar dinámicamente si el tipo existe en la configuración
-                config = machinery_config_service.get_config(value)
-                if config:
-                    old_tipo = self.state.get("tipo_maquinaria")
-                    self.state[key] = value
-                    debug_print(f"DEBUG: Campo '{key}' actualizado a: {value}")
-                    
-                    # Si el tipo de maquinaria CAMBIÓ, limpiar campos relacionados
-                    if old_tipo and old_tipo != value:
-                        debug_print(f"DEBUG: Tipo de maquinaria cambió de '{old_tipo}' a '{value}'. Limpiando detalles, recomendaciones y selección.")
-                        self.state["detalles_maquinaria"] = {}
-                        self.state["maquinas_recomendadas"] = []
-                        self.state["maquina_seleccionada"] = None
-                        self.state["quiere_cotizacion"] = None
-                        self.state["completed"] = False
-                else:
-                    logging.error(f"ADVERTENCIA: Tipo de maquinaria inválido '{value}' extraído por el LLM.")
-            
-            elif key == "apellido":
-                # Combinar nombre y apellido en el campo nombre
-                nombre_actual = self.state.get("nombre", "")
-                if nombre_actual and value:
-                    self.state["nombre"] = f"{nombre_actual} {value}".strip()
-                    self.state["apellido"] = value 
-                    debug_print(f"DEBUG: Nombre y apellido combinados: '{self.state['nombre']}'")
-                else:
-                    self.state[key] = value
-                    debug_print(f"DEBUG: Campo '{key}' actualizado con valor: '{value}'")
-            
-            # 4. Para todos los demás campos, la actualización es directa.
-            # Se confía en que el LLM ya formateó la respuesta según las reglas del prompt.
-            else:
-                self.state[key] = value
-                debug_print(f"DEBUG: Campo '{key}' actualizado con valor: '{value}'")
+            # 3. Manejo de casos especiales; 4. para todos los demás campos, la
+            # actualización es directa.
+            handler = self._FIELD_HANDLERS.get(key, IntelligentLeadQualificationChatbot._apply_field)
+            handler(self, key, value, extracted_info)
         
         # Lógica de inferencia post-extracción
         # Si tenemos tipo_maquinaria pero no tipo_ayuda, inferimos que es "maquinaria"
@@ -2073,29 +2514,16 @@ class IntelligentLeadQualificationChatbot:
             # Obtener el último mensaje del usuario para analizar
             user_messages = [m for m in self.state.get("messages", []) if m.get("role") == "user"]
             if user_messages:
-                last_user_msg = user_messages[-1].get("content", "").lower().strip()
-                
-                # Palabras clave para cliente_final
-                cliente_final_keywords = [
-                    "uso propio", "uso de la empresa", "uso interno", "para mi empresa",
-                    "para nuestra empresa", "para la empresa", "no me dedico",
-                    "no nos dedicamos", "no, es para", "cliente final", "cliente_final"
-                ]
-                # Palabras clave para distribuidor
-                distribuidor_keywords = [
-                    "sí me dedico", "si me dedico", "me dedico a la venta",
-                    "me dedico a la renta", "para venta", "para reventa",
-                    "para distribución", "para distribucion", "soy distribuidor"
-                ]
+                last_user_msg = _normalize_text(user_messages[-1].get("content", ""))
                 
-                for kw in cliente_final_keywords:
+                for kw in _CLIENTE_FINAL_KEYWORDS:
                     if kw in last_user_msg:
                         self.state["tipo_cliente"] = "cliente_final"
                         debug_print(f"DEBUG: Inferido tipo_cliente='cliente_final' por palabra clave '{kw}' en mensaje: '{last_user_msg}'")
                         break
                 
                 if not self.state.get("tipo_cliente"):
-                    for kw in distribuidor_keywords:
+                    for kw in _DISTRIBUIDOR_KEYWORDS:
                         if kw in last_user_msg:
                             self.state["tipo_cliente"] = "distribuidor"
                             debug_print(f"DEBUG: Inferido tipo_cliente='distribuidor' por palabra clave '{kw}' en mensaje: '{last_user_msg}'")
@@ -2162,24 +2590,41 @@ class IntelligentLeadQualificationChatbot:
                             self.state["maquina_seleccionada"] = full_model
                             break
         
+    def _remember_last_bot_question(self, question_type: str) -> None:
+        """
+        Guarda en el estado la pregunta del último mensaje del bot (el que se
+        acaba de agregar), junto con su posición en el historial, para que
+        _get_last_bot_question no tenga que recorrer los mensajes.
+        """
+        messages = self.state["messages"]
+        self.state[LAST_BOT_QUESTION_KEY] = {
+            "index": len(messages) - 1,
+            "question": _bot_question_from_content(messages[-1]["content"]),
+            "question_type": question_type,
+        }
+
     def _get_last_bot_question(self) -> Tuple[Optional[str], Optional[str]]:
         """Obtiene la última pregunta que hizo el bot para proporcionar contexto"""
         try:
-            # Buscar el último mensaje del bot en el historial
-            for msg in reversed(self.state["messages"]):
+            messages = self.state["messages"]
+
+            # El apuntador solo es válido si después de ese mensaje únicamente
+            # hay mensajes del lead. Si el agente escribió desde la web o el bot
+            # mandó un multimedia, hay un mensaje del bot más reciente.
+            pointer = self.state.get(LAST_BOT_QUESTION_KEY)
+            if isinstance(pointer, dict):
+                index = pointer.get("index", -1)
+                if (
+                    0 <= index < len(messages)
+                    and messages[index]["role"] == "assistant"
+                    and all(msg["role"] == "user" for msg in messages[index + 1:])
+                ):
+                    return pointer.get("question"), pointer.get("question_type")
+
+            # Estados anteriores al apuntador: buscar el último mensaje del bot
+            for msg in reversed(messages):
                 if msg["role"] == "assistant" or msg["sender"] == "bot":
-                    content = msg["content"]
-                    question_type = msg["question_type"]
-                    # Si el mensaje contiene una pregunta, extraerla
-                    if "?" in content:
-                        # Buscar la última línea que contenga una pregunta
-                        lines = content.split('\n')
-                        for line in reversed(lines):
-                            if "?" in line and line.strip():
-                                return line.strip(), question_type
-                        # Si no se encuentra una línea específica, devolver todo el contenido
-                        return content, question_type
-                    return content, question_type
+                    return _bot_question_from_content(msg["content"]), msg["question_type"]
             return None, None
         except Exception as e:
             logging.error(f"Error obteniendo última pregunta del bot: {e}")
@@ -2241,7 +2686,7 @@ class IntelligentLeadQualificationChatbot:
 
     def get_lead_data_json(self) -> str:
         """Obtiene los datos del lead en formato JSON"""
-        return json.dumps(get_current_state_str(self.state), indent=2, ensure_ascii=False)
+        return json_utils.dumps(get_current_state_str(self.state), indent=True)
     
     def process_last_lead_message(self, wa_id: str) -> Optional[str]:
         """
@@ -2290,4 +2735,7 @@ class IntelligentLeadQualificationChatbot:
             
         except Exception as e:
             logging.error(f"Error procesando último mensaje del lead: {e}")
-            return "Disculpe, hubo un error técnico. ¿Podría intentar de nuevo?"
\ No newline at end of file
+            return "Disculpe, hubo un error técnico. ¿Podría intentar de nuevo?"
+
+        finally:
+            self._loaded_user_id = None
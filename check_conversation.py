@@ -1,12 +1,255 @@
+import logging
 import os
-import json
+import re
+import threading
 import time
+from functools import lru_cache
+from typing import Optional
 from azure.ai.inference import ChatCompletionsClient
-from azure.ai.inference.models import SystemMessage, UserMessage
+from azure.ai.inference.models import JsonSchemaFormat, SystemMessage, UserMessage
 from azure.core.credentials import AzureKeyCredential
 from azure.core.exceptions import HttpResponseError
 from maquinaria_config import machinery_config_service
-from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from bounded_cache import BoundedCache
+import json_utils
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+
+# Respuestas cortas que no hace falta mandar al modelo: confirmaciones,
+# negaciones y saludos. Son válidas en cualquier punto de la conversación.
+_TRIVIAL_VALIDO = frozenset((
+    "si", "sí", "no", "ok", "okay", "va", "vale", "claro", "correcto", "exacto",
+    "de acuerdo", "perfecto", "gracias", "muchas gracias", "hola", "buenas",
+    "buenos dias", "buenos días", "buenas tardes", "buenas noches", "si gracias",
+    "sí gracias", "no gracias", "ninguno", "ninguna", "listo",
+))
+
+# Prefiltro determinista: un mensaje que es solo un correo o solo un teléfono
+# es un dato del lead (valido); pedir información de otros proveedores es
+# competencia. Los nombres de tipos de maquinaria NO se usan como atajo: "la
+# historia de las torres de iluminación" los menciona y es fuera de dominio.
+_CONTACT_ONLY_RE = re.compile(
+    r"(?:(?:mi )?(?:correo|email|e-mail|mail|telefono|teléfono|cel|celular|numero|número)(?: es)?:?\s*)?"
+    r"(?:[\w.+-]+@[\w-]+(?:\.[\w-]+)+|\+?\d[\d\s().-]{5,}\d)"
+)
+_COMPETENCIA_RE = re.compile(
+    r"\b(?:otros? proveedor(?:es)?|la competencia|tu competencia|su competencia|"
+    r"otras? empresas? (?:que vendan|que renten|de maquinaria)|otras? distribuidora?s?)\b"
+)
+
+
+def _prefiltrar(normalized: str) -> Optional[str]:
+    """Etiqueta para los mensajes que se clasifican sin el modelo, o None."""
+    if normalized in _TRIVIAL_VALIDO:
+        return "valido"
+    if _CONTACT_ONLY_RE.fullmatch(normalized):
+        return "valido"
+    if _COMPETENCIA_RE.search(normalized):
+        return "competencia_prohibido"
+    return None
+
+
+# Clasificaciones del modelo por (tipos de maquinaria, mensaje normalizado).
+# Los tipos van en la llave porque forman parte del prompt: al recargar la
+# configuración las etiquetas viejas dejan de usarse. Solo se guardan las que
+# vinieron del modelo, nunca el "valido" de fail-open, para que un error
+# transitorio no deje pasar ese mensaje para siempre; y expiran para que un
+# cambio en el modelo o en el prompt base también se refleje con el tiempo.
+_CLASSIFICATION_CACHE = BoundedCache(maxsize=4096, ttl=3600)
+
+# Hilos para poner timeout a la clasificación. Un executor por llamada creaba y
+# destruía un hilo en cada mensaje y, peor, el `with` esperaba en shutdown() a
+# que terminara la llamada al modelo: el timeout de 30 s no cortaba nada.
+_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="clasificador")
+
+_LABELS = ("valido", "competencia_prohibido", "fuera_de_dominio")
+_RESPONSE_FORMAT = JsonSchemaFormat(
+    name="clasificacion",
+    schema={
+        "type": "object",
+        "properties": {"label": {"type": "string", "enum": list(_LABELS)}},
+        "required": ["label"],
+        "additionalProperties": False,
+    },
+    strict=True,
+)
+
+_CLIENT: Optional[ChatCompletionsClient] = None
+_CLIENT_LOCK = threading.Lock()
+_MODEL_NAME = "gpt-4.1-mini"
+
+
+def _get_client() -> ChatCompletionsClient:
+    """
+    Cliente de Foundry compartido por el worker. Construirlo en cada mensaje
+    repetía la lectura de variables de entorno y el handshake TLS en la ruta
+    crítica de cada clasificación.
+    """
+    global _CLIENT
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                _CLIENT = ChatCompletionsClient(
+                    endpoint=os.environ["FOUNDRY_ENDPOINT"] + "models",
+                    credential=AzureKeyCredential(os.environ["FOUNDRY_API_KEY"]),
+                    api_version="2024-05-01-preview",
+                    # Sin timeouts de socket, una llamada colgada ocupa para
+                    # siempre un hilo de _EXECUTOR aunque el future ya expiró.
+                    connection_timeout=5,
+                    read_timeout=30,
+                )
+    return _CLIENT
+
+
+# Parte fija del system prompt. El proveedor reutiliza (caché de prompt) el
+# prefijo idéntico entre llamadas, así que todo lo fijo va primero y en un
+# string constante; lo que depende de la configuración (los tipos de
+# maquinaria) se agrega AL FINAL. No interpolar nada dentro de este bloque.
+_SYSTEM_PROMPT_BASE = (
+    "Eres un clasificador de intenciones para un chatbot de ventas de maquinaria.\n\n"
+    "Clasifica cada mensaje en UNA de estas tres categorías:\n\n"
+    
+    "1. VALIDO - Incluye CUALQUIER consulta con las siguientes características:\n"
+    "   - Preguntas sobre tipos de maquinaria (ver TIPOS DE MAQUINARIA al final)\n"
+    "   - Preguntas sobre refacciones de maquinaria\n"
+    "   - Consultas sobre PRECIOS de maquinaria específica\n"
+    "   - Consultas sobre créditos de maquinaria o financiamiento\n"
+    "   - Preguntas sobre disponibilidad de inventario\n"
+    "   - Preguntas sobre características y especificaciones\n"
+    "   - Consultas sobre marcas de maquinaria\n"
+    "   - Información sobre características y especificaciones de maquinaria (capacidad, altura, etc.)\n"
+    "   - Solicitudes de cotización\n"
+    "   - Información personal del cliente (nombre, empresa, contacto, lugar de requerimiento)\n"
+    "   - Preguntas sobre por qué necesita ciertos datos\n"
+    "   - Preguntas sobre cómo se llama el asistente\n"
+    "   - Detalles sobre proyectos que requieren maquinaria\n"
+    "   - Respuestas cortas sobre el giro o actividad de la empresa del cliente (ej: 'mantenimiento', 'construcción', 'minería', 'renta de maquinaria')\n"
+    "   - Respuestas sobre si el equipo es para uso propio, venta o renta (ej: 'no, es para uso propio', 'sí, rentamos maquinaria')\n"
+    "   - Respuestas de selección cuando el usuario elige entre opciones presentadas (ej: 'la segunda', 'me interesa el primero', 'quiero la opción 3')\n\n"
+    
+    "2. COMPETENCIA_PROHIBIDO - Consultas sobre otros proveedores:\n"
+    "   - Preguntas sobre precios de competidores\n"
+    "   - Comparativas con otros proveedores\n"
+    "   - Recomendaciones de proveedores externos\n"
+    "   - Consultas sobre alternativas a Alpha C\n\n"
+    
+    "3. FUERA_DE_DOMINIO - Cualquier tema no relacionado con maquinaria:\n"
+    "   - Historia, ciencia general\n"
+    "   - Entretenimiento, deportes, cultura\n"
+    "   - Tecnología no relacionada con maquinaria\n"
+    "   - Política, religión, temas controversiales\n\n"
+    
+    "EJEMPLOS IMPORTANTES:\n"
+    "- '¿Cuál es el precio de la soldadora Shindaiwa?' → valido\n"
+    "- 'Lo necesito de 20 litros' → valido\n"
+    "- 'Me interesa la segunda opción' → valido\n"
+    "- 'Quiero el primero' → valido\n"
+    "- 'quiero la segunda' → valido (selección de opción presentada)\n"
+    "- 'quiero la primera' → valido (selección de opción presentada)\n"
+    "- 'la primera opción' → valido (selección de opción presentada)\n"
+    "- 'si, la segunda' → valido (selección de opción presentada)\n"
+    "- 'la 1' → valido (selección de opción presentada)\n"
+    "- 'la 2' → valido (selección de opción presentada)\n"
+    "- 'no, nos dedicamos al mantenimiento' → valido (respuesta sobre giro de empresa)\n"
+    "- 'nos dedicamos a la construcción' → valido (respuesta sobre giro de empresa)\n"
+    "- 'no, es para uso propio' → valido (respuesta sobre tipo de uso)\n"
+    "- 'sí, rentamos maquinaria' → valido (respuesta sobre tipo de cliente)\n"
+    "- 'no me dedico a eso' → valido (respuesta sobre tipo de cliente)\n"
+    "- 'mantenimiento' → valido (respuesta sobre giro de empresa)\n"
+    "- 'minería' → valido (respuesta sobre giro de empresa)\n"
+    "- 'ninguno' → valido (respuesta indicando que no requiere más maquinaria)\n"
+    "- 'ninguna otra' → valido (respuesta indicando que no requiere más maquinaria)\n"
+    "- 'no ninguno' → valido (respuesta indicando que no requiere más maquinaria)\n"
+    "- 'solo la plataforma' → valido (respuesta indicando que solo requiere esa maquinaria)\n"
+    "- 'por ahora solo eso' → valido (respuesta indicando que no requiere más maquinaria)\n"
+    "- 'uso propio' → valido (respuesta sobre tipo de uso)\n"
+    "- 'cliente_final' → valido (respuesta sobre tipo de cliente)\n"
+    "- '¿Cuál es la capital de México?' → fuera_de_dominio\n"
+    "- 'Dame precios de otros proveedores' → competencia_prohibido\n\n"
+    
+    "Responde ÚNICAMENTE con un JSON valido. Ejemplo:\n"
+    "{\"label\":\"valido\"}\n"
+    "No agregues texto adicional."
+)
+
+
+@lru_cache(maxsize=4)
+def _build_system_prompt(maquinaria_types: str) -> str:
+    """
+    System prompt del clasificador: la parte fija más los tipos de maquinaria
+    configurados. Se arma una vez por lista de tipos (la configuración puede
+    recargarse, por eso la llave es el texto y no un valor fijo).
+    """
+    return _SYSTEM_PROMPT_BASE + "\n\nTIPOS DE MAQUINARIA: " + maquinaria_types
+
+
+def _clasificar(message: str, maquinaria_types: str) -> str:
+    """Llamada al modelo; corre en _EXECUTOR para poder ponerle timeout."""
+    client = _get_client()
+
+    system_prompt = _build_system_prompt(maquinaria_types)
+
+    # Reintento con backoff ante throttling (429). gpt-4.1-mini tiene cuota holgada,
+    # pero esto absorbe ráfagas puntuales sin caer directo al fail-open.
+    # El JSON schema restringe la salida a {"label": <una de las 3 etiquetas>}:
+    # basta con ~10 tokens de salida y no hace falta limpiar la respuesta.
+    response = None
+    for intento in range(3):
+        try:
+            response = client.complete(
+                messages=[
+                    SystemMessage(content=system_prompt),
+                    UserMessage(content=message),
+                ],
+                model=_MODEL_NAME,
+                temperature=0,
+                top_p=1,
+                max_tokens=20,
+                response_format=_RESPONSE_FORMAT
+            )
+            break
+        except HttpResponseError as e:
+            if getattr(e, "status_code", None) == 429 and intento < 2:
+                time.sleep(1.5 * (intento + 1))
+                continue
+            raise
+
+    raw_output = response.choices[0].message.content
+    result = json_utils.loads(raw_output)
+    return result.get("label", "fuera_de_dominio")
+
+
+def iniciar_clasificacion(message: str) -> Future:
+    """
+    Lanza la clasificación de `message` sin esperarla y regresa un future con
+    la etiqueta. Los mensajes del prefiltro y los que ya están en caché regresan
+    un future resuelto, sin ocupar un hilo. Los errores del modelo se propagan
+    por el future: quien espera decide (clasificar_mensaje hace fail-open).
+    """
+    normalized = " ".join(message.strip().lower().split()).strip(".,!¡")
+    label = _prefiltrar(normalized)
+    if label is not None:
+        future = Future()
+        future.set_result(label)
+        return future
+
+    # Obtener tipos de maquinaria dinámicamente
+    maquinaria_types = ", ".join(m.type_id for m in machinery_config_service.get_all_types())
+    cache_key = (maquinaria_types, normalized)
+    label = _CLASSIFICATION_CACHE.get(cache_key)
+    if label is not None:
+        future = Future()
+        future.set_result(label)
+        return future
+
+    future = _EXECUTOR.submit(_clasificar, message, maquinaria_types)
+
+    def _guardar(done: Future) -> None:
+        if not done.cancelled() and done.exception() is None:
+            _CLASSIFICATION_CACHE.set(cache_key, done.result())
+
+    future.add_done_callback(_guardar)
+    return future
 
 
 def clasificar_mensaje(message: str) -> str:
@@ -18,156 +261,16 @@ def clasificar_mensaje(message: str) -> str:
     Antes se usaba Ministral-3B, pero su deployment tenía RPM=1 y throttleaba (429)
     en conversaciones reales, lo que corrompía los mensajes con el prefijo "(FD)".
     """
-
-    def _clasificar():
-        # Configuración de cliente
-        endpoint = os.environ["FOUNDRY_ENDPOINT"] + "models"
-        model_name = "gpt-4.1-mini"
-        api_key = os.environ["FOUNDRY_API_KEY"]
-
-        client = ChatCompletionsClient(
-            endpoint=endpoint,
-            credential=AzureKeyCredential(api_key),
-            api_version="2024-05-01-preview"
-        )   
-
-        # Obtener tipos de maquinaria dinámicamente
-        maquinaria_types = [m.type_id for m in machinery_config_service.get_all_types()]
-
-        system_prompt = (
-            "Eres un clasificador de intenciones para un chatbot de ventas de maquinaria.\n\n"
-            "Clasifica cada mensaje en UNA de estas tres categorías:\n\n"
-            
-            "1. VALIDO - Incluye CUALQUIER consulta con las siguientes características:\n"
-            "   - Preguntas sobre tipos de maquinaria:" + ", ".join(maquinaria_types) + "\n"
-            "   - Preguntas sobre refacciones de maquinaria\n"
-            "   - Consultas sobre PRECIOS de maquinaria específica\n"
-            "   - Consultas sobre créditos de maquinaria o financiamiento\n"
-            "   - Preguntas sobre disponibilidad de inventario\n"
-            "   - Preguntas sobre características y especificaciones\n"
-            "   - Consultas sobre marcas de maquinaria\n"
-            "   - Información sobre características y especificaciones de maquinaria (capacidad, altura, etc.)\n"
-            "   - Solicitudes de cotización\n"
-            "   - Información personal del cliente (nombre, empresa, contacto, lugar de requerimiento)\n"
-            "   - Preguntas sobre por qué necesita ciertos datos\n"
-            "   - Preguntas sobre cómo se llama el asistente\n"
-            "   - Detalles sobre proyectos que requieren maquinaria\n"
-            "   - Respuestas cortas sobre el giro o actividad de la empresa del cliente (ej: 'mantenimiento', 'construcción', 'minería', 'renta de maquinaria')\n"
-            "   - Respuestas sobre si el equipo es para uso propio, venta o renta (ej: 'no, es para uso propio', 'sí, rentamos maquinaria')\n"
-            "   - Respuestas de selección cuando el usuario elige entre opciones presentadas (ej: 'la segunda', 'me interesa el primero', 'quiero la opción 3')\n\n"
-            
-            "2. COMPETENCIA_PROHIBIDO - Consultas sobre otros proveedores:\n"
-            "   - Preguntas sobre precios de competidores\n"
-            "   - Comparativas con otros proveedores\n"
-            "   - Recomendaciones de proveedores externos\n"
-            "   - Consultas sobre alternativas a Alpha C\n\n"
-            
-            "3. FUERA_DE_DOMINIO - Cualquier tema no relacionado con maquinaria:\n"
-            "   - Historia, ciencia general\n"
-            "   - Entretenimiento, deportes, cultura\n"
-            "   - Tecnología no relacionada con maquinaria\n"
-            "   - Política, religión, temas controversiales\n\n"
-            
-            "EJEMPLOS IMPORTANTES:\n"
-            "- '¿Cuál es el precio de la soldadora Shindaiwa?' → valido\n"
-            "- 'Lo necesito de 20 litros' → valido\n"
-            "- 'Me interesa la segunda opción' → valido\n"
-            "- 'Quiero el primero' → valido\n"
-            "- 'quiero la segunda' → valido (selección de opción presentada)\n"
-            "- 'quiero la primera' → valido (selección de opción presentada)\n"
-            "- 'la primera opción' → valido (selección de opción presentada)\n"
-            "- 'si, la segunda' → valido (selección de opción presentada)\n"
-            "- 'la 1' → valido (selección de opción presentada)\n"
-            "- 'la 2' → valido (selección de opción presentada)\n"
-            "- 'no, nos dedicamos al mantenimiento' → valido (respuesta sobre giro de empresa)\n"
-            "- 'nos dedicamos a la construcción' → valido (respuesta sobre giro de empresa)\n"
-            "- 'no, es para uso propio' → valido (respuesta sobre tipo de uso)\n"
-            "- 'sí, rentamos maquinaria' → valido (respuesta sobre tipo de cliente)\n"
-            "- 'no me dedico a eso' → valido (respuesta sobre tipo de cliente)\n"
-            "- 'mantenimiento' → valido (respuesta sobre giro de empresa)\n"
-            "- 'minería' → valido (respuesta sobre giro de empresa)\n"
-            "- 'ninguno' → valido (respuesta indicando que no requiere más maquinaria)\n"
-            "- 'ninguna otra' → valido (respuesta indicando que no requiere más maquinaria)\n"
-            "- 'no ninguno' → valido (respuesta indicando que no requiere más maquinaria)\n"
-            "- 'solo la plataforma' → valido (respuesta indicando que solo requiere esa maquinaria)\n"
-            "- 'por ahora solo eso' → valido (respuesta indicando que no requiere más maquinaria)\n"
-            "- 'uso propio' → valido (respuesta sobre tipo de uso)\n"
-            "- 'cliente_final' → valido (respuesta sobre tipo de cliente)\n"
-            "- '¿Cuál es la capital de México?' → fuera_de_dominio\n"
-            "- 'Dame precios de otros proveedores' → competencia_prohibido\n\n"
-            
-            "Responde ÚNICAMENTE con un JSON valido. Ejemplo:\n"
-            "{\"label\":\"valido\"}\n"
-            "No agregues texto adicional."
-        )
-
-        # Reintento con backoff ante throttling (429). gpt-4.1-mini tiene cuota holgada,
-        # pero esto absorbe ráfagas puntuales sin caer directo al fail-open.
-        # response_format="json_object" fuerza salida JSON limpia (el prompt incluye "JSON").
-        response = None
-        for intento in range(3):
-            try:
-                response = client.complete(
-                    messages=[
-                        SystemMessage(content=system_prompt),
-                        UserMessage(content=message),
-                    ],
-                    model=model_name,
-                    temperature=0,
-                    top_p=1,
-                    max_tokens=100,
-                    response_format="json_object"
-                )
-                break
-            except HttpResponseError as e:
-                if getattr(e, "status_code", None) == 429 and intento < 2:
-                    time.sleep(1.5 * (intento + 1))
-                    continue
-                raise
-
-        raw_output = response.choices[0].message.content.strip()
-        
-        # Remove markdown code blocks if present
-        if "```json" in raw_output:
-            raw_output = raw_output.split("```json")[1].split("```")[0].strip()
-        elif "```" in raw_output:
-            raw_output = raw_output.split("```")[1].split("```")[0].strip()
-        
-        # Find the first complete JSON object
-        json_start = raw_output.find('{')
-        if json_start != -1:
-            # Extract only the first JSON object
-            raw_output = raw_output[json_start:]
-            # Find the matching closing brace for the first object
-            brace_count = 0
-            json_end = 0
-            for i, char in enumerate(raw_output):
-                if char == '{':
-                    brace_count += 1
-                elif char == '}':
-                    brace_count -= 1
-                    if brace_count == 0:
-                        json_end = i + 1
-                        break
-            if json_end > 0:
-                raw_output = raw_output[:json_end]
-
-        result = json.loads(raw_output)
-        return result.get("label", "fuera_de_dominio")
-
     try:
-        # Usar ThreadPoolExecutor con timeout para Azure Functions
-        with ThreadPoolExecutor(max_workers=1) as executor:
-            future = executor.submit(_clasificar)
-            result = future.result(timeout=30)  # 30 segundos timeout
-            return result
+        # El future corre en _EXECUTOR para poder ponerle timeout
+        return iniciar_clasificacion(message).result(timeout=30)  # 30 segundos timeout
     except FutureTimeoutError:
-        print("Timeout en clasificar_mensaje después de 30 segundos")
+        logging.error("Timeout en clasificar_mensaje después de 30 segundos")
         # Fail-open: un fallo de infra del clasificador de dominio NO debe bloquear al lead.
         # Content-safety y groundness cubren el contenido realmente peligroso por separado.
         return "valido"
     except Exception as e:
-        print("Error parseando respuesta:", e)
+        logging.error("Error parseando respuesta: %s", e)
         # Fail-open: ante error de parseo/API, dejamos pasar el mensaje en vez de vetarlo.
         return "valido"
 
@@ -1,173 +1,429 @@
 import os
 import re
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
 from azure.ai.contentsafety import ContentSafetyClient
 from azure.ai.contentsafety.models import AnalyzeTextOptions
 from azure.core.credentials import AzureKeyCredential
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
-from check_conversation import clasificar_mensaje
-from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from check_conversation import iniciar_clasificacion
+from bounded_cache import BoundedCache
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 class TimeoutError(Exception):
     """Excepción personalizada para timeouts"""
     pass
 
 
+# Hilos compartidos para las verificaciones remotas. Cada verificación corre
+# aquí para poder ponerle timeout, y check_message_safety lanza las tres a la
+# vez (el clasificador de dominio usa el pool de check_conversation). Un executor por llamada creaba hilos en cada mensaje y su `with`
+# esperaba en shutdown() a que terminara la llamada: el timeout no cortaba nada.
+_EXECUTOR = ThreadPoolExecutor(max_workers=12, thread_name_prefix="guardrails")
+_CHECK_TIMEOUT = 30  # segundos
+# Timeouts del socket. El timeout del future solo deja de esperar: sin estos,
+# una conexión colgada mantiene ocupado el hilo del pool indefinidamente.
+_CONNECT_TIMEOUT = 5  # segundos
+
+# Sesión HTTP compartida para shieldPrompt: reutiliza la conexión TLS con
+# Content Safety entre mensajes del mismo worker en lugar de abrir una nueva
+# en cada verificación. El pool alcanza para las verificaciones simultáneas.
+# Un 429 o 5xx transitorio se reintenta con backoff: sin esto la verificación
+# regresaba None y el mensaje pasaba sin revisar si era un jailbreak. El POST
+# de shieldPrompt solo analiza el texto, así que repetirlo es seguro. (El
+# cliente de Content Safety ya reintenta por su cuenta con la política de
+# azure-core.)
+_SHIELD_PROMPT_RETRY = Retry(
+    total=3,
+    backoff_factor=0.3,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset({"POST"}),
+    raise_on_status=False,
+)
+_HTTP_SESSION = requests.Session()
+_HTTP_SESSION.mount(
+    "https://",
+    HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=_SHIELD_PROMPT_RETRY),
+)
+
+
+_API_VERSION = "2024-09-01"
+
+
+@lru_cache(maxsize=1)
+def _foundry_settings() -> Tuple[str, str]:
+    """
+    (endpoint, llave) de Foundry, leídos una sola vez por worker. Se leen al
+    primer uso y no al importar: una variable faltante no debe impedir que
+    cargue function_app (y con él el endpoint de verificación del webhook).
+    """
+    return os.environ["FOUNDRY_ENDPOINT"], os.environ["FOUNDRY_API_KEY"]
+
+
+@lru_cache(maxsize=1)
+def _get_content_safety_client() -> ContentSafetyClient:
+    """
+    Cliente de Content Safety compartido por el worker. Construirlo en cada
+    mensaje rehacía el pipeline de autenticación y el handshake TLS.
+    """
+    endpoint, subscription_key = _foundry_settings()
+    return ContentSafetyClient(
+        endpoint=endpoint,
+        credential=AzureKeyCredential(subscription_key),
+        connection_timeout=_CONNECT_TIMEOUT,
+        read_timeout=_CHECK_TIMEOUT,
+    )
+
+# Patrones de inyección de código, unidos en una sola expresión compilada al
+# importar: una búsqueda por mensaje en lugar de tres. Están en minúsculas y
+# sin IGNORECASE porque detect_code_injection baja el mensaje una sola vez.
+_INJECTION_RE = re.compile(
+    # Inyección SQL: busca palabras clave de SQL y patrones comunes de ataque.
+    r"\b(select|insert|update|delete|drop|union|create|alter)\b|--|;|' or '1'='1"
+    # Inyección de comandos/código Python: busca funciones peligrosas y sintaxis común.
+    r"|\b(os\.system|subprocess|eval|exec|import|open)\b"
+    # Cross-Site Scripting (XSS): busca etiquetas de script y manejadores de eventos.
+    r"|<script.*?>|javascript:|\bon\w+\s*="
+)
+
+# Con pyahocorasick instalado, las palabras clave y literales fijos se buscan
+# en una sola pasada del autómata sobre el mensaje en minúsculas, sin importar
+# cuántas palabras haya. Solo lo que sí necesita regex (etiqueta <script> y
+# manejadores on...=) queda en _INJECTION_TAIL_RE. Sin la librería se usa
+# _INJECTION_RE completa; ambas rutas detectan exactamente lo mismo.
+_INJECTION_KEYWORDS = (
+    "select", "insert", "update", "delete", "drop", "union", "create", "alter",
+    "os.system", "subprocess", "eval", "exec", "import", "open",
+)
+_INJECTION_LITERALS = ("--", ";", "' or '1'='1", "javascript:")
+_INJECTION_TAIL_RE = re.compile(r"<script.*?>|\bon\w+\s*=")
+
+# Marcador que se guarda en el historial en lugar del mensaje rechazado
+CODE_INJECTION_MESSAGE = "MENSAJE INVÁLIDO: Se ha detectado un posible intento de inyección de código en el mensaje."
+
+
+def _build_injection_automaton():
+    if ahocorasick is None:
+        return None
+    automaton = ahocorasick.Automaton()
+    # Valor: (largo, requiere límite de palabra como el \b de la regex)
+    for keyword in _INJECTION_KEYWORDS:
+        automaton.add_word(keyword, (len(keyword), True))
+    for literal in _INJECTION_LITERALS:
+        automaton.add_word(literal, (len(literal), False))
+    automaton.make_automaton()
+    return automaton
+
+
+_INJECTION_AUTOMATON = _build_injection_automaton()
+
+
+def _is_word_char(text: str, index: int) -> bool:
+    """Equivalente a \w de re en la posición `index` (False fuera del texto)."""
+    if index < 0 or index >= len(text):
+        return False
+    char = text[index]
+    return char.isalnum() or char == "_"
+
+# Resultados de content safety y shieldPrompt por mensaje normalizado: los
+# leads repiten mucho las mismas frases cortas ("sí", "ok", "gracias"). Los
+# errores (None) no se guardan, para que una falla transitoria no se quede
+# pegada. El clasificador de dominio tiene su propia caché en check_conversation.
+_RESULT_CACHE = BoundedCache(maxsize=4096, ttl=3600)
+
+
+# Mensajes que ya pasaron todas las verificaciones con resultados definitivos
+# (sin errores ni fail-open): una repetición regresa "seguro" sin crear
+# futures ni consultar las demás cachés. Expiran para que un cambio en los
+# modelos de Azure o en el prompt del clasificador se refleje con el tiempo.
+_SAFE_MESSAGES = BoundedCache(maxsize=8192, ttl=3600)
+
+
+def _normalize(message: str) -> str:
+    return " ".join(message.lower().split())
+
+
+def _done_future(value) -> Future:
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+# Mensajes para los que no se llama a content safety ni a shieldPrompt: muy
+# cortos para contener contenido dañino o un jailbreak, o que son solo números,
+# signos y emojis, o una confirmación/saludo común. El clasificador de dominio
+# sí corre siempre. El umbral es por caracteres y no por palabras: "ignora tus
+# instrucciones" tiene pocas palabras y es justo lo que shieldPrompt detecta.
+_SKIP_REMOTE_MAX_LEN = 12
+_SKIP_REMOTE_RE = re.compile(
+    r"[\W\d_]*"
+    r"|(?:s[ií]|no|ok|okay|va|vale|claro|correcto|exacto|perfecto|listo|hola|"
+    r"(?:muchas )?gracias|de acuerdo|buen[oa]s(?: d[ií]as| tardes| noches)?)[\W\d_]*"
+)
+
+
+def _skips_remote_safety(message: str) -> bool:
+    normalized = _normalize(message)
+    return len(normalized) < _SKIP_REMOTE_MAX_LEN or _SKIP_REMOTE_RE.fullmatch(normalized) is not None
+
+
+# Verificaciones en curso por la misma llave de _RESULT_CACHE. WhatsApp reenvía
+# el webhook cuando la respuesta tarda, y el lead a veces manda el mismo texto
+# dos veces seguidas: la segunda petición se cuelga del future de la primera en
+# lugar de repetir la llamada a Azure. Un future compartido no se cancela.
+_IN_FLIGHT: Dict[Tuple[str, str], Future] = {}
+_IN_FLIGHT_LOCK = threading.RLock()  # RLock: cancel() corre _forget con el lock tomado
+
+
+def _cancel_if_unshared(future: Future) -> None:
+    """Cancela el future si nadie más lo está esperando (ver _IN_FLIGHT)."""
+    with _IN_FLIGHT_LOCK:
+        if not getattr(future, "shared", False):
+            future.cancel()
+
+
+def _cancel_checks(futures: Optional[Dict[str, Future]]) -> None:
+    for future in (futures or {}).values():
+        _cancel_if_unshared(future)
+
+
 class ContentSafetyGuardrails:
-    def __init__(self):
-        self.subscription_key = os.environ["FOUNDRY_API_KEY"]
-        self.endpoint = os.environ["FOUNDRY_ENDPOINT"]
-        self.api_version = "2024-09-01"
+    # Sin estado por instancia: la configuración (_foundry_settings), los
+    # clientes y las cachés son del módulo, así que construirla no cuesta nada.
 
-    def detect_code_injection(self, message: str):
+    @staticmethod
+    def detect_code_injection(message: str):
         """
         Detecta intentos de inyección de código (SQL, Python, etc.) usando expresiones regulares.
         Regresa True si se detecta un posible ataque, False si no.
+        Es local y no necesita instancia: function_app la corre antes de cargar
+        la conversación para no gastar lecturas de Cosmos en tráfico malicioso.
         """
-        # Patrones de inyección de código a buscar
-        code_patterns = [
-            # Inyección SQL: busca palabras clave de SQL y patrones comunes de ataque.
-            r"\b(SELECT|INSERT|UPDATE|DELETE|DROP|UNION|CREATE|ALTER)\b|--|;|\' OR \'1\'=\'1",
-            
-            # Inyección de comandos/código Python: busca funciones peligrosas y sintaxis común.
-            r"\b(os\.system|subprocess|eval|exec|import|open)\b",
-            
-            # Cross-Site Scripting (XSS): busca etiquetas de script y manejadores de eventos.
-            r"<script.*?>|javascript:|\bon\w+\s*="
-        ]
-        
-        # Itera sobre cada patrón y busca una coincidencia en el mensaje
-        for pattern in code_patterns:
-            if re.search(pattern, message, re.IGNORECASE):
+        lowered = message.lower()
+        if _INJECTION_AUTOMATON is None:
+            return _INJECTION_RE.search(lowered) is not None
+
+        for end, (length, needs_boundary) in _INJECTION_AUTOMATON.iter(lowered):
+            start = end - length + 1
+            if not needs_boundary:
+                return True
+            if not _is_word_char(lowered, start - 1) and not _is_word_char(lowered, end + 1):
+                return True
+        return _INJECTION_TAIL_RE.search(lowered) is not None
+
+    def _analyze_content(self, message: str) -> bool:
+        """AnalyzeText de Content Safety: True si alguna categoría rebasa severidad 3."""
+        client = _get_content_safety_client()
+        # Crear solicitud de análisis de texto
+        request = AnalyzeTextOptions(text=message)
+        response = client.analyze_text(request)
+
+        categories = response["categoriesAnalysis"]
+        for category in categories:
+            if category["severity"] > 3:
                 return True
         return False
 
-    def check_content_safety(self, message: str):
+    def _shield_prompt(self, message: str) -> Optional[bool]:
+        """shieldPrompt de Content Safety: True si detecta un ataque, None si la API falla."""
+        # El mensaje del usuario se pasa como userPrompt para detectar ataques
+        # directos (jailbreak). El campo 'documents' es para detectar ataques
+        # indirectos en contenido externo (PDFs, emails, etc.) y genera falsos
+        # positivos cuando se usa con mensajes normales del usuario.
+        user_prompt = message
+        documents = []
+        endpoint, subscription_key = _foundry_settings()
+
+        # Endpoint para el API de Content Safety de Shield Prompt
+        response = _HTTP_SESSION.post(
+            f"{endpoint}/contentsafety/text:shieldPrompt?api-version={_API_VERSION}",
+            headers={
+                "Content-Type": "application/json",
+                "Ocp-Apim-Subscription-Key": subscription_key
+            },
+            json={
+                "userPrompt": user_prompt,
+                "documents": documents
+            },
+            timeout=(_CONNECT_TIMEOUT, _CHECK_TIMEOUT)
+        )
+
+        # Handle the API response
+        if response.status_code == 200:
+            result = response.json()
+            if result["userPromptAnalysis"]["attackDetected"]:
+                return True
+            return False
+        else:
+            logging.error("Error en shieldPrompt: %s %s", response.status_code, response.text)
+            return None
+
+    @staticmethod
+    def _submit_conversation_check(message: str) -> Future:
         """
-        Detecta ataques de contenido como Hate, SelfHarm, Sexual, y Violence
-        Regresa True si se detecta un ataque, False si no se detecta, None si hay error
+        Future que resuelve a True si el clasificador de dominio NO considera
+        válido el mensaje. Se encadena al future del clasificador en lugar de
+        correr clasificar_mensaje en un hilo de _EXECUTOR: así ningún hilo se
+        queda bloqueado esperando a otro pool.
         """
-        def _check_content():
-            # Crear cliente de Content Safety
-            client = ContentSafetyClient(
-                endpoint=self.endpoint,
-                credential=AzureKeyCredential(self.subscription_key)
-            )
-            # Crear solicitud de análisis de texto
-            request = AnalyzeTextOptions(text=message)
-            response = client.analyze_text(request)
-
-            categories = response["categoriesAnalysis"]
-            for category in categories:
-                if category["severity"] > 3:
-                    return True
-            return False
+        result = Future()
+        # En curso desde ya: un future encadenado no se puede cancelar a medias
+        result.set_running_or_notify_cancel()
+
+        def _chain(label_future: Future) -> None:
+            try:
+                result.set_result(label_future.result() != "valido")
+            except BaseException as e:
+                result.set_exception(e)
+
+        iniciar_clasificacion(message).add_done_callback(_chain)
+        return result
+
+    @staticmethod
+    def _submit_cached(check_name: str, check, message: str) -> Future:
+        """
+        Lanza `check(message)` en el pool, o regresa un future ya resuelto si el
+        resultado está en caché, o el de una verificación idéntica en curso.
+        """
+        key = (check_name, _normalize(message))
+        cached = _RESULT_CACHE.get(key)
+        if cached is not None:
+            return _done_future(cached)
+
+        def _run():
+            result = check(message)
+            if result is not None:
+                _RESULT_CACHE.set(key, result)
+            return result
+
+        with _IN_FLIGHT_LOCK:
+            future = _IN_FLIGHT.get(key)
+            if future is not None and not future.cancelled():
+                future.shared = True
+                return future
+            future = _EXECUTOR.submit(_run)
+            _IN_FLIGHT[key] = future
+
+        def _forget(done: Future) -> None:
+            with _IN_FLIGHT_LOCK:
+                if _IN_FLIGHT.get(key) is done:
+                    del _IN_FLIGHT[key]
 
+        future.add_done_callback(_forget)
+        return future
+
+    @staticmethod
+    def _wait(future, check_name: str, timeout: float, on_error):
+        """
+        Espera el resultado de una verificación. Un timeout se propaga como
+        TimeoutError (check_message_safety lo convierte en su respuesta); cualquier
+        otro error regresa `on_error`.
+        """
         try:
-            # Usar ThreadPoolExecutor con timeout para Azure Functions
-            with ThreadPoolExecutor(max_workers=1) as executor:
-                future = executor.submit(_check_content)
-                result = future.result(timeout=30)  # 30 segundos timeout
-                return result
+            return future.result(timeout=timeout)
         except FutureTimeoutError:
-            print("Timeout en check_content_safety después de 30 segundos")
-            raise TimeoutError("Timeout en check_content_safety después de 30 segundos")
+            logging.error("Timeout en %s después de %s segundos", check_name, _CHECK_TIMEOUT)
+            raise TimeoutError(f"Timeout en {check_name} después de {_CHECK_TIMEOUT} segundos")
         except Exception as e:
-            print(f"Error checking content safety: {e}")
-            return None
+            logging.error("Error en %s: %s", check_name, e)
+            return on_error
+
+    def check_content_safety(self, message: str):
+        """
+        Detecta ataques de contenido como Hate, SelfHarm, Sexual, y Violence
+        Regresa True si se detecta un ataque, False si no se detecta, None si hay error
+        """
+        future = self._submit_cached("content_safety", self._analyze_content, message)
+        return self._wait(future, "check_content_safety", _CHECK_TIMEOUT, None)
 
     def detect_groundness_result(self, message: str):
         """
         Detecta ataques de groundness como prompts con Jailbreak attacks e Indirect attacks
-        Regresa True si se detecta un ataque, False si no se detecta, "timeout" si excede tiempo límite
+        Regresa True si se detecta un ataque, False si no se detecta, None si hay error
         """
-        def _check_groundness():
-            subscription_key = self.subscription_key
-            endpoint = self.endpoint
-            api_version = self.api_version
-
-            # El mensaje del usuario se pasa como userPrompt para detectar ataques
-            # directos (jailbreak). El campo 'documents' es para detectar ataques
-            # indirectos en contenido externo (PDFs, emails, etc.) y genera falsos
-            # positivos cuando se usa con mensajes normales del usuario.
-            user_prompt = message
-            documents = []
-
-            # Endpoint para el API de Content Safety de Shield Prompt
-            response = requests.post(
-                f"{endpoint}/contentsafety/text:shieldPrompt?api-version={api_version}",
-                headers={
-                    "Content-Type": "application/json",
-                    "Ocp-Apim-Subscription-Key": subscription_key
-                },
-                json={
-                    "userPrompt": user_prompt,
-                    "documents": documents
-                }
-            )
-
-            # Handle the API response
-            if response.status_code == 200:
-                result = response.json()
-                if result["userPromptAnalysis"]["attackDetected"]:
-                    return True
-                return False
-            else:
-                print("Error:", response.status_code, response.text)
-                return None
-
-        try:
-            # Usar ThreadPoolExecutor con timeout para Azure Functions
-            with ThreadPoolExecutor(max_workers=1) as executor:
-                future = executor.submit(_check_groundness)
-                result = future.result(timeout=30)  # 30 segundos timeout
-                return result
-        except FutureTimeoutError:
-            print("Timeout en detect_groundness_result después de 30 segundos")
-            raise TimeoutError("Timeout en detect_groundness_result después de 30 segundos")
-        except Exception as e:
-            print("Error:", e)
-            return None
+        future = self._submit_cached("groundness", self._shield_prompt, message)
+        return self._wait(future, "detect_groundness_result", _CHECK_TIMEOUT, None)
 
     def check_conversation_safety(self, message: str):
         """
         Clasifica un mensaje en: valido, competencia_prohibido, fuera_de_dominio.
-        Devuelve True si el mensaje no es valido, False si es valido, "timeout" si excede tiempo límite.
+        Devuelve True si el mensaje no es valido, False si es valido.
         """
-        def _check_conversation():
-            clasificacion = clasificar_mensaje(message)
-            return clasificacion != "valido"
+        future = self._submit_conversation_check(message)
+        # Fail-open: si el clasificador de dominio no puede evaluarse, dejamos pasar
+        # el mensaje (False = válido) en vez de bloquear a un lead legítimo.
+        return self._wait(future, "check_conversation_safety", _CHECK_TIMEOUT, False)
 
-        try:
-            # Usar ThreadPoolExecutor con timeout para Azure Functions
-            with ThreadPoolExecutor(max_workers=1) as executor:
-                future = executor.submit(_check_conversation)
-                result = future.result(timeout=30)  # 30 segundos timeout
-                return result
-        except FutureTimeoutError:
-            print("Timeout en check_conversation_safety después de 30 segundos")
-            raise TimeoutError("Timeout en check_conversation_safety después de 30 segundos")
-        except Exception as e:
-            print(f"Error en check_conversation_safety: {e}")
-            # Fail-open: si el clasificador de dominio no puede evaluarse, dejamos pasar
-            # el mensaje (False = válido) en vez de bloquear a un lead legítimo.
-            return False
+    def start_remote_checks(self, message: str) -> Dict[str, Future]:
+        """
+        Lanza las verificaciones remotas de check_message_safety sin esperarlas.
+        function_app las arranca antes de cargar la conversación, así la lectura
+        de Cosmos corre mientras tanto; los futures se pasan después como
+        `pending` a check_message_safety. Regresa {} si no hay nada que lanzar.
+        """
+        if self.detect_code_injection(message) or _normalize(message) in _SAFE_MESSAGES:
+            return {}
+
+        # Las tres verificaciones remotas son independientes y casi todo su
+        # tiempo es espera de red: se lanzan juntas y comparten un mismo plazo,
+        # así la latencia es la de la más lenta y no la suma de las tres. Los
+        # resultados se revisan en el mismo orden de prioridad de siempre.
+        if _skips_remote_safety(message):
+            futures = {
+                "content_safety": _done_future(False),
+                "groundness": _done_future(False),
+            }
+        else:
+            futures = {
+                "content_safety": self._submit_cached("content_safety", self._analyze_content, message),
+                "groundness": self._submit_cached("groundness", self._shield_prompt, message),
+            }
+        futures["invalid_conversation"] = self._submit_conversation_check(message)
+        return futures
 
-    def check_message_safety(self, message: str):  
-        logging.info(f"Verificando seguridad del mensaje: {message}")      
+    def check_message_safety(self, message: str, pending: Optional[Dict[str, Future]] = None):
+        logging.info("Verificando seguridad del mensaje: %s", message)
         # Verificar inyección de código (no requiere API externa, es rápido)
         detect_code_injection_result = self.detect_code_injection(message)
-        logging.info(f"Verificando inyección de código: {detect_code_injection_result}")
+        logging.info("Verificando inyección de código: %s", detect_code_injection_result)
         if detect_code_injection_result:
+            _cancel_checks(pending)
             return {
                 "type": "code_injection",
-                "message": "MENSAJE INVÁLIDO: Se ha detectado un posible intento de inyección de código en el mensaje."
+                "message": CODE_INJECTION_MESSAGE
             }
 
+        normalized = _normalize(message)
+        if normalized in _SAFE_MESSAGES:
+            logging.info("Mensaje ya verificado como seguro")
+            _cancel_checks(pending)
+            return None
+
+        futures = pending or self.start_remote_checks(message)
+        if not futures:
+            # Otro request lo marcó como seguro entre la revisión de arriba y el
+            # lanzamiento (la inyección ya se descartó): no hay nada que esperar
+            logging.info("Mensaje ya verificado como seguro")
+            return None
+        deadline = time.monotonic() + _CHECK_TIMEOUT
+
+        def remaining() -> float:
+            return max(0.0, deadline - time.monotonic())
+
         try:
             # Verificar seguridad de contenido
-            content_safety_result = self.check_content_safety(message)
-            logging.info(f"Verificando seguridad de contenido: {content_safety_result}")
+            content_safety_result = self._wait(futures["content_safety"], "check_content_safety", remaining(), None)
+            logging.info("Verificando seguridad de contenido: %s", content_safety_result)
             
             # Check allowlist for machinery/business terms that trigger false positives
             allowed_terms = [
@@ -185,7 +441,7 @@ class ContentSafetyGuardrails:
 
             if content_safety_result:
                 if is_allowed:
-                    logging.warning(f"⚠️ Contenido marcado como inseguro pero permitido por lista blanca: {message}")
+                    logging.warning("⚠️ Contenido marcado como inseguro pero permitido por lista blanca: %s", message)
                 else:
                     return {
                         "type": "content_safety", 
@@ -193,8 +449,8 @@ class ContentSafetyGuardrails:
                     }
             
             # Verificar ataques de groundness
-            groundness_result = self.detect_groundness_result(message)
-            logging.info(f"Verificando ataques de groundness: {groundness_result}")
+            groundness_result = self._wait(futures["groundness"], "detect_groundness_result", remaining(), None)
+            logging.info("Verificando ataques de groundness: %s", groundness_result)
             if groundness_result:
                 return {
                     "type": "groundness", 
@@ -202,8 +458,10 @@ class ContentSafetyGuardrails:
                 }
             
             # Verificar seguridad de conversación
-            conversation_safety_result = self.check_conversation_safety(message)
-            logging.info(f"Verificando seguridad de conversación: {conversation_safety_result}")
+            # None si el clasificador falló: se deja pasar (fail-open), pero no
+            # cuenta como resultado definitivo para _SAFE_MESSAGES
+            conversation_safety_result = self._wait(futures["invalid_conversation"], "check_conversation_safety", remaining(), None)
+            logging.info("Verificando seguridad de conversación: %s", conversation_safety_result)
             if conversation_safety_result:
                 return {
                     "type": "invalid_conversation",
@@ -213,14 +471,34 @@ class ContentSafetyGuardrails:
         except TimeoutError:
             # Si CUALQUIERA de las funciones dentro del 'try' lanza un TimeoutError,
             # este bloque lo capturará y devolverá el JSON correcto.
-            logging.info(f"Timeout del mensaje")
+            logging.info("Timeout del mensaje")
             return {
                 "type": "timeout",
                 "message": "MENSAJE INVÁLIDO: El análisis de seguridad excedió el tiempo límite."
             }
-        
+
+        finally:
+            # Con el veredicto decidido, las verificaciones que aún no arrancan
+            # ya no hacen falta (las que están en curso no se pueden detener).
+            _cancel_checks(futures)
+
+        if None not in (content_safety_result, groundness_result, conversation_safety_result):
+            _SAFE_MESSAGES.set(normalized, True)
         return None
 
+
+# Una sola instancia por worker: el bot se crea en cada request, pero los
+# guardrails no tienen estado por request y sus clientes y cachés son del módulo.
+_guardrails_instance: Optional[ContentSafetyGuardrails] = None
+
+
+def get_guardrails() -> ContentSafetyGuardrails:
+    """Obtiene la instancia compartida de ContentSafetyGuardrails."""
+    global _guardrails_instance
+    if _guardrails_instance is None:
+        _guardrails_instance = ContentSafetyGuardrails()
+    return _guardrails_instance
+
 """
 # TESTING
 if __name__ == "__main__":
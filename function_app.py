@@ -7,12 +7,20 @@ Azure Function para procesar webhooks de WhatsApp
 import azure.functions as func
 import logging
 import os
-import json
+import threading
+import time
+import json_utils
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, Optional
 from whatsapp_bot import WhatsAppBot
-from state_management import InMemoryStateStore, CosmosDBStateStore
+from check_guardrails import ContentSafetyGuardrails, get_guardrails
+from check_conversation import clasificar_mensaje
+from state_management import InMemoryStateStore, CosmosDBStateStore, message_epoch, recent_message_ids
+from bounded_cache import BoundedCache
 from azure.cosmos import CosmosClient
-from datetime import datetime, timezone, timedelta
 from hubspot_manager import HubSpotManager
+from maquinaria_config import machinery_config_service
 
 # Silencia solo los logs detallados del SDK de Azure Cosmos y del pipeline HTTP
 logging.getLogger("azure.cosmos").setLevel(logging.ERROR)
@@ -20,8 +28,65 @@ logging.getLogger("azure.core.pipeline.policies.http_logging_policy").setLevel(l
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
 
+# Configuración que no cambia durante la vida del worker: se lee una sola vez.
+_VERIFY_TOKEN = os.environ.get("VERIFY_TOKEN")
+_COSMOS_CONNECTION_STRING = os.environ.get("COSMOS_CONNECTION_STRING")
+_COSMOS_DB_NAME = os.environ.get("COSMOS_DB_NAME")
+_COSMOS_CONTAINER_NAME = os.environ.get("COSMOS_CONTAINER_NAME")
+_HUBSPOT_ACCESS_TOKEN = os.environ.get("HUBSPOT_ACCESS_TOKEN")
+
+# Cada cuánto se recarga de Cosmos la configuración de maquinaria (segundos)
+_MACHINERY_CONFIG_TTL_SECONDS = 5 * 60
+_machinery_config_loaded_at: Optional[float] = None
+_machinery_config_lock = threading.Lock()
+
+# Tiempo sin mensajes del agente (segundos) para regresar la conversación al bot
+_AGENT_TIMEOUT_SECONDS = 30 * 60
+
+# Ids de mensajes de WhatsApp ya recibidos por este worker. WhatsApp reenvía el
+# webhook cuando la respuesta tarda (p. ej. un guardrail lento), y el reenvío
+# suele llegar mientras el original todavía se procesa, cuando el mensaje aún
+# no está en Cosmos. Se revisa antes de cargar la conversación.
+_SEEN_MESSAGE_IDS = BoundedCache(maxsize=10000, ttl=24 * 60 * 60)
+
+# Con PROCESS_MESSAGES_IN_QUEUE=1 el webhook solo encola el mensaje y responde
+# 200 de inmediato; process_queued_message hace el trabajo (guardrails, LLM,
+# HubSpot y el envío). WhatsApp reenvía el webhook si la respuesta tarda, y el
+# procesamiento completo tarda varios segundos. Apagado por defecto.
+_QUEUE_MESSAGES = os.environ.get("PROCESS_MESSAGES_IN_QUEUE") == "1"
+_INBOUND_QUEUE = "wa-inbound"
+
+
+@lru_cache(maxsize=1)
+def _get_cosmos_client() -> CosmosClient:
+    """
+    Cliente de Cosmos compartido por el worker. Crearlo en cada request repetía
+    la inicialización de autenticación y tiraba el pool de conexiones HTTP.
+    Si la creación falla no se cachea y se reintenta en el siguiente request.
+    """
+    return CosmosClient.from_connection_string(_COSMOS_CONNECTION_STRING)
+
+
+@app.warmup_trigger(arg_name="warmupContext")
+def warmup(warmupContext: func.Context) -> None:
+    """
+    Corre cuando el host levanta una instancia nueva, antes de mandarle tráfico.
+    Crea los clientes del worker y hace una clasificación de dominio para que
+    el primer mensaje de un lead no pague el arranque en frío (conexión TLS con
+    Foundry y Cosmos incluidas). Un error aquí no impide que la instancia arranque.
+    """
+    try:
+        get_guardrails()
+        if _COSMOS_CONNECTION_STRING is not None and _COSMOS_DB_NAME is not None:
+            _ensure_machinery_config(_get_cosmos_client(), _COSMOS_DB_NAME)
+        clasificar_mensaje("warmup")
+        logging.info("Instancia precalentada")
+    except Exception as e:
+        logging.error(f"Error precalentando la instancia: {e}")
+
 @app.route(route="whatsappbot1")
-def whatsappbot1(req: func.HttpRequest) -> func.HttpResponse:
+@app.queue_output(arg_name="inbound_queue", queue_name=_INBOUND_QUEUE, connection="AzureWebJobsStorage")
+def whatsappbot1(req: func.HttpRequest, inbound_queue: func.Out[str]) -> func.HttpResponse:
     """
     Main Azure Function entry point for WhatsApp webhook.
     Handles both GET (verification) and POST (message) requests.
@@ -30,7 +95,7 @@ def whatsappbot1(req: func.HttpRequest) -> func.HttpResponse:
     logging.info(f"req.method: {req.method}")
 
     if req.method == 'POST':
-        return handle_message(req)
+        return handle_message(req, inbound_queue)
     else:
         return verify(req)
 
@@ -40,13 +105,12 @@ def verify(req):
     This is called when you first set up the webhook in Meta Developer Console.
     """
 
-    verify_token = os.environ["VERIFY_TOKEN"]
+    verify_token = _VERIFY_TOKEN
 
     # Parse params from the webhook verification request
     mode = req.params.get("hub.mode")
     token = req.params.get("hub.verify_token")
     challenge = req.params.get("hub.challenge")
-    # logging.info(f"mode: {mode}, token: {token}, challenge: {challenge}")
 
     # Check if a token and mode were sent
     if mode and token:
@@ -64,6 +128,24 @@ def verify(req):
         logging.info("MISSING_PARAMETER")
         return func.HttpResponse("Missing parameters", status_code=400)
     
+def _ensure_machinery_config(cosmos_client, db_name) -> None:
+    """
+    Inicializa machinery_config_service con el cliente de Cosmos. Antes se
+    reinicializaba en cada request, leyendo el contenedor completo de
+    configuración; ahora se recarga como máximo cada
+    _MACHINERY_CONFIG_TTL_SECONDS, así los cambios hechos desde la web se siguen
+    reflejando sin reiniciar la app.
+    """
+    global _machinery_config_loaded_at
+    if _machinery_config_loaded_at is not None and time.monotonic() - _machinery_config_loaded_at < _MACHINERY_CONFIG_TTL_SECONDS:
+        return
+    with _machinery_config_lock:
+        # Otro request pudo recargarla mientras se esperaba el lock
+        if _machinery_config_loaded_at is not None and time.monotonic() - _machinery_config_loaded_at < _MACHINERY_CONFIG_TTL_SECONDS:
+            return
+        machinery_config_service.__init__(cosmos_client, db_name)
+        _machinery_config_loaded_at = time.monotonic()
+
 def create_whatsapp_bot() -> WhatsAppBot:
     """
     Factory method para crear una instancia fresca de WhatsAppBot por request.
@@ -77,15 +159,15 @@ def create_whatsapp_bot() -> WhatsAppBot:
         cosmos_client = None
         db_name = None
         
-        # Reusar el cliente si ya se creó en create_state_store (mejora: optimizar esto)
+        # Reusar el cliente del state store (es el mismo cliente del worker)
         if isinstance(state_store, CosmosDBStateStore):
             cosmos_client = state_store.cosmos_client
             db_name = state_store.database_name
-        elif all(key in os.environ for key in ["COSMOS_CONNECTION_STRING", "COSMOS_DB_NAME"]):
+        elif _COSMOS_CONNECTION_STRING is not None and _COSMOS_DB_NAME is not None:
              # Si no estamos usando CosmosDBStateStore pero queremos cargar datos de DB (ej: desarrollo local)
              try:
-                cosmos_client = CosmosClient.from_connection_string(os.environ["COSMOS_CONNECTION_STRING"])
-                db_name = os.environ["COSMOS_DB_NAME"]
+                cosmos_client = _get_cosmos_client()
+                db_name = _COSMOS_DB_NAME
              except Exception:
                  pass
 
@@ -93,10 +175,7 @@ def create_whatsapp_bot() -> WhatsAppBot:
         
         # IMPORTANTE: Aquí actualizamos las instancias globales que usan machinery_config_service e inventory_service
         # Esto es un patrón temporal hasta que WhatsAppBot acepte inyección de dependencias completa
-        from maquinaria_config import machinery_config_service
-        
-        # Re-inicializar servicios con el cliente
-        machinery_config_service.__init__(cosmos_client, db_name)
+        _ensure_machinery_config(cosmos_client, db_name)
         
         # Nota: InventoryService se instancia dentro de IntelligentResponseGenerator usualmente, 
         # pero para que use la DB necesitamos pasarle el cliente.
@@ -122,13 +201,12 @@ def create_state_store():
     """
     try:
         # Intentar usar Cosmos DB si las variables de entorno están configuradas
-        if all(key in os.environ for key in ["COSMOS_CONNECTION_STRING", "COSMOS_DB_NAME", "COSMOS_CONTAINER_NAME"]):
-            cosmos_client = CosmosClient.from_connection_string(os.environ["COSMOS_CONNECTION_STRING"])
-            db_name = os.environ["COSMOS_DB_NAME"]
-            container_name = os.environ["COSMOS_CONTAINER_NAME"]
-            
+        if None not in (_COSMOS_CONNECTION_STRING, _COSMOS_DB_NAME, _COSMOS_CONTAINER_NAME):
+            # El store se crea por request (es barato: solo referencias al
+            # contenedor) porque sus snapshots solo valen dentro del request:
+            # la web escribe los mensajes del agente directo en Cosmos.
             logging.info("Usando CosmosDBStateStore para producción")
-            return CosmosDBStateStore(cosmos_client, db_name, container_name)
+            return CosmosDBStateStore(_get_cosmos_client(), _COSMOS_DB_NAME, _COSMOS_CONTAINER_NAME)
         else:
             # Fallback a InMemoryStateStore para desarrollo
             logging.info("Usando InMemoryStateStore para desarrollo")
@@ -138,58 +216,136 @@ def create_state_store():
         logging.warning(f"Error configurando Cosmos DB, usando InMemoryStateStore: {e}")
         return InMemoryStateStore()
 
-def is_valid_whatsapp_message(body):
+@dataclass(frozen=True)
+class InboundMessage:
+    """Mensaje entrante de WhatsApp, extraído del webhook una sola vez."""
+
+    wa_id: str                  # wa_id del lead (contacts[0])
+    phone_number: str           # Número de WhatsApp del lead empezando por 521
+    message_id: str             # id del mensaje asignado por WhatsApp
+    msg_type: str               # "text", "image", "audio", ...
+    text: Optional[str]         # Cuerpo del mensaje si es de texto
+    details: Dict[str, Any]     # El mensaje completo (lo usa el flujo multimedia)
+
+
+def _webhook_value(body) -> Optional[Dict[str, Any]]:
     """
-    Check if the incoming webhook event has a valid WhatsApp message structure.
+    `entry[0].changes[0].value` del webhook, recorrido una sola vez: ahí vienen
+    tanto los mensajes como las actualizaciones de estado. None si el evento
+    no tiene esa estructura (ej. no es de WhatsApp).
     """
-    return (
-        body.get("object")
-        and body.get("entry")
-        and body["entry"][0].get("changes")
-        and body["entry"][0]["changes"][0].get("value")
-        and body["entry"][0]["changes"][0]["value"].get("messages")
-        and body["entry"][0]["changes"][0]["value"]["messages"][0]
+    if not isinstance(body, dict) or not body.get("object"):
+        return None
+    try:
+        value = body["entry"][0]["changes"][0]["value"]
+    except (KeyError, IndexError, TypeError):
+        return None
+    return value if isinstance(value, dict) else None
+
+
+def _inbound_from_value(value: Optional[Dict[str, Any]]) -> Optional[InboundMessage]:
+    """Extrae el mensaje del `value` de un webhook; None si no trae un mensaje."""
+    if value is None:
+        return None
+    try:
+        message = value["messages"][0]
+        wa_id = value["contacts"][0]["wa_id"]
+    except (KeyError, IndexError, TypeError):
+        return None
+    if not message:
+        return None
+
+    return InboundMessage(
+        wa_id=wa_id,
+        phone_number=message.get("from", ""),
+        message_id=message.get("id", ""),
+        msg_type=message.get("type", ""),
+        text=message["text"].get("body") if "text" in message else None,
+        details=message,
     )
+
+
+def parse_inbound(body) -> Optional[InboundMessage]:
+    """
+    Extrae el mensaje de un webhook de WhatsApp. Regresa None si el evento no
+    tiene la estructura de un mensaje (ej. no es de WhatsApp).
+    """
+    return _inbound_from_value(_webhook_value(body))
     
-def handle_message(req):
+def handle_message(req, inbound_queue: Optional[func.Out] = None):
     """
     Handles incoming WhatsApp messages (POST requests).
     Processes the message and sends appropriate responses.
     """
 
-    body = req.get_json()
-    logging.info(f"request body: {body}")
+    raw_body = req.get_body()
+
+    # La mayoría de los webhooks son actualizaciones de estado (enviado,
+    # entregado, leído) que se ignoran: se descartan sin parsear el JSON.
+    if b'"statuses"' in raw_body and b'"messages"' not in raw_body:
+        logging.info("Received a WhatsApp status update.")
+        return func.HttpResponse("OK", status_code=200)
+
+    # json_utils usa orjson si está instalado: el payload de WhatsApp es el
+    # trabajo de CPU más grande de esta función fuera de las llamadas de red.
+    try:
+        body = json_utils.loads(raw_body)
+    except json_utils.JSONDecodeError:
+        logging.error("Failed to decode JSON")
+        return func.HttpResponse("Invalid JSON provided", status_code=400)
+    # El cuerpo completo solo se formatea si el nivel DEBUG está activo; en
+    # producción (Information en host.json) no se paga su repr en cada request
+    logging.debug("request body: %r", body)
+
+    value = _webhook_value(body)
 
     # Check if it's a WhatsApp status update (ignore these)
-    if (
-        body.get("entry", [{}])[0]
-        .get("changes", [{}])[0]
-        .get("value", {})
-        .get("statuses")
-    ):
+    if value is not None and value.get("statuses"):
         logging.info("Received a WhatsApp status update.")
         return func.HttpResponse("OK", status_code=200)
 
     try:
-        if is_valid_whatsapp_message(body):
+        inbound = _inbound_from_value(value)
+        if inbound is not None:
+            if _QUEUE_MESSAGES and inbound_queue is not None:
+                inbound_queue.set(json_utils.dumps(body))
+                logging.info(f"Mensaje {inbound.message_id} encolado")
+                return func.HttpResponse("OK", status_code=200)
+
             # Crear instancia fresca del bot para este request
             whatsapp_bot = create_whatsapp_bot()
-            process_whatsapp_message(body, whatsapp_bot)
+            process_whatsapp_message(inbound, whatsapp_bot)
 
             return func.HttpResponse("OK", status_code=200)
         else:
             # if the request is not a WhatsApp API event, return an error
             logging.error("Not a WhatsApp API event")
             return func.HttpResponse("Not a WhatsApp API event", status_code=404)
-    except json.JSONDecodeError:
+    except json_utils.JSONDecodeError:
         logging.error("Failed to decode JSON")
         return func.HttpResponse("Invalid JSON provided", status_code=400)
 
+@app.queue_trigger(arg_name="queued", queue_name=_INBOUND_QUEUE, connection="AzureWebJobsStorage")
+def process_queued_message(queued: func.QueueMessage) -> None:
+    """
+    Procesa un webhook de WhatsApp encolado por handle_message (ver
+    _QUEUE_MESSAGES). Hace lo mismo que el camino síncrono del webhook.
+    """
+    inbound = parse_inbound(json_utils.loads(queued.get_body()))
+    if inbound is None:
+        logging.error("Mensaje encolado sin un evento de WhatsApp válido")
+        return
+
+    whatsapp_bot = create_whatsapp_bot()
+    process_whatsapp_message(inbound, whatsapp_bot)
+
 def check_agent_timeout(wa_id: str, whatsapp_bot: WhatsAppBot) -> bool:
     """
     Verifica si han pasado 30 minutos desde el último mensaje del agente.
     Si es así, cambia el modo de conversación de vuelta a 'bot'.
     Retorna True si se cambió el modo, False si no.
+    Solo modifica el estado en memoria: el guardado que hace el chatbot al
+    procesar el mensaje escribe el cambio de modo junto con los mensajes nuevos.
     """
     try:
         current_state = whatsapp_bot.chatbot.state
@@ -198,33 +354,28 @@ def check_agent_timeout(wa_id: str, whatsapp_bot: WhatsAppBot) -> bool:
         if current_state.get("conversation_mode") != "agente":
             return False
         
-        # Buscar el último mensaje del agente
-        last_agent_message_time = None
+        # Hora del último mensaje del agente. CosmosDBStateStore ya la calculó
+        # al cargar; para otros stores se busca en el historial.
+        last_agent_ts = current_state.get("last_agent_ts")
+        if last_agent_ts is None:
+            for msg in reversed(current_state.get("messages", [])):
+                if msg.get("sender") == "agente":
+                    last_agent_ts = message_epoch(msg)
+                    break
         
-        for msg in reversed(current_state.get("messages", [])):
-            if msg.get("sender") == "agente":
-                last_agent_message_time = msg.get("timestamp")
-                break
-        
-        if not last_agent_message_time:
-            # No hay mensajes del agente, pero mantenemos el modo agente
+        if last_agent_ts is None:
+            # No hay mensajes del agente, pero mantenemos el modo agente: el
+            # modo no cambió, así que no hay nada que guardar
             logging.info(f"Modo mantenido en 'agente' para {wa_id} (no hay mensajes de agente)")
-            return True
+            return False
         
-        # Verificar si han pasado 30 minutos
-        try:
-            last_time = datetime.fromisoformat(last_agent_message_time.replace('Z', '+00:00'))
-            now = datetime.now(timezone.utc)
-            time_diff = now - last_time
-            
-            if time_diff > timedelta(minutes=30):
-                current_state["conversation_mode"] = "bot"
-                whatsapp_bot.chatbot.save_conversation()
-                logging.info(f"Modo cambiado a 'bot' para {wa_id} (timeout de 30 minutos)")
-                return True
-                
-        except Exception as e:
-            logging.error(f"Error parseando timestamp: {e}")
+        # Verificar si han pasado 30 minutos. Si el mensaje no llega a
+        # guardarse (reset, status, rechazo), el timeout se vuelve a detectar
+        # en el siguiente mensaje.
+        if time.time() - last_agent_ts > _AGENT_TIMEOUT_SECONDS:
+            current_state["conversation_mode"] = "bot"
+            logging.info(f"Modo cambiado a 'bot' para {wa_id} (timeout de 30 minutos)")
+            return True
             
         return False
         
@@ -248,7 +399,7 @@ def process_multimedia_message(wa_id: str, message_details: dict, whatsapp_bot:
         message_id = message_details.get("id")
 
         multimedia_details = message_details.get(message_type, {})
-        logging.info(f"Detalles del mensaje multimedia: {message_details}")
+        logging.debug("Detalles del mensaje multimedia: %s", message_details)
 
         multimedia_id = multimedia_details.get("id")
         multimedia["multimedia_id"] = multimedia_id
@@ -261,17 +412,14 @@ def process_multimedia_message(wa_id: str, message_details: dict, whatsapp_bot:
         logging.error(f"Error procesando mensaje multimedia: {e}")
         return func.HttpResponse("Internal server error", status_code=500)
         
-def process_whatsapp_message(body, whatsapp_bot: WhatsAppBot):
+def process_whatsapp_message(inbound: InboundMessage, whatsapp_bot: WhatsAppBot):
     """
     Processes the WhatsApp message and sends appropriate response.
     Uses the conversation manager and WhatsApp bot for intelligent responses.
     """
     try:
-        message_info = body["entry"][0]["changes"][0]["value"]
-
-        # Extraer el wa_id del lead
-        wa_id = message_info["contacts"][0]["wa_id"]
-        logging.info(f"wa_id del lead: {wa_id}")
+        wa_id = inbound.wa_id
+        logging.info("wa_id del lead: %s", wa_id)
 
         # Verificar que quien manda el mensaje esté autorizado
         # TODO: Eliminar en producción
@@ -280,38 +428,65 @@ def process_whatsapp_message(body, whatsapp_bot: WhatsAppBot):
             logging.error("Unauthorized user!!!")
             return
 
-        # Extraer el contenido del mensaje
-        message_details = message_info["messages"][0]
-        logging.info(f"Detalles del mensaje: {message_details}")
-        phone_number = message_details["from"] # Número de WhatsApp del lead empezando por 521
+        logging.debug("Detalles del mensaje: %s", inbound.details)
+        phone_number = inbound.phone_number
+
+        if inbound.message_id and not _SEEN_MESSAGE_IDS.add(inbound.message_id):
+            logging.info(f"Mensaje duplicado detectado: {inbound.message_id}")
+            return
+
+        # Duplicado que llegó a otro worker: basta con los ids de los últimos
+        # mensajes, sin cargar (ni deserializar) la conversación completa
+        state_store = whatsapp_bot.state_store
+        if inbound.text is not None and isinstance(state_store, CosmosDBStateStore):
+            if inbound.message_id in state_store.peek_last_message_ids(wa_id):
+                logging.info(f"Mensaje duplicado detectado: {inbound.message_id}")
+                return
+
+        # La inyección de código se detecta localmente: se rechaza aquí, antes
+        # de cargar la conversación o llamar a Content Safety. El marcador y la
+        # respuesta se agregan al historial con un patch (va después del peek
+        # para que un reenvío del mismo mensaje a otro worker se detecte).
+        if inbound.text is not None and ContentSafetyGuardrails.detect_code_injection(inbound.text):
+            logging.warning(f"Posible inyección de código de {wa_id}, mensaje rechazado")
+            whatsapp_bot.reject_code_injection(wa_id, inbound.message_id)
+            return
+
+        # Las verificaciones de seguridad no dependen de la conversación: se
+        # lanzan antes de cargarla para que la lectura de Cosmos corra en
+        # paralelo. Los comandos reset y status no pasan por los guardrails.
+        safety_checks = None
+        if inbound.text is not None and inbound.text.lower() not in ("reset", "status"):
+            safety_checks = whatsapp_bot.guardrails.start_remote_checks(inbound.text)
 
         # Cargar conversación
         whatsapp_bot.chatbot.load_conversation(wa_id)
 
         logging.info(f"Conversación cargada para usuario {wa_id}")
 
-        if "text" in message_details:
-            # Extraer el contenido en texto del mensaje
-            message_text = message_details["text"]["body"]
-            # Extraer el id del mensaje asignado por WhatsApp
-            whatsapp_message_id = message_details["id"]
+        if inbound.text is not None:
+            message_text = inbound.text
+            whatsapp_message_id = inbound.message_id
 
             # Actualizar número de WhatsApp en estado si no se ha guardado
             # Esto solo se ejecuta cuando se inicia una conversación
             current_state = whatsapp_bot.chatbot.state
 
-            # Verificar que en los ids de los últimos 3 mensajes no esté el id del mensaje actual
-            # Esto es para evitar procesar mensajes duplicados
+            # Verificar que en los ids de los últimos mensajes no esté el id del mensaje actual
+            # Esto es para evitar procesar mensajes duplicados que llegaron a otro worker
             # En algunas ocasiones, WhatsApp envía mensajes duplicados (parece que cuando un guardrail se tarda en procesar, envía el mismo mensaje duplicado)
-            last_3_messages = current_state.get("messages", [])[-3:]
-            if whatsapp_message_id in [msg.get("whatsapp_message_id") for msg in last_3_messages]:
+            # CosmosDBStateStore arma el set al cargar; para otros stores se calcula aquí
+            recent_ids = current_state.get("recent_message_ids")
+            if recent_ids is None:
+                recent_ids = recent_message_ids(current_state.get("messages", []))
+            if whatsapp_message_id in recent_ids:
                 logging.info(f"Mensaje duplicado detectado: {whatsapp_message_id}")
                 return
 
             logging.info(f"Mensaje duplicado no detectado: {whatsapp_message_id}")
 
             # Crear instancia de HubSpotManager
-            hubspot_manager = HubSpotManager(os.environ["HUBSPOT_ACCESS_TOKEN"])
+            hubspot_manager = HubSpotManager(_HUBSPOT_ACCESS_TOKEN)
 
             logging.info(f"HubSpotManager creado para usuario {wa_id}")
 
@@ -334,13 +509,13 @@ def process_whatsapp_message(body, whatsapp_bot: WhatsAppBot):
 
             # Ejecutar slot-filling usando el contexto del último mensaje (agente o bot)
             # Ahora el chatbot envía automáticamente las respuestas por WhatsApp
-            whatsapp_bot.process_message(wa_id, message_text, whatsapp_message_id, hubspot_manager)
+            whatsapp_bot.process_message(wa_id, message_text, whatsapp_message_id, hubspot_manager, safety_checks)
             
         else:
             # TODO: Esto se debería registrar en Cosmos DB
             # Handle non-text messages with a help message
             logging.info(f"Message Type: NON-TEXT")
-            process_multimedia_message(wa_id, message_details, whatsapp_bot)
+            process_multimedia_message(wa_id, inbound.details, whatsapp_bot)
 
     except Exception as e:
         logging.error(f"Error procesando mensaje: {e}")
@@ -362,7 +537,7 @@ def agent_message(req: func.HttpRequest) -> func.HttpResponse:
             return func.HttpResponse("Method not allowed", status_code=405)
         
         # Obtener datos del request
-        body = req.get_json()
+        body = json_utils.loads(req.get_body())
         if not body:
             return func.HttpResponse("Invalid JSON", status_code=400)
         
@@ -411,7 +586,7 @@ def start_bot_mode(req: func.HttpRequest) -> func.HttpResponse:
             return func.HttpResponse("Method not allowed", status_code=405)
         
         # Obtener datos del request
-        body = req.get_json()
+        body = json_utils.loads(req.get_body())
         if not body:
             return func.HttpResponse("Invalid JSON", status_code=400)
         
@@ -430,21 +605,21 @@ def start_bot_mode(req: func.HttpRequest) -> func.HttpResponse:
         
         if response:
             logging.info(f"Respuesta generada para {wa_id}: {response}")
-            return func.HttpResponse(json.dumps({
+            return func.HttpResponse(json_utils.dumps({
                 "success": True,
                 "message": "Bot mode activated and response generated",
                 "response": response
             }), status_code=200, mimetype="application/json")
         else:
             logging.info(f"No se generó respuesta para {wa_id} - último mensaje no es del lead")
-            return func.HttpResponse(json.dumps({
+            return func.HttpResponse(json_utils.dumps({
                 "success": False,
                 "message": "No response generated - last message was not from lead"
             }), status_code=200, mimetype="application/json")
             
     except Exception as e:
         logging.error(f"Error en endpoint start-bot-mode: {e}")
-        return func.HttpResponse(json.dumps({
+        return func.HttpResponse(json_utils.dumps({
             "success": False,
             "message": "Internal server error",
             "error": str(e)
@@ -463,7 +638,7 @@ def new_lead_form(req: func.HttpRequest) -> func.HttpResponse:
             return func.HttpResponse("Method not allowed", status_code=405)
         
         # Obtener datos del request
-        body = req.get_json()
+        body = json_utils.loads(req.get_body())
         if not body:
             return func.HttpResponse("Invalid JSON", status_code=400)
         
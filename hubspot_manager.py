@@ -3,10 +3,62 @@ Integración con HubSpot CRM
 """
 
 import requests
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from typing import Dict, Optional
 import logging
-import json
+import json_utils
 from maquinaria_config import machinery_config_service
+from bounded_cache import BoundedCache
+
+# Sesión HTTP compartida por el worker: HubSpotManager se crea en cada mensaje,
+# y con requests.post/patch sueltos cada llamada abría una conexión TLS nueva
+# con api.hubapi.com. Se reintentan 429 y 5xx de gateway con backoff solo en los
+# métodos idempotentes: los default de Retry (incluye DELETE) más PATCH, que
+# aquí solo fija propiedades y repetirlo deja el mismo resultado. POST queda
+# fuera: un POST repetido puede crear el contacto dos veces.
+_HTTP_SESSION = requests.Session()
+_HTTP_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(
+            total=2,
+            backoff_factor=0.2,
+            status_forcelist=(429, 502, 503, 504),
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"PATCH"},
+            raise_on_status=False,
+        ),
+    ),
+)
+# Headers que no dependen del token. requests ya pide gzip y mantiene la
+# conexión abierta por default; se fijan aquí para que no dependan de esa
+# default y para que cada llamada solo agregue el Authorization.
+_HTTP_SESSION.headers.update({
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+    "Accept-Encoding": "gzip, deflate",
+    "Connection": "keep-alive",
+})
+# (conexión, lectura) en segundos. Sin timeout, una llamada colgada a HubSpot
+# dejaba esperando al webhook indefinidamente.
+_TIMEOUT = (3, 10)
+
+# Endpoint de contactos de la API v3 de HubSpot
+_CONTACTS_URL = "https://api.hubapi.com/crm/v3/objects/contacts"
+_UPSERT_URL = _CONTACTS_URL + "/batch/upsert"
+# batch/upsert por id_conversacion_bot requiere que esa propiedad sea de valor
+# único en HubSpot. Si HubSpot la rechaza (400), el worker deja de intentarlo
+# y usa el create normal, para no pagar dos llamadas en cada lead nuevo.
+_UPSERT_ID_PROPERTY = "id_conversacion_bot"
+_upsert_supported = True
+
+# contact_id -> últimas propiedades que este worker dejó en HubSpot.
+# detalles_maquinaria y apellido se reenvían en cada mensaje que los extrae
+# aunque el texto no cambie; con esto solo viaja lo que sí cambió.
+_SENT_PROPERTIES = BoundedCache(maxsize=2048)
 
 # Lista de productos de interés registrados en HubSpot
 PRODUCTO_INTERESADO = [
@@ -87,20 +139,86 @@ ESTADOS = [
   "Zacatecas"
 ]
 
+# Las listas conservan el orden (el valor por default es el primero); la
+# validación de cada valor extraído usa estos sets
+_GIRO_EMPRESA_SET = frozenset(GIRO_EMPRESA)
+_ESTADOS_SET = frozenset(ESTADOS)
+
+# tipo de maquinaria -> (preguntas de las que se armaron, prefijos "<pregunta> Respuesta: ")
+# Las preguntas son el dict memoizado de machinery_config_service: si la
+# configuración se recarga llega un dict nuevo y los prefijos se rearman.
+_ANSWER_PREFIXES: Dict[str, tuple] = {}
+
+
+def _answer_prefixes(tipo_maquinaria: str) -> Optional[Dict[str, str]]:
+    """Prefijo de respuesta de cada campo de un tipo, o None si el tipo no existe."""
+    questions = machinery_config_service.get_field_questions(tipo_maquinaria)
+    if questions is None:
+        return None
+    cached = _ANSWER_PREFIXES.get(tipo_maquinaria)
+    if cached is not None and cached[0] is questions:
+        return cached[1]
+    prefixes = {name: f"{question} Respuesta: " for name, question in questions.items() if question}
+    _ANSWER_PREFIXES[tipo_maquinaria] = (questions, prefixes)
+    return prefixes
+
+
+_UNSET = object()
+
+
+def _error_message(response: requests.Response) -> str:
+    """Mensaje de error de una respuesta de HubSpot ("" si no trae uno legible)."""
+    try:
+        return str(response.json().get("message", ""))
+    except Exception:
+        return ""
+
+
 class TokenExpired(Exception):
     pass
 
+
+@lru_cache(maxsize=4)
+def _auth_headers(access_token: str) -> Dict[str, str]:
+    """
+    Header de autenticación de la API de HubSpot, armado una vez por token y
+    compartido por todos los HubSpotManager del worker. Los demás headers
+    viven en _HTTP_SESSION. No se deben modificar.
+    """
+    return {"Authorization": f"Bearer {access_token}"}
+
+
 class HubSpotManager:
+    # Se crea uno por mensaje porque contact_id es del lead que se está
+    # atendiendo; lo que sí se comparte entre requests (sesión HTTP, headers,
+    # últimas propiedades enviadas) vive a nivel de módulo.
     def __init__(self, access_token: str):
         self.access_token = access_token
-        self.url = "https://api.hubapi.com/crm/v3/objects/contacts"
-        self.headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"
-        }
+        self.url = _CONTACTS_URL
+        self.headers = _auth_headers(access_token)
 
         self.contact_id = None
 
+    def _contact_url(self) -> str:
+        return f"{_CONTACTS_URL}/{self.contact_id}"
+
+    def _request(self, method: str, url: str, body: Optional[Dict] = None) -> requests.Response:
+        """
+        Llamada a la API de HubSpot con la sesión, los headers y el timeout
+        compartidos. Un 401 no se reintenta: el token es estático (private app),
+        así que solo se reporta para que se note que hay que rotarlo.
+        """
+        response = _HTTP_SESSION.request(
+            method,
+            url,
+            headers=self.headers,
+            data=json_utils.dumps_bytes(body) if body is not None else None,
+            timeout=_TIMEOUT
+        )
+        if response.status_code == 401:
+            logging.error("HubSpot rechazó el token (401): revisar HUBSPOT_ACCESS_TOKEN")
+        return response
+
     def create_contact(self, wa_id: str, telefono: str) -> Optional[str]:
         """Crea un contacto en HubSpot"""
         try:
@@ -115,19 +233,53 @@ class HubSpotManager:
             logging.info("Creando nuevo contacto en HubSpot")
 
             # Retornar el id del contacto creado
+            if _upsert_supported:
+                self.contact_id = self._upsert_contact(properties)
+                # Solo se recurre al create si el upsert quedó desactivado; un
+                # error de este contacto (p. ej. un correo inválido) se repetiría
+                if self.contact_id is not None or _upsert_supported:
+                    return self.contact_id
             self.contact_id = self._create_contact(properties)
             return self.contact_id
         except Exception as e:
             logging.error(f"Error en HubSpot: {e}")
             return None
     
+    def _upsert_contact(self, properties: Dict) -> Optional[str]:
+        """
+        Crea el contacto, o regresa el que ya tiene el mismo id_conversacion_bot,
+        en una sola llamada. A diferencia del create, repetirlo (reintento o
+        webhook duplicado en otro worker) no crea un contacto duplicado.
+        Regresa None si HubSpot no aceptó el upsert. Solo un 400 sobre
+        id_conversacion_bot como idProperty (la propiedad no es de valor único)
+        desactiva el upsert para el worker; cualquier otro error es de este
+        contacto.
+        """
+        global _upsert_supported
+        upsert_input = {
+            "idProperty": _UPSERT_ID_PROPERTY,
+            "id": properties[_UPSERT_ID_PROPERTY],
+            "properties": {k: v for k, v in properties.items() if k != _UPSERT_ID_PROPERTY},
+        }
+        response = self._request("POST", _UPSERT_URL, {"inputs": [upsert_input]})
+        if response.status_code in (200, 201):
+            contact_id = response.json()["results"][0]["id"]
+            logging.info(f"Contacto creado o existente (upsert): {contact_id}")
+            return contact_id
+
+        if response.status_code == 400 and _UPSERT_ID_PROPERTY in _error_message(response):
+            _upsert_supported = False
+            logging.warning(f"Upsert por {_UPSERT_ID_PROPERTY} no soportado, se usa create: {response.text}")
+            return None
+
+        logging.error(f"Error creando contacto (upsert): {response.status_code}")
+        logging.error(f"Respuesta de HubSpot: {response.text}")
+        logging.error(f"Propiedades que se intentaron enviar: {properties}")
+        return None
+
     def _create_contact(self, properties: Dict) -> Optional[str]:
         """Crea un nuevo contacto"""
-        response = requests.post(
-            f"{self.url}",
-            headers=self.headers,
-            json={"properties": properties}
-        )
+        response = self._request("POST", _CONTACTS_URL, {"properties": properties})
         if response.status_code == 201:
             data = response.json()
             logging.info(f"Contacto creado exitosamente: {data['id']}")
@@ -142,85 +294,100 @@ class HubSpotManager:
     def update_contact(self, state: Dict, extracted_info: Dict) -> Optional[str]:
         """Actualiza un contacto existente"""
 
-        properties = {}
-
         # Si no hay información extraída, no actualizar el contacto
         if not extracted_info:
             return None
 
         try:
-            logging.info(f"Actualizando contacto en HubSpot con información: {extracted_info}")
+            logging.debug("Actualizando contacto en HubSpot con información: %s", extracted_info)
+
+            properties = self._build_properties(state, extracted_info)
+            if not properties:
+                # Re-extracción de campos que el estado ya tiene: nada que enviar
+                logging.debug("No hay propiedades para actualizar en el contacto %s", self.contact_id)
+                return self.contact_id
+            return self._update_contact(properties)
+        except Exception as e:
+            logging.error(f"Error actualizando contacto en HubSpot: {e}")
+            return None
 
-            for key, value in extracted_info.items():
-                current_value = state.get(key)
-                if key not in ["detalles_maquinaria", "apellido"] and current_value and current_value not in ["No especificado", "No tiene", None, ""]:
-                    continue
+    def _build_properties(self, state: Dict, extracted_info: Dict) -> Dict:
+        """
+        Traduce la información extraída a propiedades de HubSpot. Los campos que
+        el estado ya tiene con un valor real no se vuelven a enviar.
+        """
+        properties = {}
 
-                if key == "nombre":
-                    properties["firstname"] = value + " Prueba Bot"
+        for key, value in extracted_info.items():
+            current_value = state.get(key)
+            if key not in ["detalles_maquinaria", "apellido"] and current_value and current_value not in ["No especificado", "No tiene", None, ""]:
+                continue
 
-                elif key == "apellido":
-                    # Combinar nombre y apellido en el campo nombre
-                    nombre_actual = state.get("nombre", "")
-                    if nombre_actual and value:
-                        properties["firstname"] = f"{nombre_actual} {value}".strip() + " Prueba Bot"
-                    else:
-                        properties["firstname"] = extracted_info["nombre"] + " " + value + " Prueba Bot"
+            if key == "nombre":
+                properties["firstname"] = value + " Prueba Bot"
+
+            elif key == "apellido":
+                # Combinar nombre y apellido en el campo nombre
+                nombre_actual = state.get("nombre", "")
+                if nombre_actual and value:
+                    properties["firstname"] = f"{nombre_actual} {value}".strip() + " Prueba Bot"
+                else:
+                    properties["firstname"] = extracted_info["nombre"] + " " + value + " Prueba Bot"
 
-                elif key == "tipo_maquinaria":
-                    # TODO: mejorar con el valor real
-                    properties["en_que_producto_estas_interesado_"] = PRODUCTO_INTERESADO_DICT[value]
+            elif key == "tipo_maquinaria":
+                # TODO: mejorar con el valor real
+                # Tipos sin producto en HubSpot (motobomba, cortadora...) se
+                # omiten; antes el KeyError descartaba toda la actualización
+                producto = PRODUCTO_INTERESADO_DICT.get(value)
+                if producto is not None:
+                    properties["en_que_producto_estas_interesado_"] = producto
+            
+            elif key == "detalles_maquinaria" and isinstance(value, dict):
+                current_detalles = state.get("detalles_maquinaria", {})
+                current_detalles.update(value)
                 
-                elif key == "detalles_maquinaria" and isinstance(value, dict):
-                    current_detalles = state.get("detalles_maquinaria", {})
-                    current_detalles.update(value)
-                    
-                    # Convertir detalles_maquinaria a texto legible usando MAQUINARIA_CONFIG
-                    current_detalles_text = self._convert_detalles_to_text(current_detalles, state.get("tipo_maquinaria"))
-                    properties["caracteristicas_de_maquinaria_de_interes"] = current_detalles_text
-
-                elif key == "nombre_empresa":
-                    properties["company"] = value
-
-                elif key == "giro_empresa":
-                    # TODO: mejorar con el valor real
-                    if value in GIRO_EMPRESA:
-                        properties["giro_de_la_empresa_"] = value
-                    else:
-                        properties["giro_de_la_empresa_"] = GIRO_EMPRESA[0]
+                # Convertir detalles_maquinaria a texto legible usando MAQUINARIA_CONFIG
+                current_detalles_text = self._convert_detalles_to_text(current_detalles, state.get("tipo_maquinaria"))
+                properties["caracteristicas_de_maquinaria_de_interes"] = current_detalles_text
 
-                elif key == "lugar_requerimiento":
-                    # TODO: mejorar con el valor real
-                    if value in ESTADOS:
-                        properties["estado___region"] = value
-                    else:
-                        properties["estado___region"] = ESTADOS[0]
+            elif key == "nombre_empresa":
+                properties["company"] = value
 
-                elif key == "telefono":
-                    properties["phone"] = value
+            elif key == "giro_empresa":
+                # TODO: mejorar con el valor real
+                if value in _GIRO_EMPRESA_SET:
+                    properties["giro_de_la_empresa_"] = value
+                else:
+                    properties["giro_de_la_empresa_"] = GIRO_EMPRESA[0]
 
-                elif key == "correo":
-                    properties["email"] = value
-            
-            if properties:
-                return self._update_contact(properties)
-            else:
-                logging.info(f"No hay propiedades para actualizar en el contacto {self.contact_id}")
-                return self.contact_id
-        except Exception as e:
-            logging.error(f"Error actualizando contacto en HubSpot: {e}")
-            return None
+            elif key == "lugar_requerimiento":
+                # TODO: mejorar con el valor real
+                if value in _ESTADOS_SET:
+                    properties["estado___region"] = value
+                else:
+                    properties["estado___region"] = ESTADOS[0]
+
+            elif key == "telefono":
+                properties["phone"] = value
+
+            elif key == "correo":
+                properties["email"] = value
+
+        return properties
     
     def _update_contact(self, properties: Dict) -> Optional[str]:
         """Actualiza un contacto existente"""
-        response = requests.patch(
-            f"{self.url}/{self.contact_id}",
-            headers=self.headers,
-            json={"properties": properties}
-        )
+        sent = _SENT_PROPERTIES.get(self.contact_id) or {}
+        changed = {k: v for k, v in properties.items() if sent.get(k, _UNSET) != v}
+        if not changed:
+            logging.debug("Propiedades sin cambios para el contacto %s, se omite el PATCH", self.contact_id)
+            return self.contact_id
+
+        response = self._request("PATCH", self._contact_url(), {"properties": changed})
         if response.status_code == 200:
             logging.info(f"Contacto actualizado exitosamente: {self.contact_id}")
-            logging.info(f"Propiedades actualizadas: {properties}")
+            logging.debug("Propiedades actualizadas: %s", changed)
+            _SENT_PROPERTIES.set(self.contact_id, {**sent, **changed})
             return self.contact_id
         
         logging.error(f"Error actualizando contacto {self.contact_id}: {response.status_code}")
@@ -231,11 +398,9 @@ class HubSpotManager:
     # Eliminar contacto (usado para el comando de reset)
     def delete_contact(self) -> Optional[str]:
         """Elimina un contacto"""
+        _SENT_PROPERTIES.pop(self.contact_id)
         try:
-            response = requests.delete(
-                f"{self.url}/{self.contact_id}",
-                headers=self.headers
-            )
+            response = self._request("DELETE", self._contact_url())
             if response.status_code == 204:
                 logging.info(f"Contacto eliminado exitosamente: {self.contact_id}")
                 return self.contact_id
@@ -250,30 +415,24 @@ class HubSpotManager:
         """Convierte los detalles de maquinaria a texto legible usando las preguntas de MAQUINARIA_CONFIG"""
         
         if not tipo_maquinaria or not detalles:
-            return json.dumps(detalles, ensure_ascii=False)
+            return json_utils.dumps(detalles)
         
         try:
             # Obtener la configuración directamente usando el string tipo_maquinaria
             # Ahora machinery_config_service usa strings como keys
-            config = machinery_config_service.get_config(str(tipo_maquinaria))
+            prefixes = _answer_prefixes(str(tipo_maquinaria))
             
-            if not config:
-                return json.dumps(detalles, ensure_ascii=False)
+            if prefixes is None:
+                return json_utils.dumps(detalles)
             
             text_parts = []
             
             # Para cada campo en los detalles, buscar su pregunta correspondiente
             for field_name, field_value in detalles.items():
                 if field_value:
-                    # Buscar la pregunta para este campo
-                    question = None
-                    for field_config in config.fields:
-                        if field_config.name == field_name:
-                            question = field_config.question
-                            break
-                    
-                    if question:
-                        text_parts.append(f"{question} Respuesta: {field_value}")
+                    prefix = prefixes.get(field_name)
+                    if prefix:
+                        text_parts.append(prefix + str(field_value))
                     else:
                         text_parts.append(f"{field_name}: {field_value}")
             
@@ -281,4 +440,4 @@ class HubSpotManager:
             
         except Exception as e:
             logging.error(f"Error convirtiendo detalles a texto: {e}")
-            return json.dumps(detalles, ensure_ascii=False)
\ No newline at end of file
+            return json_utils.dumps(detalles)
\ No newline at end of file
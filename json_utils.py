@@ -0,0 +1,45 @@
+"""
+JSON Utils
+
+Serialización JSON compartida por el bot. Usa orjson (extensión en C, varias
+veces más rápida que el módulo json) cuando está instalado y cae al módulo
+estándar si no, con la misma salida: UTF-8 sin escapar (equivalente a
+ensure_ascii=False), compacta (sin espacios tras "," ni ":", como orjson) y,
+opcionalmente, indentación de 2 espacios.
+"""
+
+import json
+from typing import Any, Callable, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson.JSONDecodeError hereda de json.JSONDecodeError, así que un solo
+# except cubre ambos backends.
+JSONDecodeError = json.JSONDecodeError
+
+
+def dumps(obj: Any, indent: bool = False, default: Optional[Callable[[Any], Any]] = None) -> str:
+    """Serializa `obj` a str. `indent=True` equivale a indent=2."""
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2 if indent else 0
+        return orjson.dumps(obj, default=default, option=option).decode("utf-8")
+    if indent:
+        return json.dumps(obj, ensure_ascii=False, indent=2, default=default)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=default)
+
+
+def dumps_bytes(obj: Any, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+    """Como dumps, pero en bytes UTF-8: listo para el cuerpo de una petición HTTP."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=default)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=default).encode("utf-8")
+
+
+def loads(data: Union[str, bytes, bytearray]) -> Any:
+    """Deserializa un documento JSON desde str o bytes."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
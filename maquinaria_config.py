@@ -2,7 +2,7 @@
 Configuración centralizada de maquinaria
 """
 
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, FrozenSet, Optional, Tuple
 from pydantic import BaseModel, Field
 
 # ============================================================================
@@ -50,6 +50,38 @@ TYPE_DISPLAY_NAMES: Dict[str, str] = {
 # SERVICIO DE CONFIGURACIÓN
 # ============================================================================
 
+def _display_name(config: Optional[MachineryTypeSchema], type_id: str) -> str:
+    """
+    Nombre amigable (plural) de un tipo para mostrar al usuario.
+    Prioridad: display_name del config (Cosmos) → mapa de respaldo → name → type_id.
+    """
+    if config and getattr(config, "display_name", None):
+        return config.display_name
+    if type_id in TYPE_DISPLAY_NAMES:
+        return TYPE_DISPLAY_NAMES[type_id]
+    if config and config.name:
+        return config.name
+    return type_id
+
+
+class _LoadedConfigs:
+    """
+    Configuraciones cargadas junto con los textos derivados que se inyectan en
+    los prompts en cada mensaje. Los derivados se arman la primera vez que se
+    piden y viven en el mismo objeto que las configuraciones de las que salen:
+    una recarga crea un objeto nuevo y lo asigna de una sola vez, así que un
+    request concurrente nunca memoiza a partir de una carga a medias.
+    """
+
+    def __init__(self, configs: Dict[str, MachineryTypeSchema]):
+        self.configs = configs
+        self.type_ids_str: Optional[str] = None
+        self.type_display_list_str: Optional[str] = None
+        self.field_names: Dict[str, FrozenSet[str]] = {}
+        self.field_questions: Dict[str, Dict[str, str]] = {}
+        self.required_fields: Dict[str, Tuple[str, ...]] = {}
+
+
 class MachineryConfigService:
     """
     Servicio para gestionar la configuración de tipos de maquinaria.
@@ -57,18 +89,21 @@ class MachineryConfigService:
     """
     
     def __init__(self, cosmos_client=None, database_name=None):
-        self._configs: Dict[str, MachineryTypeSchema] = {}
         if cosmos_client and database_name:
             self._db = cosmos_client.get_database_client(database_name)
             self._container = self._db.get_container_client("machinery_configuration")
-            self._load_configs_from_db()
+            configs = self._load_configs_from_db()
         else:
              # Fallback logic or empty init for testing/offline support if needed
              # For now we can keep the local load as fallback or strictly require DB
-             self._configs = self._load_initial_configs_fallback()
+             configs = self._load_initial_configs_fallback()
+        # Se asigna ya completa: __init__ se vuelve a llamar para recargar
+        # mientras otros requests leen del servicio
+        self._loaded = _LoadedConfigs(configs)
 
-    def _load_configs_from_db(self):
+    def _load_configs_from_db(self) -> Dict[str, MachineryTypeSchema]:
         """Carga configuraciones desde Cosmos DB"""
+        configs: Dict[str, MachineryTypeSchema] = {}
         try:
             # Query all items
             items = list(self._container.read_all_items())
@@ -79,10 +114,10 @@ class MachineryConfigService:
                     # Remove Cosmos DB specific fields to avoid Pydantic validation errors if strict
                     clean_item = {k: v for k, v in item.items() if not k.startswith("_")}
                     schema = MachineryTypeSchema(**clean_item)
-                    self._configs[schema.type_id] = schema
+                    configs[schema.type_id] = schema
                 except Exception as e:
                     print(f"Error loading config for item {item.get('id')}: {e}")
-            print(f"Loaded {len(self._configs)} machinery configurations from Cosmos DB.")
+            print(f"Loaded {len(configs)} machinery configurations from Cosmos DB.")
         except Exception as e:
             print(f"Error connecting/reading from Cosmos DB (machinery_configuration): {e}")
 
@@ -91,9 +126,10 @@ class MachineryConfigService:
         # local. Sin esto, en un entorno sin ese contenedor (ej. PROD) get_config()
         # devuelve None para todos los tipos, tipo_maquinaria nunca se persiste y el
         # bot se queda en un loop infinito pidiendo el tipo de maquinaria.
-        if not self._configs:
+        if not configs:
             print("ADVERTENCIA: sin configuraciones desde Cosmos. Usando config local de respaldo (machinery_data).")
-            self._configs = self._load_initial_configs_fallback()
+            configs = self._load_initial_configs_fallback()
+        return configs
 
     def _load_initial_configs_fallback(self) -> Dict[str, MachineryTypeSchema]:
         """
@@ -111,37 +147,75 @@ class MachineryConfigService:
 
     def get_config(self, type_id: str) -> Optional[MachineryTypeSchema]:
         """Obtiene la configuración para un tipo de maquinaria específico"""
-        return self._configs.get(type_id)
+        return self._loaded.configs.get(type_id)
 
     def get_all_types(self) -> List[MachineryTypeSchema]:
         """Obtiene todas las configuraciones de tipos de maquinaria"""
-        return list(self._configs.values())
+        return list(self._loaded.configs.values())
 
     def get_type_display_name(self, type_id: str) -> str:
         """
         Nombre amigable (plural) de un tipo para mostrar al usuario.
         Prioridad: display_name del config (Cosmos) → mapa de respaldo → name → type_id.
         """
-        config = self._configs.get(type_id)
-        if config and getattr(config, "display_name", None):
-            return config.display_name
-        if type_id in TYPE_DISPLAY_NAMES:
-            return TYPE_DISPLAY_NAMES[type_id]
-        if config and config.name:
-            return config.name
-        return type_id
+        return _display_name(self._loaded.configs.get(type_id), type_id)
 
     def get_type_display_list(self) -> List[str]:
         """Lista de nombres amigables de TODOS los tipos manejados (en el orden del config)."""
         return [self.get_type_display_name(t.type_id) for t in self.get_all_types()]
 
+    def get_type_ids_str(self) -> str:
+        """type_id de todos los tipos entre comillas y separados por espacio (para el prompt de extracción)."""
+        loaded = self._loaded
+        if loaded.type_ids_str is None:
+            loaded.type_ids_str = " ".join(f"\"{type_id}\"" for type_id in loaded.configs)
+        return loaded.type_ids_str
+
+    def get_type_display_list_str(self) -> str:
+        """get_type_display_list() unida con comas (para el prompt de respuesta)."""
+        loaded = self._loaded
+        if loaded.type_display_list_str is None:
+            loaded.type_display_list_str = ", ".join(
+                _display_name(config, type_id) for type_id, config in loaded.configs.items()
+            )
+        return loaded.type_display_list_str
+
+    def get_field_names(self, type_id: str) -> Optional[FrozenSet[str]]:
+        """Nombres de los campos de detalle de un tipo (memoizado), o None si el tipo no existe."""
+        loaded = self._loaded
+        names = loaded.field_names.get(type_id)
+        if names is None:
+            config = loaded.configs.get(type_id)
+            if not config:
+                return None
+            names = frozenset(field.name for field in config.fields)
+            loaded.field_names[type_id] = names
+        return names
+
+    def get_field_questions(self, type_id: str) -> Optional[Dict[str, str]]:
+        """Pregunta de cada campo de detalle de un tipo (memoizado), o None si el tipo no existe. No se debe modificar."""
+        loaded = self._loaded
+        questions = loaded.field_questions.get(type_id)
+        if questions is None:
+            config = loaded.configs.get(type_id)
+            if not config:
+                return None
+            questions = {field.name: field.question for field in config.fields}
+            loaded.field_questions[type_id] = questions
+        return questions
+
     def get_required_fields(self, type_id: str) -> List[str]:
         """Obtiene una lista de los nombres de campos obligatorios para un tipo de maquinaria"""
-        config = self.get_config(type_id)
-        if not config:
-            return []
-        
-        return [field.name for field in config.fields if field.required]
+        loaded = self._loaded
+        required = loaded.required_fields.get(type_id)
+        if required is None:
+            config = loaded.configs.get(type_id)
+            if not config:
+                return []
+            required = tuple(field.name for field in config.fields if field.required)
+            loaded.required_fields[type_id] = required
+        # Copia: los llamadores filtran la lista según el contexto
+        return list(required)
 
 
 
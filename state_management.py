@@ -1,9 +1,11 @@
+import copy
 from abc import ABC, abstractmethod
 from hmac import new
-from typing import Optional, TypedDict, List, Dict, Any
+from typing import Optional, TypedDict, List, Dict, Any, FrozenSet
 from enum import Enum
 from datetime import datetime, timezone
 import logging
+from bounded_cache import BoundedCache
 
 class ConversationState(TypedDict):
     nombre: Optional[str]
@@ -32,6 +34,80 @@ class ConversationState(TypedDict):
     hubspot_contact_id: Optional[str]
     # Control del flujo de cotización
     quiere_cotizacion: Optional[str]  # "sí" | "no" | None (None = aún no se ha mostrado el mensaje o no ha respondido)
+    # Última pregunta del bot: {"index", "question", "question_type"} (ver IntelligentLeadQualificationChatbot._get_last_bot_question)
+    _last_bot_question: Optional[Dict[str, Any]]
+    # Epoch (segundos) del último mensaje del agente. Se calcula al cargar de
+    # Cosmos y no se guarda (ver _TRANSIENT_STATE_KEYS).
+    last_agent_ts: Optional[int]
+    # Ids de WhatsApp de los últimos RECENT_MESSAGE_IDS_WINDOW mensajes, para
+    # detectar duplicados con una búsqueda en un set. También transitorio.
+    recent_message_ids: FrozenSet[str]
+
+def utc_now_iso(now: Optional[datetime] = None) -> str:
+    """
+    Hora actual (o `now`) en UTC con el formato que usan Cosmos y la web
+    ("2024-01-31T18:05:09Z"). isoformat evita strftime, que es sensible al
+    locale y bastante más lento.
+    """
+    if now is None:
+        now = datetime.now(timezone.utc)
+    return now.isoformat(timespec="seconds").replace("+00:00", "Z")
+
+def iso_to_epoch(timestamp: Optional[str]) -> Optional[int]:
+    """Convierte un timestamp ISO ("...Z") a epoch en segundos; None si no se puede."""
+    if not timestamp:
+        return None
+    try:
+        return int(datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp())
+    except (ValueError, TypeError) as e:
+        logging.error(f"Error parseando timestamp {timestamp!r}: {e}")
+        return None
+
+def message_epoch(message: Dict[str, Any]) -> Optional[int]:
+    """
+    Epoch en segundos de un mensaje del historial. Usa `ts` y solo parsea el
+    timestamp ISO en mensajes que no lo tienen (anteriores a `ts` o escritos
+    por la web, como los del agente).
+    """
+    ts = message.get("ts")
+    if ts is not None:
+        return ts
+    return iso_to_epoch(message.get("timestamp"))
+
+def recent_message_ids(messages: List[Dict[str, Any]]) -> FrozenSet[str]:
+    """Ids de WhatsApp (no vacíos) de los últimos RECENT_MESSAGE_IDS_WINDOW mensajes."""
+    return frozenset(
+        msg["whatsapp_message_id"]
+        for msg in messages[-RECENT_MESSAGE_IDS_WINDOW:]
+        if msg.get("whatsapp_message_id")
+    )
+
+def build_message(role: str, sender: str, content: str = "", whatsapp_message_id: str = "",
+                  question_type: str = "", **extra: Any) -> Dict[str, Any]:
+    """
+    Construye un mensaje del historial con el formato que esperan Cosmos y la web.
+
+    Todos los sitios que agregan mensajes pasan por aquí para que cada dict se
+    arme de una sola vez con las mismas llaves literales (CPython ya las interna,
+    así que todos los mensajes comparten los mismos objetos str como llaves) en
+    lugar de repetir el literal del dict en cada lugar.
+    `extra` permite campos opcionales como `multimedia`.
+    Además del timestamp ISO (para mostrar) se guarda `ts` en epoch, para
+    comparar tiempos sin parsear el string (ver message_epoch).
+    """
+    now = datetime.now(timezone.utc)
+    message = {
+        "role": role,
+        "whatsapp_message_id": whatsapp_message_id,
+        "question_type": question_type,
+        "content": content,
+        "timestamp": utc_now_iso(now),
+        "ts": int(now.timestamp()),
+        "sender": sender,
+    }
+    if extra:
+        message.update(extra)
+    return message
 
 # Configuración de prioridad de campos para la generación de preguntas
 # IMPORTANTE: El orden de los campos de esta variable es el orden en el que se hacen las preguntas
@@ -155,6 +231,27 @@ class InMemoryStateStore(ConversationStateStore):
     def delete_conversation_state(self, user_id: str) -> None:
         self._states.pop(user_id, None)
 
+# Campos del estado que se sincronizan con /state/<campo> en Cosmos
+_WATCHED_FIELDS = (
+    "nombre", "apellido", "tipo_ayuda", "tipo_maquinaria", "detalles_maquinaria",
+    "maquina_seleccionada", "maquinas_recomendadas", "tipo_cliente", "nombre_empresa", 
+    "giro_empresa", "correo", "telefono", "completed", "cotizacion_enviada",
+    "lugar_requerimiento", "asignado_asesor", "quiere_cotizacion",
+    "constancia_fiscal_entregada", "_last_bot_question"
+)
+
+# Campos derivados al cargar que no se escriben en Cosmos
+_TRANSIENT_STATE_KEYS = ("last_agent_ts", "recent_message_ids")
+
+# Cuántos mensajes recientes se revisan para detectar un webhook duplicado. No
+# basta con los últimos 3: entre el mensaje original y su reenvío pueden caber
+# la respuesta del bot, mensajes del agente y otros mensajes del lead.
+RECENT_MESSAGE_IDS_WINDOW = 16
+
+# Máximo de operaciones que Cosmos acepta en un solo patch_item
+_PATCH_MAX_OPS = 10
+
+
 class CosmosDBStateStore(ConversationStateStore):
     """Implementación con Cosmos DB para producción"""
     
@@ -163,31 +260,38 @@ class CosmosDBStateStore(ConversationStateStore):
         self.database_name = database_name
         self.container_name = container_name
         self.container = self.cosmos_client.get_database_client(database_name).get_container_client(container_name)
+        # Última versión conocida de cada conversación en Cosmos (lo que se
+        # cargó o guardó desde este store). save_conversation_state compara
+        # contra ella en lugar de volver a leer el documento, y si no cambió
+        # nada no escribe.
+        self._snapshots = BoundedCache(maxsize=1024)
+
+    def _take_snapshot(self, user_id: str, state: ConversationState) -> None:
+        self._snapshots.set(user_id, {
+            "fields": {field: copy.deepcopy(state.get(field)) for field in _WATCHED_FIELDS},
+            "conversation_mode": state.get("conversation_mode"),
+            "message_count": len(state.get("messages", [])),
+        })
     
     def get_conversation_state(self, user_id: str) -> Optional[ConversationState]:
         """Recupera el estado de conversación desde Cosmos DB"""
         try:
-            # Primero verificar si el documento existe
             item_id = f"conv_{user_id}"
-            
-            # Usar query para verificar existencia sin generar error
-            query = "SELECT c.id FROM c WHERE c.id = @item_id"
-            parameters = [{"name": "@item_id", "value": item_id}]
-            
-            items = list(self.container.query_items(
-                query=query,
-                parameters=parameters,
-                partition_key=user_id
-            ))
-            
-            if not items:
-                logging.info(f"Lead nuevo detectado: {user_id}")
-                return None
-            
-            # Si existe, leer el documento completo
-            response = self.container.read_item(item=item_id, partition_key=user_id)
+
+            # Un solo point read: el 404 indica un lead nuevo. Antes se
+            # verificaba la existencia con una query y luego se leía el
+            # documento, dos viajes a Cosmos por cada mensaje.
+            try:
+                response = self.container.read_item(item=item_id, partition_key=user_id)
+            except Exception as e:
+                if getattr(e, "status_code", None) == 404:
+                    logging.info(f"Lead nuevo detectado: {user_id}")
+                    return None
+                raise
             logging.info(f"Estado existente cargado para usuario {user_id}")
-            return self._cosmos_to_conversation_state(response)
+            state = self._cosmos_to_conversation_state(response)
+            self._take_snapshot(user_id, state)
+            return state
             
         except Exception as e:
             logging.error(f"Error recuperando estado de Cosmos DB: {e}")
@@ -199,36 +303,50 @@ class CosmosDBStateStore(ConversationStateStore):
         Detecta cambios específicos y ejecuta operaciones granulares.
         """
         try:
-            # Obtener estado anterior para comparación
-            old_state = self.get_conversation_state(user_id)
-            
-            if old_state is None:
-                # Primera vez: crear documento completo
-                self._create_new_conversation_state(user_id, state)
-                logging.info(f"Documento inicial creado para usuario {user_id}")
-                return
+            # Comparar contra la última versión conocida; solo si este store
+            # todavía no la tiene (no cargó la conversación) se lee de Cosmos.
+            snapshot = self._snapshots.get(user_id)
+            if snapshot is None:
+                old_state = self.get_conversation_state(user_id)
+
+                if old_state is None:
+                    # Primera vez: crear documento completo
+                    self._create_new_conversation_state(user_id, state)
+                    logging.info(f"Documento inicial creado para usuario {user_id}")
+                    return
+                snapshot = self._snapshots.get(user_id)
             
-            # Detectar y aplicar cambios específicos
+            # Detectar los cambios y aplicarlos juntos: mensajes, campos y modo
+            # van en un mismo patch en lugar de un viaje a Cosmos por tipo
             changes_applied = []
+            patch_ops = []
             
             # 1. Verificar nuevos mensajes
-            if self._has_new_messages(old_state, state):
+            if len(state.get("messages", [])) > snapshot["message_count"]:
                 new_messages = self._get_new_message(state)
-                self._append_messages(user_id, new_messages)
+                patch_ops.extend(self._message_patch_ops(new_messages))
                 changes_applied.append(f"{len(new_messages)} mensajes")
             
             # 2. Verificar cambios en campos del lead
-            field_changes = self._detect_field_changes(old_state, state)
+            field_changes = self._detect_field_changes(snapshot["fields"], state)
             if field_changes:
-                self._patch_fields(user_id, field_changes)
+                # "set" y no "replace": replace falla si la ruta no existe, y los
+                # documentos creados antes de agregar un campo a _WATCHED_FIELDS
+                # (p. ej. _last_bot_question) no lo tienen
+                patch_ops.extend(
+                    {"op": "set", "path": f"/state/{field_name}", "value": new_value}
+                    for field_name, new_value in field_changes.items()
+                )
                 changes_applied.append(f"{len(field_changes)} campos")
             
             # 3. Verificar cambio de modo de conversación
-            if old_state.get("conversation_mode") != state.get("conversation_mode"):
-                self._update_conversation_mode(user_id, state.get("conversation_mode"))
+            if snapshot["conversation_mode"] != state.get("conversation_mode"):
+                patch_ops.append({"op": "replace", "path": "/conversation_mode", "value": state.get("conversation_mode")})
                 changes_applied.append("modo conversación")
             
             if changes_applied:
+                self._patch(user_id, patch_ops)
+                self._take_snapshot(user_id, state)
                 logging.info(f"Cambios aplicados para usuario {user_id}")
                 # logging.info(f"Cambios aplicados para usuario {user_id}: {', '.join(changes_applied)}")
             else:
@@ -239,6 +357,7 @@ class CosmosDBStateStore(ConversationStateStore):
             # Fallback: guardar documento completo
             cosmos_doc = self._conversation_state_to_cosmos(user_id, state)
             self.container.upsert_item(cosmos_doc)
+            self._take_snapshot(user_id, state)
             # logging.info(f"Estado guardado con fallback completo para usuario {user_id}")
 
     def add_single_message(self, user_id: str, message_content: Any, whatsapp_message_id: str, state: ConversationState) -> None:
@@ -249,14 +368,7 @@ class CosmosDBStateStore(ConversationStateStore):
                 self._create_new_conversation_state(user_id, state)
             
             # Formatear el mensaje
-            new_message = {
-                "whatsapp_message_id": whatsapp_message_id,
-                "sender": "lead",
-                "role": "user",
-                "content": "",
-                "question_type": "",
-                "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
-            }
+            new_message = build_message("user", "lead", whatsapp_message_id=whatsapp_message_id)
 
             # Si es texto, agregar el texto en content, si es multimedia, agregar nuevo elemento "multimedia"
             if isinstance(message_content, str):
@@ -285,15 +397,11 @@ class CosmosDBStateStore(ConversationStateStore):
         avanza junto con Cosmos, el siguiente guardado se desincroniza.
         """
         try:
-            new_message = {
-                "whatsapp_message_id": whatsapp_message_id or "",
-                "sender": sender,
-                "role": "assistant",
-                "content": "",
-                "question_type": "",
-                "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
-                "multimedia": multimedia
-            }
+            new_message = build_message(
+                "assistant", sender,
+                whatsapp_message_id=whatsapp_message_id or "",
+                multimedia=multimedia
+            )
 
             self._append_messages(user_id, [new_message])
 
@@ -309,6 +417,7 @@ class CosmosDBStateStore(ConversationStateStore):
     def delete_conversation_state(self, user_id: str) -> None:
         """Elimina el estado de conversación de Cosmos DB"""
         try:
+            self._snapshots.pop(user_id)
             self.container.delete_item(item=f"conv_{user_id}", partition_key=user_id)
             # logging.info(f"Estado eliminado exitosamente para usuario {user_id}")
         except Exception as e:
@@ -319,11 +428,38 @@ class CosmosDBStateStore(ConversationStateStore):
         """Crea un nuevo estado de conversación"""
         cosmos_doc = self._conversation_state_to_cosmos(user_id, state)
         self.container.upsert_item(cosmos_doc)
+        self._take_snapshot(user_id, state)
         logging.info(f"Documento inicial creado para usuario {user_id}")
     
+    def peek_last_message_ids(self, user_id: str, count: int = RECENT_MESSAGE_IDS_WINDOW) -> List[str]:
+        """
+        Ids de WhatsApp de los últimos `count` mensajes, sin leer el documento
+        completo. function_app descarta con esto un mensaje duplicado antes de
+        cargar la conversación. Ante un error regresa [] (la carga completa
+        sigue funcionando igual).
+        """
+        try:
+            # Solo los ids, no los mensajes completos
+            query = (
+                "SELECT VALUE ARRAY_SLICE(ARRAY(SELECT VALUE m.whatsapp_message_id FROM m IN c.messages), "
+                f"-{int(count)}) FROM c WHERE c.id = @item_id"
+            )
+            parameters = [{"name": "@item_id", "value": f"conv_{user_id}"}]
+            items = list(self.container.query_items(
+                query=query,
+                parameters=parameters,
+                partition_key=user_id
+            ))
+            if not items:
+                return []
+            return [message_id for message_id in items[0] if message_id]
+        except Exception as e:
+            logging.error(f"Error consultando los últimos mensajes de {user_id}: {e}")
+            return []
+
     def _conversation_state_to_cosmos(self, user_id: str, state: ConversationState) -> Dict[str, Any]:
         """Transforma ConversationState al formato de Cosmos DB"""
-        now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        now = utc_now_iso()
         
         # Preparar mensajes con formato completo
         messages_formatted = []
@@ -335,6 +471,7 @@ class CosmosDBStateStore(ConversationStateStore):
                 "text": msg["content"],
                 "question_type": msg.get("question_type", ""),
                 "timestamp": msg.get("timestamp", now),
+                "ts": message_epoch(msg),
                 "delivered": True,
                 "read": False
             }
@@ -346,6 +483,8 @@ class CosmosDBStateStore(ConversationStateStore):
         state_copy.pop("conversation_mode", None)
         state_copy.pop("asignado_asesor", None)
         state_copy.pop("hubspot_contact_id", None)
+        for key in _TRANSIENT_STATE_KEYS:
+            state_copy.pop(key, None)
         
         # Tipo de maquinaria ya es string, no requiere conversión
         pass
@@ -371,7 +510,10 @@ class CosmosDBStateStore(ConversationStateStore):
         
         # Convertir mensajes al formato esperado por ai_langchain.py
         messages = []
+        last_agent_msg = None
         for msg in cosmos_doc.get("messages", []):
+            if msg["sender"] == "agente":
+                last_agent_msg = msg
             msg_converted = {
                 "role": "user" if msg["sender"] == "lead" else "assistant",
                 # Los mensajes multimedia se guardan con text=None; normalizar a ""
@@ -379,6 +521,8 @@ class CosmosDBStateStore(ConversationStateStore):
                 "content": msg.get("text") or "",
                 "question_type": msg.get("question_type"),
                 "timestamp": msg.get("timestamp"),
+                "ts": msg.get("ts"),
+                "whatsapp_message_id": msg.get("whatsapp_message_id", ""),
                 "sender": msg["sender"]
             }
             messages.append(msg_converted)
@@ -408,7 +552,12 @@ class CosmosDBStateStore(ConversationStateStore):
             "asignado_asesor": cosmos_doc.get("asignado_asesor"),
             "hubspot_contact_id": cosmos_doc.get("hubspot_contact_id"),
             "quiere_cotizacion": state.get("quiere_cotizacion"),
-            "constancia_fiscal_entregada": state.get("constancia_fiscal_entregada", False)
+            "constancia_fiscal_entregada": state.get("constancia_fiscal_entregada", False),
+            "_last_bot_question": state.get("_last_bot_question"),
+            # Se calcula aquí, aprovechando el recorrido de los mensajes, para
+            # que check_agent_timeout no tenga que buscarlo ni parsearlo.
+            "last_agent_ts": message_epoch(last_agent_msg) if last_agent_msg else None,
+            "recent_message_ids": recent_message_ids(messages)
         }
         
         return conversation_state
@@ -417,12 +566,6 @@ class CosmosDBStateStore(ConversationStateStore):
     # MÉTODOS INTERNOS PARA OPERACIONES GRANULARES (OPTIMIZACIÓN DE PERFORMANCE)
     # ============================================================================
     
-    def _has_new_messages(self, old_state: ConversationState, new_state: ConversationState) -> bool:
-        """Detecta si hay mensajes nuevos comparando la longitud"""
-        old_messages = old_state.get("messages", [])
-        new_messages = new_state.get("messages", [])
-        return len(new_messages) > len(old_messages)
-    
     def _get_new_message(self, new_state: ConversationState) -> List[Dict[str, Any]]:
         """Obtiene solo los mensajes nuevos"""
         new_messages = new_state.get("messages", [])
@@ -433,16 +576,7 @@ class CosmosDBStateStore(ConversationStateStore):
         """Detecta qué campos del lead han cambiado"""
         changes = {}
         
-        # Campos a monitorear para cambios
-        fields_to_check = [
-            "nombre", "apellido", "tipo_ayuda", "tipo_maquinaria", "detalles_maquinaria",
-            "maquina_seleccionada", "maquinas_recomendadas", "tipo_cliente", "nombre_empresa", 
-            "giro_empresa", "correo", "telefono", "completed", "cotizacion_enviada",
-            "lugar_requerimiento", "asignado_asesor", "quiere_cotizacion",
-            "constancia_fiscal_entregada"
-        ]
-        
-        for field in fields_to_check:
+        for field in _WATCHED_FIELDS:
             old_value = old_state.get(field)
             new_value = new_state.get(field)
             
@@ -454,114 +588,65 @@ class CosmosDBStateStore(ConversationStateStore):
                 
         return changes
     
-    def _append_messages(self, user_id: str, new_messages: List[Dict[str, Any]]) -> None:
-        """Agrega mensajes nuevos usando patch operation"""
-        try:
-            # Preparar mensajes en formato Cosmos DB
-            formatted_messages = []
-            for i, msg in enumerate(new_messages):
-                msg_formatted = {
-                    "id": f"msg_{int(datetime.now(timezone.utc).timestamp())}_{i}",
-                    "whatsapp_message_id": msg.get("whatsapp_message_id", ""),
-                    "sender": msg.get("sender", "lead" if msg["role"] == "user" else "bot"),
-                    "text": msg["content"],
-                    "question_type": msg.get("question_type", ""),
-                    "timestamp": msg.get("timestamp", datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")),
-                    "delivered": True,
-                    "read": False
-                }
-
-                if msg.get("multimedia"):
-                    msg_formatted["text"] = None
-                    msg_formatted["multimedia"] = msg["multimedia"]
-                formatted_messages.append(msg_formatted)
-            
-            # Usar patch operation para agregar mensajes
-            patch_ops = []
-            for msg in formatted_messages:
-                patch_ops.append({
-                    "op": "add",
-                    "path": f"/messages/-",
-                    "value": msg
-                })
-            
-            # También actualizar updated_at
+    def _message_patch_ops(self, new_messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Operaciones de patch que agregan `new_messages` en formato Cosmos DB"""
+        patch_ops = []
+        for i, msg in enumerate(new_messages):
+            msg_formatted = {
+                "id": f"msg_{int(datetime.now(timezone.utc).timestamp())}_{i}",
+                "whatsapp_message_id": msg.get("whatsapp_message_id", ""),
+                "sender": msg.get("sender", "lead" if msg["role"] == "user" else "bot"),
+                "text": msg["content"],
+                "question_type": msg.get("question_type", ""),
+                "timestamp": msg["timestamp"] if "timestamp" in msg else utc_now_iso(),
+                "ts": message_epoch(msg),
+                "delivered": True,
+                "read": False
+            }
+
+            if msg.get("multimedia"):
+                msg_formatted["text"] = None
+                msg_formatted["multimedia"] = msg["multimedia"]
+
             patch_ops.append({
-                "op": "replace",
-                "path": "/updated_at",
-                "value": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+                "op": "add",
+                "path": "/messages/-",
+                "value": msg_formatted
             })
-            
-            self.container.patch_item(
-                item=f"conv_{user_id}",
-                partition_key=user_id,
-                patch_operations=patch_ops
-            )
-            
-            logging.info(f"Agregados {len(new_messages)} mensajes para usuario {user_id}")
-            
-        except Exception as e:
-            logging.error(f"Error agregando mensajes con patch: {e}")
-            raise
-    
-    def _patch_fields(self, user_id: str, field_changes: Dict[str, Any]) -> None:
-        """Actualiza campos específicos usando patch operations"""
-        try:
-            patch_ops = []
-            
-            for field_name, new_value in field_changes.items():
-                # No es necesaria la conversion de MaquinariaType
-                pass
-                
-                patch_ops.append({
-                    "op": "replace",
-                    "path": f"/state/{field_name}",
-                    "value": new_value
-                })
-            
-            # Actualizar timestamp
-            patch_ops.append({
+        return patch_ops
+
+    def _patch(self, user_id: str, patch_ops: List[Dict[str, Any]]) -> None:
+        """
+        Aplica `patch_ops` (más la actualización de updated_at) al documento.
+        Cosmos acepta hasta 10 operaciones por patch: normalmente cabe todo en
+        una sola llamada y solo un guardado con muchos cambios se parte en varias.
+        """
+        step = _PATCH_MAX_OPS - 1  # una operación por llamada es para updated_at
+        for start in range(0, len(patch_ops), step):
+            chunk = patch_ops[start:start + step]
+            chunk.append({
                 "op": "replace",
                 "path": "/updated_at",
-                "value": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+                "value": utc_now_iso()
             })
-            
             self.container.patch_item(
                 item=f"conv_{user_id}",
                 partition_key=user_id,
-                patch_operations=patch_ops
+                patch_operations=chunk
             )
-            
-            logging.info(f"Actualizados campos {list(field_changes.keys())} para usuario {user_id}")
-            
-        except Exception as e:
-            logging.error(f"Error actualizando campos con patch: {e}")
-            raise
-    
-    def _update_conversation_mode(self, user_id: str, new_mode: str) -> None:
-        """Actualiza el modo de conversación"""
+
+    def _append_messages(self, user_id: str, new_messages: List[Dict[str, Any]]) -> None:
+        """Agrega mensajes nuevos usando patch operation"""
         try:
-            patch_ops = [
-                {
-                    "op": "replace",
-                    "path": "/conversation_mode",
-                    "value": new_mode
-                },
-                {
-                    "op": "replace",
-                    "path": "/updated_at",
-                    "value": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
-                }
-            ]
-            
-            self.container.patch_item(
-                item=f"conv_{user_id}",
-                partition_key=user_id,
-                patch_operations=patch_ops
-            )
+            self._patch(user_id, self._message_patch_ops(new_messages))
             
-            logging.info(f"Modo de conversación actualizado a '{new_mode}' para usuario {user_id}")
+            # Cosmos ya tiene estos mensajes: que el próximo guardado no los repita
+            snapshot = self._snapshots.get(user_id)
+            if snapshot is not None:
+                snapshot["message_count"] += len(new_messages)
+
+            logging.info(f"Agregados {len(new_messages)} mensajes para usuario {user_id}")
             
         except Exception as e:
-            logging.error(f"Error actualizando modo de conversación: {e}")
+            logging.error(f"Error agregando mensajes con patch: {e}")
             raise
\ No newline at end of file
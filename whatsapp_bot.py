@@ -7,11 +7,20 @@ import logging
 import os
 import requests
 from ai_langchain import AzureOpenAIConfig, IntelligentLeadQualificationChatbot
-from state_management import ConversationStateStore
+from state_management import ConversationStateStore, utc_now_iso
 from typing import Any, Dict, List, Optional
-from datetime import datetime, timezone
 from hubspot_manager import HubSpotManager
-from check_guardrails import ContentSafetyGuardrails
+from check_guardrails import CODE_INJECTION_MESSAGE, get_guardrails
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Sesión HTTP compartida con la Graph API de WhatsApp. Reutiliza la conexión
+# TLS (keep-alive) entre envíos del mismo worker: WhatsApp no acepta mensajes
+# parciales, así que no se puede mandar la respuesta por partes, pero sí evitar
+# el handshake en cada envío, que se suma al tiempo que espera el lead.
+_GRAPH_SESSION = requests.Session()
+
+# Llamadas a HubSpot que pueden correr junto con las de Cosmos (comando reset)
+_HUBSPOT_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="whatsapp-hubspot")
 
 # ============================================================================
 # CLASE PRINCIPAL DEL BOT DE WHATSAPP
@@ -46,8 +55,8 @@ class WhatsAppBot:
             db_name=self.db_name
         )
 
-        # Una sola instancia del guardrails
-        self.guardrails = ContentSafetyGuardrails()
+        # Guardrails compartidos por el worker (ver get_guardrails)
+        self.guardrails = get_guardrails()
         
     def _initialize_langchain_config(self):
         """Inicializa la configuración de LangChain con Azure OpenAI"""
@@ -57,7 +66,8 @@ class WhatsAppBot:
                 api_key=os.environ["FOUNDRY_API_KEY"],
                 deployment_name="gpt-4.1-mini",
                 api_version="2024-12-01-preview",
-                model_name="gpt-4.1-mini"
+                model_name="gpt-4.1-mini",
+                light_deployment_name=os.environ.get("FOUNDRY_LIGHT_DEPLOYMENT")
             )
             logging.info("Configuración de LangChain inicializada correctamente")
         except Exception as e:
@@ -177,20 +187,20 @@ class WhatsAppBot:
             else:
                 data = self.get_text_message_input(wa_id, "text", text)
 
-            logging.info(f"Data of message sent to WhatsApp API: {data}")
+            logging.debug("Data of message sent to WhatsApp API: %s", data)
             headers = {
                 "Content-type": "application/json",
                 "Authorization": f"Bearer {self.access_token}",
             }
             
             url = f"https://graph.facebook.com/{self.version}/{self.phone_number_id}/messages"
-            response = requests.post(url, data=data, headers=headers, timeout=10)
+            response = _GRAPH_SESSION.post(url, data=data, headers=headers, timeout=10)
             response.raise_for_status()
 
             json_response = response.json()
             whatsapp_message_id = json_response["messages"][0]["id"]
             
-            logging.info(f"Mensaje enviado exitosamente, response: {response.json()}")
+            logging.info("Mensaje enviado exitosamente, response: %s", json_response)
             # Mensaje enviado exitosamente, response: {'messaging_product': 'whatsapp', 'contacts': [{'input': '529931340372', 'wa_id': '5219931340372'}], 'messages': [{'id': 'wamid.HBgNNTIxOTkzMTM0MDM3MhUCABEYEjNDMUE3QkFFRjBGQjMxNzBGNQA='}]}
             return whatsapp_message_id + "___" + self.get_template_text(template_name) if template_name else whatsapp_message_id
             
@@ -216,7 +226,7 @@ class WhatsAppBot:
                 "type": mime_type,
             }
             
-            response = requests.post(url, headers=headers, files=files, data=data, timeout=30)
+            response = _GRAPH_SESSION.post(url, headers=headers, files=files, data=data, timeout=30)
             response.raise_for_status()
             
             media_id = response.json().get("id")
@@ -259,7 +269,7 @@ class WhatsAppBot:
             }
             
             url = f"https://graph.facebook.com/{self.version}/{self.phone_number_id}/messages"
-            response = requests.post(url, data=json.dumps(payload), headers=headers, timeout=10)
+            response = _GRAPH_SESSION.post(url, data=json.dumps(payload), headers=headers, timeout=10)
             response.raise_for_status()
             
             whatsapp_message_id = response.json()["messages"][0]["id"]
@@ -301,10 +311,13 @@ class WhatsAppBot:
             # El PDF ya llegó al lead; un fallo aquí no debe romper el envío
             logging.error(f"[PDF] Error registrando el documento enviado a {wa_id}: {e}")
 
-    def process_message(self, wa_id: str, message_text: str, whatsapp_message_id: str, hubspot_manager: HubSpotManager) -> None:
+    def process_message(self, wa_id: str, message_text: str, whatsapp_message_id: str, hubspot_manager: HubSpotManager,
+                        safety_checks: Optional[Dict[str, Future]] = None) -> None:
         """
         Procesa un mensaje entrante usando LangChain.
         El chatbot ahora envía automáticamente las respuestas por WhatsApp.
+        `safety_checks` son las verificaciones de seguridad ya lanzadas con
+        guardrails.start_remote_checks (si el llamador las adelantó).
         """
         try:
             # Verificar si es un comando especial
@@ -320,7 +333,7 @@ class WhatsAppBot:
                 return
 
             # Verificar si el mensaje es seguro
-            safety_result = self.guardrails.check_message_safety(message_text)
+            safety_result = self.guardrails.check_message_safety(message_text, pending=safety_checks)
             if safety_result:
                 if safety_result["type"] == "invalid_conversation" or safety_result["type"] == "content_safety":
                     message_text = "(FD) " + safety_result["message"] + " (FD) Mensaje del lead: " + message_text
@@ -383,9 +396,12 @@ class WhatsAppBot:
 
     def _handle_reset_command(self, wa_id: str, hubspot_manager: HubSpotManager) -> str:
         """Maneja el comando de reset"""
-        hubspot_manager.delete_contact()
+        # Borrar el contacto de HubSpot no depende de Cosmos: corre en paralelo
+        # con la carga y el borrado de la conversación
+        delete_future = _HUBSPOT_EXECUTOR.submit(hubspot_manager.delete_contact)
         self.chatbot.load_conversation(wa_id)
         self.chatbot.reset_conversation()
+        delete_future.result()
         logging.info(f"Conversación reiniciada para usuario {wa_id}")
         return "Conversación reiniciada. Puedes comenzar de nuevo."
     
@@ -414,6 +430,25 @@ class WhatsAppBot:
             logging.error(f"Error verificando si el usuario {wa_id} está autorizado: {e}")
             return False
     
+    def reject_code_injection(self, wa_id: str, whatsapp_message_id: str) -> None:
+        """
+        Responde a un mensaje con posible inyección de código sin cargar la
+        conversación. En el historial queda el marcador de seguridad (con el id
+        de WhatsApp del mensaje, para detectar reenvíos) y la respuesta.
+        """
+        response_for_lead = "No me queda claro lo que dices. ¿Podrías explicarme mejor?"
+        whatsapp_message_id_response = self.send_message(wa_id, response_for_lead)
+        whatsapp_ids = {
+            "safety_message": whatsapp_message_id,
+            "response_for_lead": whatsapp_message_id_response
+        }
+        try:
+            self._append_safety_messages(wa_id, CODE_INJECTION_MESSAGE, response_for_lead, whatsapp_ids)
+        except Exception as e:
+            # Sin documento de conversación (primer mensaje del lead) el patch
+            # falla; la respuesta ya se envió
+            logging.error(f"Error guardando mensajes de seguridad para usuario {wa_id}: {e}")
+
     def _save_safety_messages(self, wa_id: str, safety_message: str, response_for_lead: str, whatsapp_ids: Dict[str, str]) -> None:
         """
         Guarda los mensajes de seguridad en la base de datos usando _append_messages.
@@ -422,30 +457,32 @@ class WhatsAppBot:
         try:
             # Asegurar que el usuario tenga una conversación cargada
             self.chatbot.save_conversation()
-
-            # Preparar los dos mensajes a guardar
-            safety_messages = [
-                {
-                    "content": safety_message,
-                    "role": "user",
-                    "whatsapp_message_id": whatsapp_ids["safety_message"],
-                    "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")  # Se generará automáticamente en _append_messages
-                },
-                {
-                    "content": response_for_lead,
-                    "role": "bot",
-                    "whatsapp_message_id": whatsapp_ids["response_for_lead"],
-                    "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")  # Se generará automáticamente en _append_messages
-                }
-            ]
-            
-            # Usar _append_messages para guardar los mensajes
-            self.state_store._append_messages(wa_id, safety_messages)
-            logging.info(f"Mensajes de seguridad guardados para usuario {wa_id}")
-            
+            self._append_safety_messages(wa_id, safety_message, response_for_lead, whatsapp_ids)
         except Exception as e:
             logging.error(f"Error guardando mensajes de seguridad para usuario {wa_id}: {e}")
 
+    def _append_safety_messages(self, wa_id: str, safety_message: str, response_for_lead: str, whatsapp_ids: Dict[str, str]) -> None:
+        """Agrega al historial el mensaje de seguridad y la respuesta genérica (un patch, sin cargar)."""
+        # Preparar los dos mensajes a guardar
+        safety_messages = [
+            {
+                "content": safety_message,
+                "role": "user",
+                "whatsapp_message_id": whatsapp_ids["safety_message"],
+                "timestamp": utc_now_iso()  # Se generará automáticamente en _append_messages
+            },
+            {
+                "content": response_for_lead,
+                "role": "bot",
+                "whatsapp_message_id": whatsapp_ids["response_for_lead"],
+                "timestamp": utc_now_iso()  # Se generará automáticamente en _append_messages
+            }
+        ]
+        
+        # Usar _append_messages para guardar los mensajes
+        self.state_store._append_messages(wa_id, safety_messages)
+        logging.info(f"Mensajes de seguridad guardados para usuario {wa_id}")
+
     def _get_conversation_status(self, wa_id: str) -> str:
         """Obtiene el estado actual de la conversación del usuario."""
         try: